@@ -0,0 +1,145 @@
+"""
+Shared helpers for the benchmark scripts. Run them from api/, e.g.
+`python -m bench.connect_latency`.
+"""
+import argparse
+import os
+import statistics
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+
+
+def add_redis_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--redis-url', default=os.environ.get('BENCH_REDIS_URL'),
+        help='Real Redis to benchmark against (default: in-process fakeredis)',
+    )
+
+
+def redis_clients(url: str = None):
+    """Return (sync, async) clients talking to the same Redis (or the same fake)."""
+    if url:
+        import redis
+        import redis.asyncio as aioredis
+        return redis.from_url(url), aioredis.from_url(url)
+    import fakeredis
+    server = fakeredis.FakeServer()
+    return fakeredis.FakeRedis(server=server), fakeredis.FakeAsyncRedis(server=server)
+
+
+class CommandCounter:
+    """
+    Redis commands issued, from INFO on a real server or counted on the fake
+    connection (one per reply, so pipelined commands count individually).
+    """
+
+    def __init__(self, url: str = None):
+        self.url = url
+        self.server = None
+        self.fake_commands = 0
+        if url:
+            import redis
+            self._client = redis.from_url(url)
+        else:
+            import fakeredis
+            from fakeredis.aioredis import FakeAsyncRedisConnection
+
+            counter = self
+
+            class CountingConnection(FakeAsyncRedisConnection):
+                async def read_response(self, *args, **kwargs):
+                    counter.fake_commands += 1
+                    return await super().read_response(*args, **kwargs)
+
+            self.server = fakeredis.FakeServer()
+            self._connection_class = CountingConnection
+
+    def layer_hosts(self) -> list:
+        """channels_redis hosts on this Redis."""
+        if self.url:
+            return [self.url]
+        return [{'connection_class': self._connection_class, 'server': self.server}]
+
+    def async_client(self):
+        if self.url:
+            import redis.asyncio as aioredis
+            return aioredis.from_url(self.url)
+        import fakeredis
+        return fakeredis.FakeAsyncRedis(server=self.server, connection_class=self._connection_class)
+
+    def total(self) -> int:
+        if self.url:
+            return self._client.info('stats')['total_commands_processed']
+        return self.fake_commands
+
+
+def percentiles(samples_s: list) -> dict:
+    """Summarise latencies given in seconds as milliseconds."""
+    if not samples_s:
+        return {'n': 0}
+    ms = sorted(s * 1000 for s in samples_s)
+
+    def pick(q):
+        return round(ms[min(len(ms) - 1, int(q * len(ms)))], 3)
+
+    return {
+        'n': len(ms),
+        'mean': round(statistics.fmean(ms), 3),
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+    }
+
+
+def print_table(title: str, rows: dict):
+    print(title)
+    for name, stats in rows.items():
+        cells = '  '.join(f'{k}={v}' for k, v in stats.items())
+        print(f'  {name:<24} {cells}')
+
+
+class LayerOps:
+    """Counts channel-layer calls and per-channel deliveries on a layer instance."""
+
+    def __init__(self, layer):
+        self.calls = {'send': 0, 'group_send': 0, 'group_add': 0, 'group_discard': 0}
+        self.deliveries = 0
+        for name in self.calls:
+            setattr(layer, name, self._wrap(name, getattr(layer, name)))
+
+    def _wrap(self, name, fn):
+        async def counted(*args, **kwargs):
+            self.calls[name] += 1
+            if name == 'send':
+                self.deliveries += 1
+            return await fn(*args, **kwargs)
+        return counted
+
+    def reset(self):
+        self.deliveries = 0
+        for name in self.calls:
+            self.calls[name] = 0
+
+
+def use_local_backends(async_client):
+    """
+    Point the ASGI app at in-process stand-ins: the in-memory channel layer and
+    the given async Redis client for the matchmaking queue. Match logging is
+    turned off so benchmarks never touch MongoDB.
+    """
+    from django.conf import settings
+    from channels.layers import channel_layers
+    from chat import consumers
+    from chat.services import queue, worker
+
+    settings.CHANNEL_LAYERS = {
+        'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 100000}},
+    }
+    channel_layers.backends.clear()
+    queue.async_matchmaking_queue._injected = [async_client]
+    queue.async_matchmaking_queue._clients = None
+    consumers.log_match = consumers.log_match_end = worker.log_match = lambda *args, **kwargs: None
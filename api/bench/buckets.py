@@ -0,0 +1,85 @@
+"""
+Join latency of the attribute-bucketed matchmaking queue as the number of
+waiters grows (up to 100k synthetic waiters with random language, region and
+interests). Lookups should stay flat, not grow with queue depth.
+"""
+import argparse
+import json
+import random
+import time
+
+from bench._common import add_redis_args, percentiles, print_table, redis_clients, setup_django
+
+LANGS = ['en', 'es', 'fr', 'de', 'pt', 'hi', 'ar', 'ja', 'ko', 'ru']
+REGIONS = ['na', 'sa', 'eu', 'af', 'as', 'oc']
+TAGS = [f'tag{i}' for i in range(50)]
+
+
+def random_meta(rng: random.Random) -> dict:
+    meta = {}
+    if rng.random() < 0.9:
+        meta['lang'] = rng.choice(LANGS)
+    if rng.random() < 0.8:
+        meta['region'] = rng.choice(REGIONS)
+    meta['interests'] = rng.sample(TAGS, rng.randint(0, 3))
+    return meta
+
+
+def seed(client, queue_module, start: int, count: int, rng: random.Random):
+    """Write waiters straight into the queue structures (what join's enqueue does)."""
+    q = queue_module
+    now_ms = int(time.time() * 1000)
+    pipe = client.pipeline(transaction=False)
+    for i in range(start, start + count):
+        channel = f'bench.seed!{i}'
+        meta = random_meta(rng)
+        buckets = q.match_buckets(meta)
+        payload = {'channel_name': channel, 'user_id': f's{i}', 'meta': meta, 'worker': q.WORKER_ID, 'buckets': buckets}
+        pipe.zadd(q.QUEUE_KEY, {channel: now_ms})
+        pipe.hset(q.PAYLOAD_KEY, channel, json.dumps(payload))
+        pipe.sadd(f'{q.WORKER_WAITING_PREFIX}{q.WORKER_ID}', channel)
+        for name, delay in buckets:
+            pipe.zadd(f'{q.BUCKET_PREFIX}{name}', {channel: now_ms + delay})
+        if len(pipe) >= 5000:
+            pipe.execute()
+    pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depths', default='1000,10000,100000', help='Comma-separated waiter counts')
+    parser.add_argument('--joins', type=int, default=1000, help='Timed joins per depth')
+    add_redis_args(parser)
+    opts = parser.parse_args()
+    setup_django()
+
+    from chat.services import queue as queue_module
+    from chat.services.queue import MatchmakingQueue
+
+    client, _ = redis_clients(opts.redis_url)
+    queue = MatchmakingQueue(client=client)
+    queue.heartbeat()
+    rng = random.Random(42)
+    rows = {}
+    seeded = 0
+    for depth in sorted(int(d) for d in opts.depths.split(',')):
+        seed(client, queue_module, seeded, depth - seeded, rng)
+        seeded = depth
+        samples, matched = [], 0
+        for i in range(opts.joins):
+            start = time.perf_counter()
+            session = queue.join(f'bench.join!{depth}:{i}', f'j{i}', random_meta(rng))
+            samples.append(time.perf_counter() - start)
+            if 'session_id' in session:
+                matched += 1
+                # Keep the depth constant: replace the waiter we consumed.
+                seed(client, queue_module, seeded, 1, rng)
+                seeded += 1
+            else:
+                queue.leave_queue(f'bench.join!{depth}:{i}')
+        rows[f'{depth} waiters'] = {**percentiles(samples), 'matched': matched}
+    print_table(f'join latency by queue depth ({opts.joins} joins each), ms', rows)
+
+
+if __name__ == '__main__':
+    main()
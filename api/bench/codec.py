@@ -0,0 +1,77 @@
+"""
+Encode/decode cost of the wire formats used by ChatConsumer frames and the
+matchmaking queue payloads: stdlib json (the previous default), orjson (what
+chat.codec uses when installed) and MessagePack (the binary subprotocol).
+Frames are taken from bench/traces/ so SDP sizes are realistic.
+"""
+import argparse
+import json
+import os
+import time
+
+from bench._common import print_table
+from bench.signaling import TRACE_DIR, load_trace
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def sample_frames() -> dict:
+    trace = load_trace(os.path.join(TRACE_DIR, 'trickle_ice.jsonl'))
+    offer = next(item['payload'] for item in trace if item['payload'].get('type') == 'offer')
+    candidate = next(item['payload'] for item in trace if 'candidate' in item['payload'])
+    return {
+        'offer': {'type': 'signal', 'payload': offer, 'sender_id': 42},
+        'candidate': {'type': 'signal', 'payload': candidate, 'sender_id': 42},
+        'signals_x8': {'type': 'signals', 'payloads': [candidate] * 8, 'sender_id': 42},
+        'chat': {'type': 'chat', 'message': 'hey, where are you from?', 'sender_id': 42},
+        'queue_payload': {
+            'channel_name': 'specific.abc123!def456', 'user_id': '42',
+            'meta': {'lang': 'en', 'region': 'eu', 'interests': ['music', 'games', 'film']},
+            'worker': 'host-1234', 'buckets': [['lang:en|region:eu', 0], ['lang:en', 10000], ['*', 30000]],
+        },
+    }
+
+
+def codecs() -> dict:
+    table = {'json': (lambda o: json.dumps(o), json.loads)}
+    if orjson is not None:
+        table['orjson'] = (orjson.dumps, orjson.loads)
+    if msgpack is not None:
+        table['msgpack'] = (lambda o: msgpack.packb(o, use_bin_type=True), lambda b: msgpack.unpackb(b, raw=False))
+    return table
+
+
+def _time(fn, arg, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    for frame_name, frame in sample_frames().items():
+        rows = {}
+        for codec_name, (encode, decode) in codecs().items():
+            wire = encode(frame)
+            rows[codec_name] = {
+                'bytes': len(wire),
+                'encode_us': round(_time(encode, frame, args.iterations) * 1e6, 2),
+                'decode_us': round(_time(decode, wire, args.iterations) * 1e6, 2),
+            }
+        print_table(frame_name, rows)
+
+
+if __name__ == '__main__':
+    main()
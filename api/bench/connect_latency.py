@@ -0,0 +1,62 @@
+"""
+Connect-to-matched latency of the matchmaking join: the old executor path
+(sync client via sync_to_async, then a get_session read-back) against the
+native redis.asyncio queue awaited directly.
+"""
+import argparse
+import asyncio
+import time
+
+from bench._common import add_redis_args, percentiles, print_table, redis_clients, setup_django
+
+
+async def _run(join_matched, pairs: int, concurrency: int) -> list:
+    samples = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one_join(i):
+        async with sem:
+            start = time.perf_counter()
+            session = await join_matched(f'bench.specific!{i}', f'u{i}')
+            if 'session_id' in session:
+                samples.append(time.perf_counter() - start)
+
+    # Every joiner either waits or completes a match; only the completing join
+    # (the one that receives the session) is timed.
+    await asyncio.gather(*(one_join(i) for i in range(pairs * 2)))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pairs', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    add_redis_args(parser)
+    opts = parser.parse_args()
+    setup_django()
+
+    from asgiref.sync import sync_to_async
+    from chat.services.queue import AsyncMatchmakingQueue, MatchmakingQueue
+
+    sync_client, async_client = redis_clients(opts.redis_url)
+    sync_queue = MatchmakingQueue(client=sync_client)
+    async_queue = AsyncMatchmakingQueue(client=async_client)
+
+    async def executor_join(channel, user):
+        session = await sync_to_async(sync_queue.join)(channel, user)
+        if 'session_id' in session:
+            session = await sync_to_async(sync_queue.get_session)(session['session_id'])
+        return session
+
+    async def native_join(channel, user):
+        return await async_queue.join(channel, user)
+
+    rows = {}
+    for name, fn in (('sync_to_async', executor_join), ('redis.asyncio', native_join)):
+        samples = asyncio.run(_run(fn, opts.pairs, opts.concurrency))
+        rows[name] = percentiles(samples)
+    print_table(f'connect-to-matched ({opts.pairs} pairs, concurrency {opts.concurrency}), ms', rows)
+
+
+if __name__ == '__main__':
+    main()
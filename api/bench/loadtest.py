@@ -0,0 +1,334 @@
+"""
+End-to-end load test: simulated users drive config.asgi.application over
+WebSocket, in process, against a Redis stand-in (fakeredis, or --redis-url).
+
+Each user connects, waits for a match and then plays its behavior:
+  chatter  pings its partner with chat messages (the partner echoes them back,
+           giving the message RTT), then presses next
+  caller   runs a WebRTC offer/answer with trickle-ICE candidates over 'signal',
+           chats a little, then hangs up (disconnects)
+  skipper  presses next shortly after every match
+After --sessions-per-connect sessions a user disconnects, thinks, and connects
+again, until --duration is over. --mix sets the share of each behavior.
+
+Reports connects/s, time-to-match and RTT percentiles, matches/s and Redis
+commands per match (queue and, for the redis/hybrid layers, channel layer).
+--save-baseline writes the summary as JSON; --baseline compares a run with a
+stored summary and exits 1 when a metric is worse by more than --tolerance;
+with --repeat both use the per-metric median of several runs.
+Simulated clients share the event loop (and CPU) with the app, so once that
+saturates the latencies include client time. Timings depend on the machine:
+keep one baseline per machine and setup (bench/baselines/loadtest.json was
+taken on a single core with fakeredis and the options stored in it).
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+
+from bench._common import CommandCounter, add_redis_args, percentiles, print_table, setup_django
+
+BEHAVIORS = {
+    'chatter': {'chats': 5, 'signals': 0, 'then': 'next'},
+    'caller': {'chats': 2, 'signals': 10, 'then': 'disconnect'},
+    'skipper': {'chats': 0, 'signals': 0, 'then': 'next'},
+}
+# Summary metrics compared against a baseline: True when higher is better
+CHECKS = {
+    'connects_per_s': True,
+    'matches_per_s': True,
+    'ttm_p95_ms': False,
+    'rtt_p95_ms': False,
+    'redis_cmds_per_match': False,
+    'errors': False,
+}
+SDP = 'v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n' + 'a=candidate:placeholder\r\n' * 40
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(','):
+        name, _, share = item.partition('=')
+        if name.strip() not in BEHAVIORS:
+            raise SystemExit(f'unknown behavior {name!r}; choose from {", ".join(BEHAVIORS)}')
+        mix[name.strip()] = float(share or 1)
+    return mix
+
+
+class Stats:
+    def __init__(self):
+        self.connect = []
+        self.ttm = []
+        self.rtt = []
+        self.counts = Counter()
+        self.closes = Counter()
+
+
+class User:
+    """One simulated client; a new WebsocketCommunicator per connection."""
+
+    def __init__(self, application, behavior: dict, opts, stats: Stats, rng: random.Random):
+        self.application = application
+        self.behavior = behavior
+        self.opts = opts
+        self.stats = stats
+        self.rng = rng
+
+    async def run(self, deadline: float):
+        while time.monotonic() < deadline:
+            try:
+                await self._connection(deadline)
+            except Exception as e:
+                # The app raised; WebsocketCommunicator hands it to whichever call came next
+                self.stats.counts['errors'] += 1
+                self.stats.counts['app_' + type(e).__name__] += 1
+            await asyncio.sleep(self.rng.uniform(0, 2 * self.opts.think_ms / 1000))
+
+    async def _connection(self, deadline: float):
+        from channels.testing import WebsocketCommunicator
+
+        comm = WebsocketCommunicator(self.application, '/ws/chat/')
+        start = time.perf_counter()
+        connected, _ = await comm.connect(timeout=10)
+        if not connected:
+            self.stats.counts['connect_failed'] += 1
+            return
+        self.stats.connect.append(time.perf_counter() - start)
+        self.stats.counts['connects'] += 1
+        self.comm = comm
+        self.queued_at = start
+        self.sessions = 0
+        self.actions = []  # (due, coroutine factory) of the current session
+        self.session_id = None
+        try:
+            await self._loop(deadline)
+        finally:
+            if self.closed is None:
+                await comm.disconnect()
+
+    async def _loop(self, deadline: float):
+        self.closed = None
+        while self.closed is None:
+            now = time.monotonic()
+            if now >= deadline + 1:
+                return
+            due = min((at for at, _ in self.actions), default=deadline + 1)
+            try:
+                message = await asyncio.wait_for(self.comm.output_queue.get(), max(0.001, due - now))
+            except asyncio.TimeoutError:
+                message = None
+            if message is not None:
+                await self._handle(message, deadline)
+            now = time.monotonic()
+            ready = [action for action in self.actions if action[0] <= now]
+            self.actions = [action for action in self.actions if action[0] > now]
+            for _, act in ready:
+                if self.closed is None:
+                    await act()
+
+    async def _send(self, frame: dict):
+        await self.comm.send_to(text_data=json.dumps(frame))
+        self.stats.counts['sent_' + frame['type']] += 1
+
+    async def _handle(self, message: dict, deadline: float):
+        if message['type'] == 'websocket.close':
+            self.closed = message.get('code', 1000)
+            self.stats.closes[self.closed] += 1
+            return
+        frame = json.loads(message['text'])
+        kind = frame['type']
+        self.stats.counts['recv_' + kind] += 1
+        now = time.perf_counter()
+        if kind == 'matched':
+            self.stats.ttm.append(now - self.queued_at)
+            self.session_id = frame['session_id']
+            self._plan_session(frame['is_initiator'])
+        elif kind == 'chat':
+            text = frame['message']
+            if text.startswith('ping '):
+                await self._send({'type': 'chat', 'message': 'pong ' + text[5:]})
+            elif text.startswith('pong '):
+                self.stats.rtt.append(now - float(text.split()[2]))
+        elif kind == 'signal' and frame['payload'].get('type') == 'offer':
+            await self._send({'type': 'signal', 'payload': {'type': 'answer', 'sdp': SDP}})
+        elif kind in ('partner_next', 'partner_left'):
+            # partner_next re-queues us on the server; after partner_left the client asks
+            self._end_session()
+            if kind == 'partner_left' and time.monotonic() < deadline:
+                await self._send({'type': 'next'})
+        elif kind in ('duplicate', 'error', 'overloaded'):
+            self.stats.counts['errors'] += 1
+
+    def _plan_session(self, is_initiator: bool):
+        think = self.opts.think_ms / 1000
+        at = time.monotonic()
+        actions = []
+        if self.behavior['signals'] and is_initiator:
+            actions.append((at, lambda: self._send({'type': 'signal', 'payload': {'type': 'offer', 'sdp': SDP}})))
+        for i in range(self.behavior['signals']):
+            candidate = {'candidate': f'candidate:{i} 1 udp 2122260223 10.0.0.{i % 250} {50000 + i} typ host'}
+            actions.append((at + think * 0.1 * (i + 1), lambda c=candidate: self._send({'type': 'signal', 'payload': c})))
+        for i in range(self.behavior['chats']):
+            at += self.rng.uniform(0.5, 1.5) * think
+            actions.append((at, lambda n=i: self._send({'type': 'chat', 'message': f'ping {n} {time.perf_counter()}'})))
+        at += self.rng.uniform(0.5, 1.5) * think
+        actions.append((at, self._finish_session))
+        self.actions = actions
+
+    def _end_session(self):
+        self.session_id = None
+        self.actions = []
+        self.queued_at = time.perf_counter()
+
+    async def _finish_session(self):
+        self.sessions += 1
+        if self.behavior['then'] == 'next' and self.sessions < self.opts.sessions_per_connect:
+            self._end_session()
+            await self._send({'type': 'next'})
+        else:
+            self.closed = 1000
+            await self.comm.disconnect()
+
+
+def configure(opts, counter: CommandCounter):
+    """Point the app at the Redis stand-in and the chosen channel layer."""
+    from django.conf import settings
+    from channels.layers import channel_layers
+    from bench._common import use_local_backends
+
+    config = {**settings.CHANNEL_LAYERS['default']['CONFIG'], 'hosts': counter.layer_hosts()}
+    use_local_backends(counter.async_client())
+    if opts.layer != 'memory':
+        backend = {'redis': 'channels_redis.core.RedisChannelLayer', 'hybrid': 'chat.layers.HybridChannelLayer'}[opts.layer]
+        settings.CHANNEL_LAYERS = {'default': {'BACKEND': backend, 'CONFIG': config}}
+        channel_layers.backends.clear()
+    if not opts.rate_limits:
+        # Simulated users act in compressed time, far faster than the per-user limits allow
+        settings.CHAT_RATE_LIMITS = {}
+
+
+async def run(opts) -> dict:
+    from config.asgi import application
+
+    counter = CommandCounter(opts.redis_url)
+    configure(opts, counter)
+    if opts.redis_url:
+        await counter.async_client().flushdb()
+    rng = random.Random(opts.seed)
+    mix = parse_mix(opts.mix)
+    stats = Stats()
+    names = list(mix)
+    users = [
+        User(application, BEHAVIORS[rng.choices(names, weights=[mix[n] for n in names])[0]], opts, stats, random.Random(rng.random()))
+        for _ in range(opts.users)
+    ]
+    before = counter.total()
+    start = time.monotonic()
+    deadline = start + opts.duration
+
+    async def ramp(user, delay):
+        await asyncio.sleep(delay)
+        await user.run(deadline)
+
+    await asyncio.gather(*(ramp(user, opts.ramp * i / opts.users) for i, user in enumerate(users)))
+    elapsed = time.monotonic() - start
+    commands = counter.total() - before
+    matches = len(stats.ttm) / 2
+    ttm, rtt = percentiles(stats.ttm), percentiles(stats.rtt)
+    return {
+        'summary': {
+            'connects_per_s': round(stats.counts['connects'] / elapsed, 1),
+            'matches_per_s': round(matches / elapsed, 1),
+            'ttm_p50_ms': ttm.get('p50'), 'ttm_p95_ms': ttm.get('p95'), 'ttm_p99_ms': ttm.get('p99'),
+            'rtt_p50_ms': rtt.get('p50'), 'rtt_p95_ms': rtt.get('p95'), 'rtt_p99_ms': rtt.get('p99'),
+            'redis_cmds_per_match': round(commands / matches, 1) if matches else None,
+            'errors': stats.counts['errors'] + stats.counts['connect_failed'],
+        },
+        'connect': percentiles(stats.connect),
+        'counts': dict(stats.counts),
+        'closes': dict(stats.closes),
+    }
+
+
+def median_summary(summaries: list) -> dict:
+    """Per-metric median over repeated runs, which damps the tail-latency noise of a single run."""
+    merged = {}
+    for name in summaries[0]:
+        values = [summary[name] for summary in summaries if summary.get(name) is not None]
+        merged[name] = statistics.median(values) if values else None
+    return merged
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    """Metrics worse than the baseline by more than tolerance, as printable rows."""
+    rows, failures = {}, []
+    for name, higher_is_better in CHECKS.items():
+        now, then = summary.get(name), baseline.get(name)
+        if now is None or then is None:
+            continue
+        if name == 'errors':
+            worse = now > then
+        elif higher_is_better:
+            worse = now < then * (1 - tolerance)
+        else:
+            worse = now > then * (1 + tolerance)
+        change = f'{(now - then) / then:+.0%}' if then else 'n/a'
+        rows[name] = {'baseline': then, 'now': now, 'change': change, 'status': 'FAIL' if worse else 'ok'}
+        if worse:
+            failures.append(name)
+    print_table(f'against baseline (tolerance {tolerance:.0%})', rows)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=20, help='Seconds users keep (re)connecting')
+    parser.add_argument('--ramp', type=float, default=5, help='Seconds over which users start')
+    parser.add_argument('--mix', default='chatter=0.5,caller=0.3,skipper=0.2')
+    parser.add_argument('--think-ms', type=float, default=200, help='Mean pause between a user\'s actions')
+    parser.add_argument('--sessions-per-connect', type=int, default=3)
+    parser.add_argument('--layer', choices=('memory', 'hybrid', 'redis'), default='memory')
+    parser.add_argument('--rate-limits', action='store_true', help='Keep CHAT_RATE_LIMITS (off by default)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='Runs to take the median summary of')
+    parser.add_argument('--baseline', help='Summary JSON to compare against; exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--save-baseline', help='Write this run\'s summary JSON here')
+    add_redis_args(parser)
+    opts = parser.parse_args()
+    setup_django()
+
+    results = [asyncio.run(run(opts)) for _ in range(opts.repeat)]
+    summary = median_summary([result['summary'] for result in results])
+    title = f'load test ({opts.users} users, {opts.duration:g}s, {opts.mix}, {opts.layer} layer)'
+    rows = {}
+    for i, result in enumerate(results, 1):
+        rows[f'run {i}'] = result['summary']
+    if opts.repeat > 1:
+        rows['median'] = summary
+    last = results[-1]
+    rows.update({
+        'connect_ms (last run)': last['connect'],
+        'frames (last run)': last['counts'],
+        'closes (last run)': last['closes'] or {'none': 0},
+    })
+    print_table(title, rows)
+    if opts.save_baseline:
+        with open(opts.save_baseline, 'w') as f:
+            json.dump({'options': {k: v for k, v in vars(opts).items() if k not in ('baseline', 'save_baseline')},
+                       'summary': summary}, f, indent=2)
+            f.write('\n')
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        if compare(summary, baseline['summary'], opts.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
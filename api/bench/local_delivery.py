@@ -0,0 +1,120 @@
+"""
+Same-process delivery in a multi-worker deployment.
+
+1. Pairing: joiners on random workers take partners from a standing queue of
+   waiters spread over the same workers; reports the share of sessions whose
+   peers share a worker, with and without MATCHMAKING_PREFER_LOCAL_DEPTH.
+2. Relay: replays a session's worth of messages between two channels on one
+   layer instance (same process) and on two instances (different processes),
+   for RedisChannelLayer and chat.layers.HybridChannelLayer; reports per-message
+   latency and Redis commands per session.
+
+The expected Redis commands per session combine the two.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from bench._common import CommandCounter, add_redis_args, percentiles, print_table, redis_clients, setup_django
+
+
+def seed_waiters(client, q, count: int, workers: list, rng: random.Random):
+    """Waiters that have already relaxed into the 'anyone' bucket, on random workers."""
+    now_ms = int(time.time() * 1000)
+    pipe = client.pipeline(transaction=False)
+    for worker in workers:
+        pipe.zadd(q.WORKERS_KEY, {worker: now_ms // 1000})
+    for i in range(count):
+        channel = f'bench.seed!{i}'
+        worker = rng.choice(workers)
+        payload = {'channel_name': channel, 'user_id': f's{i}', 'meta': {}, 'worker': worker, 'buckets': [[q.ANY_BUCKET, 0]]}
+        pipe.zadd(q.QUEUE_KEY, {channel: now_ms - 30000})
+        pipe.hset(q.PAYLOAD_KEY, channel, json.dumps(payload))
+        pipe.sadd(f'{q.WORKER_WAITING_PREFIX}{worker}', channel)
+        pipe.zadd(f'{q.BUCKET_PREFIX}{q.ANY_BUCKET}', {channel: now_ms - 1})
+    pipe.execute()
+
+
+def local_pair_share(client, workers: int, depth: int, joins: int, prefer_depth: int) -> float:
+    from chat.services import queue as q
+
+    client.flushdb()
+    rng = random.Random(7)
+    worker_ids = [f'bench-worker-{i}' for i in range(workers)]
+    seed_waiters(client, q, depth, worker_ids, rng)
+    matchmaking = q.MatchmakingQueue(client=client)
+    q.PREFER_LOCAL_DEPTH = prefer_depth
+    local = 0
+    for i in range(joins):
+        q.WORKER_ID = rng.choice(worker_ids)
+        session = matchmaking.join(f'bench.join!{i}', f'j{i}', {})
+        local += session['user1']['worker'] == session['user2']['worker']
+    return local / joins
+
+
+async def _relay(layer_cls, counter: CommandCounter, same_process: bool, sessions: int, messages: int) -> dict:
+    hosts = counter.layer_hosts()
+    first = layer_cls(hosts=hosts)
+    second = first if same_process else layer_cls(hosts=hosts)
+    latencies = []
+    before = counter.total()
+    for _ in range(sessions):
+        a = await first.new_channel()
+        b = await second.new_channel()
+        for i in range(messages):
+            start = time.perf_counter()
+            await first.send(b, {'type': 'webrtc_signal', 'channel': a, 'payload': {'candidate': f'c{i}'}})
+            await second.receive(b)
+            latencies.append(time.perf_counter() - start)
+    commands = counter.total() - before
+    for layer in {first, second}:
+        await layer.flush()
+    return {'commands': commands / sessions, 'latency': percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=500, help='Standing queue depth for the pairing run')
+    parser.add_argument('--joins', type=int, default=400)
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=40, help='Relayed messages per session (chat + signals)')
+    add_redis_args(parser)
+    opts = parser.parse_args()
+    setup_django()
+
+    from channels_redis.core import RedisChannelLayer
+    from chat.layers import HybridChannelLayer
+
+    client, _ = redis_clients(opts.redis_url)
+    shares = {
+        'prefer_local=off': local_pair_share(client, opts.workers, opts.depth, opts.joins, 0),
+        'prefer_local=on': local_pair_share(client, opts.workers, opts.depth, opts.joins, 1),
+    }
+    print_table(f'same-worker sessions ({opts.workers} workers, {opts.depth} waiting)',
+                {name: {'share': round(share, 3)} for name, share in shares.items()})
+
+    counter = CommandCounter(opts.redis_url)
+    relay = {}
+    for layer_cls in (RedisChannelLayer, HybridChannelLayer):
+        for same_process in (True, False):
+            name = f'{layer_cls.__name__}/{"same" if same_process else "cross"}'
+            relay[name] = asyncio.run(_relay(layer_cls, counter, same_process, opts.sessions, opts.messages))
+    print_table(f'relay ({opts.messages} messages/session)', {
+        name: {'redis_cmds/session': round(r['commands'], 1), 'p50_ms': r['latency']['p50'], 'p99_ms': r['latency']['p99']}
+        for name, r in relay.items()
+    })
+
+    expected = {}
+    for layer_name in ('RedisChannelLayer', 'HybridChannelLayer'):
+        for share_name, share in shares.items():
+            same = relay[f'{layer_name}/same']['commands']
+            cross = relay[f'{layer_name}/cross']['commands']
+            expected[f'{layer_name} {share_name}'] = {'redis_cmds/session': round(share * same + (1 - share) * cross, 1)}
+    print_table('expected relay Redis commands per session', expected)
+
+
+if __name__ == '__main__':
+    main()
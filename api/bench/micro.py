@@ -0,0 +1,397 @@
+"""
+Microbenchmarks of the chat/services building blocks, each against a local
+stand-in: the matchmaking queue (fakeredis, or --redis-url) at several queue
+depths, identity lookups (a seeded SQLite file), match logging (a recording
+collection in place of MongoDB) and the frame codec.
+
+Every benchmark runs --repeat timed rounds and reports the best one as
+ops_per_s and us_per_op (like timeit: slower rounds measure interference from
+the rest of the machine), with the median round and the spread of the rounds.
+The garbage collector is off during timed rounds. Per-op setup (seeding a
+waiter to leave, restoring the depth after a match) is not timed. Allocations
+are measured in a separate untimed pass under tracemalloc: peak_bytes is the
+median peak of traced memory during one op, retained_bytes the memory still
+held per op after a round (steady growth hints at a leak or an unbounded cache).
+
+--json writes the results for later; --compare OLD.json runs and compares
+against a stored file, and with --against NEW.json compares two stored files
+without running:
+
+    python -m bench.micro --json before.json
+    ... change chat/services ...
+    python -m bench.micro --compare before.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from bench._common import add_redis_args, print_table, redis_clients, setup_django
+
+
+class Bench:
+    """
+    op(*setup()) is timed; setup() and after(result) run untimed around each op,
+    prepare() before each round (outside the event loop when op is a coroutine
+    function). Without setup/after a round is timed as one loop.
+    """
+
+    def __init__(self, name: str, op, number: int, setup=None, after=None, prepare=None):
+        self.name = name
+        self.op = op
+        self.number = number
+        self.setup = setup
+        self.after = after
+        self.prepare = prepare
+
+    def _round(self, number: int) -> float:
+        op, setup, after = self.op, self.setup, self.after
+        if setup is None and after is None:
+            start = time.perf_counter()
+            for _ in range(number):
+                op()
+            return time.perf_counter() - start
+        elapsed = 0.0
+        for _ in range(number):
+            args = setup() if setup else ()
+            start = time.perf_counter()
+            result = op(*args)
+            elapsed += time.perf_counter() - start
+            if after:
+                after(result)
+        return elapsed
+
+    async def _round_async(self, number: int) -> float:
+        elapsed = 0.0
+        for _ in range(number):
+            args = self.setup() if self.setup else ()
+            start = time.perf_counter()
+            result = await self.op(*args)
+            elapsed += time.perf_counter() - start
+            if self.after:
+                self.after(result)
+        return elapsed
+
+    def round(self, number: int) -> float:
+        if self.prepare:
+            self.prepare()
+        # Like timeit: a collection triggered by earlier rounds' garbage would land on a random op
+        gc.collect()
+        gc.disable()
+        try:
+            if asyncio.iscoroutinefunction(self.op):
+                return asyncio.run(self._round_async(number))
+            return self._round(number)
+        finally:
+            gc.enable()
+
+    def allocations(self, number: int) -> dict:
+        """Median peak traced memory of one op, and memory retained per op over number ops."""
+        is_async = asyncio.iscoroutinefunction(self.op)
+        loop = asyncio.new_event_loop() if is_async else None
+        peaks = []
+        if self.prepare:
+            self.prepare()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(number):
+                args = self.setup() if self.setup else ()
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                result = loop.run_until_complete(self.op(*args)) if is_async else self.op(*args)
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+                if self.after:
+                    self.after(result)
+            retained = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+            if loop is not None:
+                loop.close()
+        return {'peak_bytes': int(statistics.median(peaks)), 'retained_bytes': round(retained / number, 1)}
+
+    def run(self, repeat: int, scale: float) -> dict:
+        number = max(1, int(self.number * scale))
+        self.round(max(1, number // 10))  # warm-up: caches, script loading, first-query setup
+        per_op = sorted(self.round(number) / number for _ in range(repeat))
+        best = per_op[0]
+        return {
+            'ops_per_s': round(1 / best),
+            'us_per_op': round(best * 1e6, 3),
+            'median_us': round(statistics.median(per_op) * 1e6, 3),
+            'spread_pct': round((per_op[-1] - best) / best * 100, 1),
+            **self.allocations(min(number, 200)),
+        }
+
+
+def seed_waiters(client, q, start: int, count: int):
+    """Waiters already relaxed into the 'anyone' bucket, written straight into the queue structures."""
+    now_ms = int(time.time() * 1000)
+    pipe = client.pipeline(transaction=False)
+    for i in range(start, start + count):
+        channel = f'bench.micro!{i}'
+        payload = {'channel_name': channel, 'user_id': f's{i}', 'meta': {}, 'worker': q.WORKER_ID, 'buckets': [[q.ANY_BUCKET, 0]]}
+        pipe.zadd(q.QUEUE_KEY, {channel: now_ms - 30000})
+        pipe.hset(q.PAYLOAD_KEY, channel, json.dumps(payload))
+        pipe.sadd(f'{q.WORKER_WAITING_PREFIX}{q.WORKER_ID}', channel)
+        pipe.zadd(f'{q.BUCKET_PREFIX}{q.ANY_BUCKET}', {channel: now_ms - 1})
+        if len(pipe) >= 5000:
+            pipe.execute()
+    pipe.execute()
+
+
+def queue_benches(client, depth: int) -> list:
+    """join/leave_queue/get_session/delete_session with depth waiters queued."""
+    from chat.services import queue as q
+
+    client.flushdb()
+    matchmaking = q.MatchmakingQueue(client=client)
+    matchmaking.heartbeat()
+    seed_waiters(client, q, 0, depth)
+    ids = iter(range(depth, 10 ** 9))
+
+    def new_waiter():
+        i = next(ids)
+        seed_waiters(client, q, i, 1)
+        return f'bench.micro!{i}'
+
+    def new_session():
+        # Pairs a fresh waiter with a fresh joiner, so the queue depth is unchanged
+        new_waiter()
+        i = next(ids)
+        return (matchmaking.join(f'bench.join!{i}', f'j{i}', {})['session_id'],)
+
+    last_joiner = []
+
+    def joiner():
+        i = next(ids)
+        last_joiner[:] = [f'bench.join!{i}']
+        return f'bench.join!{i}', f'j{i}', {}
+
+    def after_join(result):
+        # Put the queue back as it was: replace the matched waiter, or drop the new one
+        if 'session_id' in result:
+            matchmaking.delete_session(result['session_id'])
+            new_waiter()
+        else:
+            matchmaking.leave_queue(last_joiner[0])
+
+    session_id = new_session()[0]
+    label = f'[depth={depth}]'
+    return [
+        Bench(f'queue.join {"match" if depth else "wait"}{label}', matchmaking.join, 2000, joiner, after_join),
+        Bench(f'queue.leave_queue{label}', matchmaking.leave_queue, 2000, lambda: (new_waiter(),)),
+        Bench(f'queue.get_session{label}', lambda: matchmaking.get_session(session_id), 5000),
+        Bench(f'queue.delete_session{label}', matchmaking.delete_session, 2000, new_session),
+    ]
+
+
+def seed_users(count: int) -> list:
+    """count users with profiles (every 10th banned) in a fresh SQLite file; returns their ids."""
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+    from django.db import connections
+    from chat.models import UserProfile
+
+    settings.DEBUG = False  # connection.queries would show up as retained memory
+    settings.DATABASES['default']['NAME'] = os.path.join(tempfile.mkdtemp(prefix='bench-micro-'), 'db.sqlite3')
+    connections['default'].close()
+    call_command('migrate', verbosity=0, interactive=False)
+    User = get_user_model()
+    users = User.objects.bulk_create(User(username=f'bench{i}') for i in range(count))
+    UserProfile.objects.bulk_create(
+        UserProfile(user=user, display_name=f'Bench {i}', is_banned=i % 10 == 0) for i, user in enumerate(users)
+    )
+    return [user.pk for user in users]
+
+
+def identity_benches(user_count: int) -> list:
+    from chat.services import identity
+
+    user_ids = seed_users(user_count)
+    cycle = iter(range(10 ** 9))
+
+    def next_user():
+        return (user_ids[next(cycle) % len(user_ids)],)
+
+    def uncached():
+        identity.identity_cache.clear()
+        return next_user()
+
+    hot = [str(user_id) for user_id in user_ids[:100]]  # as the JWT middleware passes them
+
+    def fill_cache():
+        for user_id in hot:
+            identity.identity_cache.set(user_id, identity.load_identity(user_id))
+
+    def cached():
+        return (hot[next(cycle) % len(hot)],)
+
+    # get_identity is the connect-time profile and ban check (identity['is_banned'])
+    return [
+        Bench('identity.load_identity (query)', identity.load_identity, 2000, next_user),
+        Bench('identity.get_identity (miss)', identity.get_identity, 1000, uncached),
+        Bench('identity.get_identity (hit)', identity.get_identity, 5000, cached, prepare=fill_cache),
+    ]
+
+
+class _Collection:
+    """Stands in for the matches collection: keeps the last bulk write, so only client-side cost is timed."""
+
+    def __init__(self):
+        self.last_ops = []
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def bulk_write(self, ops, ordered=True):
+        self.last_ops = ops
+
+
+def mongo_benches() -> list:
+    from types import SimpleNamespace
+    from chat.services import mongo
+
+    db = SimpleNamespace(matches=_Collection())
+    mongo.get_mongo_db = lambda: db
+    # A writer whose queue is never drained: measures what the WebSocket path pays
+    queued = mongo.MatchLogWriter(max_queue=10 ** 7, batch_size=200, flush_interval=1.0)
+    queued._thread = object()
+    mongo.match_log_writer = queued
+    writer = mongo.MatchLogWriter(max_queue=1000, batch_size=200, flush_interval=1.0)
+    ids = iter(range(10 ** 9))
+
+    def batch():
+        started = str(time.time())
+        events = []
+        for _ in range(100):
+            session_id = f's{next(ids)}'
+            events.append({'kind': 'start', 'session_id': session_id, 'user_ids': ['1', '2'], 'started_at': started, 'ended_at': None})
+            events.append({'kind': 'end', 'session_id': session_id, 'ended_at': started, 'duration': 12.5})
+        return (events,)
+
+    return [
+        Bench('mongo.log_match (enqueue)', lambda: mongo.log_match(f's{next(ids)}', ['1', '2'], '1700000000.0'), 20000),
+        Bench('mongo.log_match_end (enqueue)', lambda: mongo.log_match_end(f's{next(ids)}', 1700000000.0), 20000),
+        Bench('mongo.write (200-event batch)', writer._write, 50, batch),
+    ]
+
+
+def codec_benches() -> list:
+    from chat import codec
+    from bench.codec import sample_frames
+
+    frames = sample_frames()
+    benches = []
+    for name in ('chat', 'candidate', 'offer'):
+        frame = frames[name]
+        text = codec.dumps(frame)
+        benches.append(Bench(f'codec.dumps[{name}]', lambda f=frame: codec.dumps(f), 20000))
+        benches.append(Bench(f'codec.loads[{name}]', lambda t=text: codec.loads(t), 20000))
+        if codec.supports_msgpack():
+            data = codec.packb(frame)
+            benches.append(Bench(f'codec.packb[{name}]', lambda f=frame: codec.packb(f), 20000))
+            benches.append(Bench(f'codec.unpackb[{name}]', lambda d=data: codec.unpackb(d), 20000))
+    return benches
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare(old: dict, new: dict, threshold: float):
+    """
+    Per-benchmark change in ops/sec and allocations. A change smaller than
+    threshold, or than the spread of either run's rounds, is reported as 'same'.
+    """
+    rows = {}
+    for name, result in new['results'].items():
+        base = old['results'].get(name)
+        if base is None:
+            continue
+        speed = result['ops_per_s'] / base['ops_per_s'] - 1
+        noise = max(threshold, base['spread_pct'] / 100, result['spread_pct'] / 100)
+        row = {
+            'ops_per_s': f"{base['ops_per_s']} -> {result['ops_per_s']}",
+            'change': f'{speed:+.1%}',
+            'verdict': 'faster' if speed > noise else 'slower' if speed < -noise else 'same',
+        }
+        if base['peak_bytes'] != result['peak_bytes']:
+            row['peak_bytes'] = f"{base['peak_bytes']} -> {result['peak_bytes']}"
+        if base['retained_bytes'] != result['retained_bytes']:
+            row['retained_bytes'] = f"{base['retained_bytes']} -> {result['retained_bytes']}"
+        rows[name] = row
+    print_table(f"{old['meta'].get('revision') or 'old'} vs {new['meta'].get('revision') or 'new'} (threshold {threshold:.0%})", rows)
+    added = sorted(set(new['results']) - set(old['results']))
+    if added:
+        print(f'  not in the old results: {", ".join(added)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depths', default='0,1000,10000', help='Comma-separated queue depths')
+    parser.add_argument('--users', type=int, default=1000, help='Seeded users for the identity benchmarks')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed rounds per benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply the ops per round')
+    parser.add_argument('--json', help='Write the results here')
+    parser.add_argument('--compare', metavar='OLD.json', help='Compare with these stored results')
+    parser.add_argument('--against', metavar='NEW.json', help='With --compare: compare two stored files, no run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Smaller ops/sec changes count as noise')
+    add_redis_args(parser)
+    opts = parser.parse_args()
+
+    if opts.compare and opts.against:
+        with open(opts.compare) as old, open(opts.against) as new:
+            compare(json.load(old), json.load(new), opts.threshold)
+        return
+
+    setup_django()
+    client, _ = redis_clients(opts.redis_url)
+    groups = [
+        *(lambda depth=int(d): queue_benches(client, depth) for d in opts.depths.split(',')),
+        lambda: identity_benches(opts.users),
+        mongo_benches,
+        codec_benches,
+    ]
+    results = {}
+    for group in groups:
+        for bench in group():
+            if opts.filter in bench.name:
+                results[bench.name] = bench.run(opts.repeat, opts.scale)
+    print_table(f'microbenchmarks (best of {opts.repeat} rounds)', results)
+
+    output = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'redis': 'server' if opts.redis_url else 'fakeredis',
+            'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(output, f, indent=2)
+            f.write('\n')
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(json.load(f), output, opts.threshold)
+
+
+if __name__ == '__main__':
+    main()
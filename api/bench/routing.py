@@ -0,0 +1,86 @@
+"""
+Peer relay throughput through ChatConsumer for both routing modes: 'group'
+(per-session group fan-out, sender drops its own echo) and 'direct'
+(send to the partner's channel only). Drives config.asgi.application with two
+WebSocket clients on the in-memory channel layer.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bench._common import LayerOps, redis_clients, setup_django, use_local_backends
+
+
+async def _pair(application):
+    from channels.testing import WebsocketCommunicator
+    first = WebsocketCommunicator(application, '/ws/chat/')
+    second = WebsocketCommunicator(application, '/ws/chat/')
+    for client in (first, second):
+        connected, _ = await client.connect()
+        assert connected
+    # Drain connect frames until both sides report a match.
+    for client in (first, second):
+        while True:
+            frame = json.loads(await client.receive_from(timeout=5))
+            if frame['type'] == 'matched':
+                break
+    return first, second
+
+
+async def _run(application, layer_ops, messages: int, kind: str) -> dict:
+    first, second = await _pair(application)
+    layer_ops.reset()
+    if kind == 'chat':
+        frame = json.dumps({'type': 'chat', 'message': 'hello there'})
+    else:
+        frame = json.dumps({'type': 'signal', 'payload': {'type': 'candidate', 'candidate': 'candidate:1 1 udp 2122260223 10.0.0.2 54321 typ host'}})
+
+    start = time.perf_counter()
+
+    async def produce():
+        for _ in range(messages):
+            await first.send_to(text_data=frame)
+
+    async def consume():
+        for _ in range(messages):
+            await second.receive_from(timeout=10)
+
+    await asyncio.gather(produce(), consume())
+    elapsed = time.perf_counter() - start
+    result = {
+        'msgs_per_s': round(messages / elapsed),
+        'layer_deliveries_per_msg': round(layer_ops.deliveries / messages, 2),
+        'group_sends': layer_ops.calls['group_send'],
+    }
+    await first.disconnect()
+    await second.disconnect()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=20000)
+    opts = parser.parse_args()
+    setup_django()
+
+    from django.conf import settings
+    from channels.layers import get_channel_layer
+    from config.asgi import application
+
+    _, async_client = redis_clients()
+    use_local_backends(async_client)
+    layer_ops = LayerOps(get_channel_layer())
+    # Measures relay throughput, so one client has to be allowed to flood
+    settings.CHAT_RATE_LIMITS = {}
+
+    for kind in ('chat', 'signal'):
+        print(f'{kind} relay ({opts.messages} messages)')
+        for mode in ('group', 'direct'):
+            settings.CHAT_ROUTING = mode
+            stats = asyncio.run(_run(application, layer_ops, opts.messages, kind))
+            print(f'  {mode:<8} ' + '  '.join(f'{k}={v}' for k, v in stats.items()))
+
+
+if __name__ == '__main__':
+    main()
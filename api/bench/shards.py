@@ -0,0 +1,129 @@
+"""
+Matchmaking over 1..N Redis shards.
+
+A pool of users joins the queue from concurrent tasks; every match ends its
+session at once and both users go back to the pool. For each shard count this
+reports joins/sec, Redis round trips per join, the busiest shard's share of
+round trips and how many matches paired users whose home shards differ.
+
+With fakeredis every shard runs in this process, so joins/sec shows the
+client-side cost of sharding only. The busiest shard's share is what bounds
+capacity on real nodes: `capacity_x` is the single-node round trips per join
+divided by the busiest shard's, i.e. how many times the joins one Redis could
+serve the sharded setup can. Start real nodes with docker-compose.shards.yml and
+pass them with --redis-urls.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from bench._common import print_table, setup_django
+
+
+def shard_clients(urls: list, count: int) -> list:
+    if urls:
+        import redis.asyncio as aioredis
+        return [aioredis.from_url(url) for url in urls[:count]]
+    import fakeredis
+    return [fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer()) for _ in range(count)]
+
+
+class RoundTrips:
+    """Counts commands sent through each shard client (a script call or a whole pipeline is one)."""
+
+    def __init__(self, clients: list):
+        self.counts = [0] * len(clients)
+        for index, client in enumerate(clients):
+            self._wrap(index, client, 'execute_command')
+            self._wrap(index, client, 'pipeline', sync=True)
+
+    def _wrap(self, index: int, client, name: str, sync: bool = False):
+        fn = getattr(client, name)
+        if sync:
+            def counted(*args, **kwargs):
+                self.counts[index] += 1
+                return fn(*args, **kwargs)
+        else:
+            async def counted(*args, **kwargs):
+                self.counts[index] += 1
+                return await fn(*args, **kwargs)
+        setattr(client, name, counted)
+
+
+async def run(clients: list, users: int, joins: int, concurrency: int, seed: int) -> dict:
+    from chat.services import queue as q
+
+    for client in clients:
+        await client.flushdb()
+    matchmaking = q.AsyncMatchmakingQueue(clients=clients)
+    await matchmaking.heartbeat()
+    trips = RoundTrips(clients)
+    rng = random.Random(seed)
+    idle = [f'u{i}' for i in range(users)]
+    rng.shuffle(idle)
+    waiting = {}  # channel -> user
+    stats = {'joins': 0, 'matches': 0, 'cross': 0}
+
+    async def joiner():
+        while stats['joins'] < joins and idle:
+            user = idle.pop()
+            channel = f'bench.shards!{user}'
+            stats['joins'] += 1
+            result = await matchmaking.join(channel, user, {})
+            if 'session_id' not in result:
+                waiting[channel] = user
+                continue
+            stats['matches'] += 1
+            users_ = [result['user1'], result['user2']]
+            homes = {matchmaking._home(u['user_id']) for u in users_}
+            stats['cross'] += len(homes) > 1
+            await matchmaking.end_session(result['session_id'])
+            for u in users_:
+                waiting.pop(u['channel_name'], None)
+                idle.insert(rng.randrange(len(idle) + 1), str(u['user_id']))
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(joiner() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    total = sum(trips.counts)
+    return {
+        'joins/s': round(stats['joins'] / elapsed),
+        'trips/join': round(total / stats['joins'], 2),
+        'busiest_trips/join': round(max(trips.counts) / stats['joins'], 2),
+        'busiest_share': round(max(trips.counts) / total, 3),
+        'matched': stats['matches'],
+        'cross_shard': round(stats['cross'] / max(stats['matches'], 1), 3),
+        'waiting': len(waiting),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--max-shards', type=int, default=4)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--joins', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument(
+        '--redis-urls', default=os.environ.get('BENCH_REDIS_URLS'),
+        help='Comma-separated real Redis nodes, one per shard (default: in-process fakeredis)',
+    )
+    opts = parser.parse_args()
+    setup_django()
+
+    urls = [u.strip() for u in opts.redis_urls.split(',') if u.strip()] if opts.redis_urls else []
+    max_shards = min(opts.max_shards, len(urls)) if urls else opts.max_shards
+    rows = {}
+    for count in range(1, max_shards + 1):
+        clients = shard_clients(urls, count)
+        rows[f'{count} shard(s)'] = asyncio.run(run(clients, opts.users, opts.joins, opts.concurrency, seed=count))
+    single = rows['1 shard(s)']['busiest_trips/join']
+    for row in rows.values():
+        row['capacity_x'] = round(single / row['busiest_trips/join'], 2)
+    print_table(f'matchmaking joins ({opts.users} users, {opts.concurrency} concurrent)', rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Replays recorded WebRTC signaling traces (JSON lines of {"t_ms", "payload"},
+see bench/traces/) through two paired ChatConsumer clients and compares
+SIGNAL_BATCH_MS settings: channel-layer sends and WebSocket frames per match,
+and the delay batching adds to each signal.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from bench._common import LayerOps, percentiles, redis_clients, setup_django, use_local_backends
+from bench.routing import _pair
+
+TRACE_DIR = os.path.join(os.path.dirname(__file__), 'traces')
+
+
+def load_trace(path: str) -> list:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def _replay(application, layer_ops, trace: list) -> dict:
+    first, second = await _pair(application)
+    layer_ops.reset()
+    sent_at = []
+    received = []
+    frames = 0
+
+    async def produce():
+        start = time.perf_counter()
+        for item in trace:
+            delay = start + item['t_ms'] / 1000 - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent_at.append(time.perf_counter())
+            await first.send_to(text_data=json.dumps({'type': 'signal', 'payload': item['payload']}))
+
+    async def consume():
+        nonlocal frames
+        while len(received) < len(trace):
+            frame = json.loads(await second.receive_from(timeout=5))
+            frames += 1
+            now = time.perf_counter()
+            count = len(frame['payloads']) if frame['type'] == 'signals' else 1
+            received.extend([now] * count)
+
+    await asyncio.gather(produce(), consume())
+    await first.disconnect()
+    await second.disconnect()
+    return {
+        'layer_sends': layer_ops.calls['send'],
+        'frames': frames,
+        'delays': [r - s for s, r in zip(sent_at, received)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trace', default=os.path.join(TRACE_DIR, 'trickle_ice.jsonl'))
+    parser.add_argument('--batch-ms', default='0,10,25,50', help='Comma-separated SIGNAL_BATCH_MS values')
+    parser.add_argument('--replays', type=int, default=5)
+    opts = parser.parse_args()
+    setup_django()
+
+    from django.conf import settings
+    from channels.layers import get_channel_layer
+    from config.asgi import application
+
+    _, async_client = redis_clients()
+    use_local_backends(async_client)
+    layer_ops = LayerOps(get_channel_layer())
+    trace = load_trace(opts.trace)
+
+    print(f'{os.path.basename(opts.trace)}: {len(trace)} signals over {trace[-1]["t_ms"]:.0f} ms, {opts.replays} replays')
+    for batch_ms in (int(v) for v in opts.batch_ms.split(',')):
+        settings.SIGNAL_BATCH_MS = batch_ms
+        runs = [asyncio.run(_replay(application, layer_ops, trace)) for _ in range(opts.replays)]
+        delays = percentiles([d for run in runs for d in run['delays']])
+        print(
+            f'  batch_ms={batch_ms:<3} layer_sends/match={sum(r["layer_sends"] for r in runs) / len(runs):.1f}'
+            f'  frames/match={sum(r["frames"] for r in runs) / len(runs):.1f}'
+            f'  added_delay_ms p50={delays["p50"]} p99={delays["p99"]}'
+        )
+
+
+if __name__ == '__main__':
+    main()
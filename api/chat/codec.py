@@ -0,0 +1,113 @@
+"""
+Wire codecs for WebSocket frames and Redis-stored queue/session records.
+
+JSON goes through orjson when it is installed (stdlib json otherwise) and is
+always compact. Clients that negotiate the MSGPACK_SUBPROTOCOL WebSocket
+subprotocol exchange MessagePack binary frames instead. Large client fields of
+channel-layer events can be zlib-compressed between workers (compress_event).
+"""
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # installed with channels-redis
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = 'blinkchat.msgpack'
+
+# Raised by loads()/unpackb() for malformed input (orjson's error subclasses ValueError).
+DecodeError = (ValueError, TypeError)
+
+
+if orjson is not None:
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(obj) -> str:
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(data):
+        return json.loads(data)
+
+
+# Channel-layer event fields that may carry large client data (SDP, chat text)
+COMPRESSIBLE_FIELDS = ('payload', 'payloads', 'message')
+
+
+def compress_event(event: dict, threshold: int) -> tuple[dict, int]:
+    """
+    zlib-compress large client fields of a channel-layer event. A field is
+    replaced by '<field>_z' bytes when its encoded size is at least threshold
+    and compression actually shrinks it. Returns (event, bytes saved).
+    """
+    if threshold <= 0:
+        return event, 0
+    saved = 0
+    for field in COMPRESSIBLE_FIELDS:
+        if field not in event:
+            continue
+        raw = dumps(event[field]).encode()
+        if len(raw) < threshold:
+            continue
+        packed = zlib.compress(raw)
+        if len(packed) >= len(raw):
+            continue
+        event = {k: v for k, v in event.items() if k != field}
+        event[field + '_z'] = packed
+        saved += len(raw) - len(packed)
+    return event, saved
+
+
+def expand_event(event: dict) -> dict:
+    """Undo compress_event(); events without compressed fields are returned as-is."""
+    for field in COMPRESSIBLE_FIELDS:
+        packed = event.get(field + '_z')
+        if packed is not None:
+            event = {k: v for k, v in event.items() if k != field + '_z'}
+            event[field] = loads(zlib.decompress(packed))
+    return event
+
+
+def supports_msgpack() -> bool:
+    return msgpack is not None
+
+
+def packb(obj) -> bytes:
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpackb(data: bytes):
+    """Decode a client frame; only values JSON can carry are accepted, since frames are relayed as JSON."""
+    try:
+        obj = msgpack.unpackb(data, raw=False)
+    except (msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as e:
+        raise ValueError(str(e)) from e
+    _check_json(obj)
+    return obj
+
+
+_JSON_SCALARS = (str, int, float, bool, type(None))
+
+
+def _check_json(obj) -> None:
+    """Raise ValueError for bin, ext and non-str map keys anywhere in obj."""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            if not all(isinstance(key, str) for key in value):
+                raise ValueError('map keys must be strings')
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif not isinstance(value, _JSON_SCALARS):
+            raise ValueError(f'{type(value).__name__} values are not supported')
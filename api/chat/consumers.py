@@ -1,43 +1,65 @@
 """
 WebSocket consumer: matchmaking, text chat, and WebRTC signaling.
 """
-import json
+import asyncio
 import logging
+import re
+import time
+import uuid
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 
-from chat.services.queue import matchmaking_queue
-from chat.services.mongo import log_match
-from chat.models import UserProfile
+from chat import codec
+from chat.middleware import (
+    OVERLOADED_CLOSE_CODE, AdmissionMiddleware, overloaded_frame, queue_full, read_resume_token, resume_token,
+)
+from chat.outbox import Outbox
+from chat.services.bans import ban_list
+from chat.services.queue import MAX_INTERESTS, async_matchmaking_queue
+from chat.services.metrics import metrics
+from chat.services.mongo import log_match, log_match_end
+from chat.services.ratelimit import connection_limiter, shared_limiter
+from chat.services.tracing import NULL_TRACE, start_trace
+from chat.services.worker import worker_runtime
 
 logger = logging.getLogger(__name__)
 
+_ATTRIBUTE_CHARS = re.compile(r'[^a-z0-9_-]')
+# Client message types counted by name in messages_received; anything else is 'other'
+_MESSAGE_TYPES = frozenset(('chat', 'signal', 'next'))
 
-@database_sync_to_async
-def get_user_profile(user):
-    if not user or user.is_anonymous:
-        return None
-    try:
-        p = UserProfile.objects.get(user=user)
-        return {'user_id': user.id, 'username': user.username, 'display_name': p.display_name or user.username}
-    except UserProfile.DoesNotExist:
-        return {'user_id': user.id, 'username': user.username, 'display_name': user.username}
-    except Exception:
-        return {'user_id': user.id, 'username': str(user), 'display_name': str(user)}
 
+def match_attributes(query_string: bytes) -> dict:
+    """Matchmaking preferences from the WebSocket URL (?lang=en&region=eu&interests=music,games)."""
+    query = parse_qs(query_string.decode())
+
+    def clean(value):
+        return _ATTRIBUTE_CHARS.sub('', value.strip().lower())[:32]
+
+    interests = []
+    for raw in ','.join(query.get('interests', [])).split(','):
+        tag = clean(raw)
+        if tag and tag not in interests:
+            interests.append(tag)
+    attributes = {
+        'lang': clean(query.get('lang', [''])[0]),
+        'region': clean(query.get('region', [''])[0]),
+        'interests': interests[:MAX_INTERESTS],
+    }
+    return {k: v for k, v in attributes.items() if v}
+
+
+def _resume_grace() -> float:
+    return getattr(settings, 'CHAT_RESUME_GRACE', 0)
 
-@database_sync_to_async
-def is_user_banned(user):
-    if not user or user.is_anonymous:
-        return False
-    try:
-        return UserProfile.objects.get(user=user).is_banned
-    except UserProfile.DoesNotExist:
-        return False
-    except Exception:
-        return True
+
+def _is_ice_candidate(payload) -> bool:
+    """Trickle-ICE candidate as sent by the frontend ({candidate: ...} or {type: 'candidate', ...})."""
+    return isinstance(payload, dict) and 'sdp' not in payload and (
+        'candidate' in payload or payload.get('type') == 'candidate'
+    )
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -45,140 +67,607 @@ class ChatConsumer(AsyncWebsocketConsumer):
         super().__init__(*args, **kwargs)
         self.session_id = None
         self.partner_channel = None
+        self.partner_worker = None
+        self.room_group_name = None
         self.user_id = None
+        self.profile = None
+        self.attributes = {}
+        self.waiting = False
+        self._signal_batch = []
+        self._signal_flush = None
+        self.binary = False
+        self.limiter = None
+        self.shared_limiter = None
+        self.closing = False
+        self._partner_grace = None
+        self.queued_at = None
+        self.trace = NULL_TRACE  # of the connect/receive/disconnect being handled
+        self.outbox = Outbox(
+            lambda message: self.base_send(message),
+            getattr(settings, 'CHAT_OUTBOX_HIGH_WATER', 262144),
+            getattr(settings, 'CHAT_OUTBOX_MAX_BYTES', 1048576),
+            getattr(settings, 'CHAT_SLOW_CONSUMER_TIMEOUT', 10),
+        )
 
     async def connect(self):
+        # Started by JWTWebSocketAuthMiddleware; 'routing' covers the hop from there to here
+        self.trace = self.scope.get('trace') or start_trace('connect')
+        self.trace.mark('routing')
+        try:
+            await self._connect()
+        finally:
+            self.trace.finish()
+            self.trace = NULL_TRACE
+
+    async def _connect(self):
         self.room_group_name = None
         user = self.scope.get('user') or AnonymousUser()
-        if await is_user_banned(user):
+        # Resolved once (and cached) by JWTWebSocketAuthMiddleware
+        identity = self.scope.get('identity')
+        if user.is_authenticated and ban_list.is_banned(user.id, identity):
+            self.trace.tag(outcome='banned')
             await self.close(code=4003)
             return
-        self.user_id = getattr(user, 'id', None) or f'anonymous_{id(self)}'
-        await self.accept()
+        # Anonymous ids must be unique across worker processes (presence index, recent partners)
+        self.user_id = getattr(user, 'id', None) or f'anonymous_{uuid.uuid4().hex}'
+        self.limiter = connection_limiter()
+        if user.is_authenticated:
+            ban_list.track(self.user_id, self)
+            # Anonymous ids are per socket, so only real users need the cross-socket limit
+            self.shared_limiter = shared_limiter(async_matchmaking_queue.client_for(self.user_id), self.user_id)
+        worker_runtime.ensure_started()
+        # Clients offering the MessagePack subprotocol get binary frames both ways
+        self.binary = codec.MSGPACK_SUBPROTOCOL in self.scope.get('subprotocols', []) and codec.supports_msgpack()
+        self.outbox.follow_transport(self.base_send)
+        self.trace.mark('setup')
+        await self.accept(subprotocol=codec.MSGPACK_SUBPROTOCOL if self.binary else None)
+        self.trace.mark('accept')
 
         # Optional: send auth info
-        profile = await get_user_profile(user)
-        await self.send(text_data=json.dumps({
+        self.profile = identity['profile'] if identity else None
+        await self._send_frame({
             'type': 'connected',
-            'user': profile,
-        }))
+            'user': self.profile,
+        })
+        self.trace.mark('connected_frame')
+        query_string = self.scope.get('query_string', b'')
+        self.attributes = match_attributes(query_string)
+        token = parse_qs(query_string.decode()).get('resume', [''])[0]
+        if token and await self._resume(token):
+            self.trace.tag(outcome='resumed')
+            return
+        await self._enter_queue()
+        self.trace.tag(outcome='matched' if self.session_id else 'waiting' if self.waiting else 'rejected')
 
-        # Join matchmaking queue (sync Redis calls in thread)
-        session_id = await sync_to_async(matchmaking_queue.join)(
-            self.channel_name,
-            self.user_id,
-            meta=profile or {}
-        )
-        if session_id:
-            session = await sync_to_async(matchmaking_queue.get_session)(session_id)
-            if session:
-                user1 = session['user1']
-                user2 = session['user2']
-                self.session_id = session_id
-                self.partner_channel = user2['channel_name'] if user1['channel_name'] == self.channel_name else user1['channel_name']
-                self.room_group_name = f'session_{session_id}'
-                await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-                # Notify the other user (who was waiting) via direct channel send
-                other_channel = user2['channel_name'] if user1['channel_name'] == self.channel_name else user1['channel_name']
-                await self.channel_layer.send(other_channel, {
-                    'type': 'matched_from_queue',
-                    'session_id': session_id,
-                    'room_group_name': self.room_group_name,
-                    'partner': user2 if user1['channel_name'] == self.channel_name else user1,
-                    'is_initiator': True,
-                })
-                await self.channel_layer.group_send(self.room_group_name, {
-                    'type': 'session_matched',
-                    'session_id': session_id,
-                    'user1': user1,
-                    'user2': user2,
-                })
-                await sync_to_async(log_match)(session_id, [str(user1.get('user_id')), str(user2.get('user_id'))], str(session.get('started_at', '')), None)
+    async def disconnect(self, close_code):
+        self.trace = start_trace('disconnect')
+        self.trace.tag(code=close_code)
+        try:
+            await self._disconnect(close_code)
+        finally:
+            self.trace.finish()
+            self.trace = NULL_TRACE
+
+    async def _disconnect(self, close_code):
+        self._drop_signals()
+        self._cancel_partner_grace()
+        self.outbox.discard()
+        if self.user_id is not None:
+            ban_list.untrack(self.user_id, self)
+        # 1006: the connection dropped without a close frame. Deliberate closes
+        # (1000, 1001 on navigation, None from a bare ws.close()) end the session.
+        if self.session_id and _resume_grace() > 0 and close_code == 1006 and not self.closing:
+            # Hold our place so a reconnect can resume the session
+            suspended = await self._suspend_session()
+            self.trace.mark('suspend')
+            if suspended:
                 return
-        await self.send(text_data=json.dumps({'type': 'waiting', 'message': 'Looking for someone...'}))
+        await self._leave()
 
-    async def disconnect(self, close_code):
-        if self.room_group_name:
-            await self.channel_layer.group_send(self.room_group_name, {
+    async def _leave(self):
+        """End our session (telling the partner) or drop our queue entry."""
+        if self.session_id:
+            await self._relay({
                 'type': 'partner_left',
                 'channel': self.channel_name,
+                'session_id': self.session_id,
             })
-            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-            if self.session_id:
-                await sync_to_async(matchmaking_queue.delete_session)(self.session_id)
-        else:
-            await sync_to_async(matchmaking_queue.leave_queue)(self.channel_name)
+            self.trace.mark('notify_partner')
+            await self._end_session()
+            self.trace.mark('end_session')
+        elif self.waiting:
+            self._stop_waiting()
+            await async_matchmaking_queue.leave_queue(self.channel_name)
+            self.trace.mark('leave_queue')
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.closing:
+            return
+        self.trace = start_trace('receive')
+        try:
+            await self._receive(text_data, bytes_data)
+        finally:
+            self.trace.finish()
+            self.trace = NULL_TRACE
+
+    async def _receive(self, text_data, bytes_data):
+        size = len(bytes_data) if bytes_data is not None else len((text_data or '').encode())
+        limit = getattr(settings, 'CHAT_MAX_FRAME_BYTES', 0)
+        if limit and size > limit:
+            # Don't let one client push arbitrarily large payloads through Redis
+            metrics.incr('frames_rejected')
+            metrics.incr('frames_rejected_bytes', size)
+            await self._send_frame({'type': 'error', 'code': 'message_too_large', 'limit': limit})
+            return
         try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
+            if bytes_data is not None and self.binary:
+                data = codec.unpackb(bytes_data)
+            else:
+                data = codec.loads(text_data or '')
+        except codec.DecodeError:
+            return
+        if not isinstance(data, dict):
             return
         msg_type = data.get('type')
+        label = msg_type if msg_type in _MESSAGE_TYPES else 'other'
+        metrics.incr('messages_received', type=label)
+        self.trace.tag(type=label)
+        self.trace.mark('decode')
+        if not await self._allow(msg_type):
+            return
+        self.trace.mark('rate_limit')
         if msg_type == 'chat':
-            if self.room_group_name:
-                await self.channel_layer.group_send(self.room_group_name, {
-                    'type': 'chat_message',
-                    'channel': self.channel_name,
-                    'message': data.get('message', ''),
-                    'sender_id': self.user_id,
-                })
+            await self._relay({
+                'type': 'chat_message',
+                'channel': self.channel_name,
+                'session_id': self.session_id,
+                'message': data.get('message', ''),
+                'sender_id': self.user_id,
+            })
+            self.trace.mark('relay')
         elif msg_type == 'signal':
-            if self.room_group_name:
-                await self.channel_layer.group_send(self.room_group_name, {
-                    'type': 'webrtc_signal',
-                    'channel': self.channel_name,
-                    'payload': data.get('payload'),
-                })
+            await self._relay_signal(data.get('payload'))
+            self.trace.mark('relay')
         elif msg_type == 'next':
-            if self.room_group_name:
-                await self.channel_layer.group_send(self.room_group_name, {
+            # End the session for both peers and re-queue on the existing sockets
+            if self.session_id:
+                await self._relay({
                     'type': 'user_next',
                     'channel': self.channel_name,
+                    'session_id': self.session_id,
                 })
+                await self._end_session()
+                self.trace.mark('end_session')
+            if not self.waiting:
+                await self._enter_queue()
+
+    async def _allow(self, msg_type) -> bool:
+        """Apply the per-connection (and per-user) rate limits to an incoming message."""
+        if self.limiter.allow(msg_type) and (
+            self.shared_limiter is None or await self.shared_limiter.allow(msg_type)
+        ):
+            return True
+        metrics.incr('messages_rate_limited')
+        if self.limiter.violation():
+            await self._send_frame({'type': 'warning', 'code': 'rate_limited', 'message_type': msg_type})
+        else:
+            metrics.incr('rate_limit_disconnects')
+            self.closing = True
+            await self.close(code=4008)
+        return False
+
+    async def _enter_queue(self, rejoining: bool = False):
+        """Join matchmaking; a match returns the new session in the same round trip."""
+        if not rejoining and queue_full():
+            # Failed resumes and re-queues after a session get past AdmissionMiddleware
+            await self._overloaded('queue_full')
+            return
+        if not rejoining:
+            self.queued_at = time.monotonic()
+        result = await async_matchmaking_queue.join(
+            self.channel_name,
+            self.user_id,
+            meta={**(self.profile or {}), **self.attributes}
+        )
+        self.trace.mark('join')
+        if result.get('replaced'):
+            # Our older tab/connection was queued; it has been dropped in favour of this one
+            await self.channel_layer.send(result['replaced'], {'type': 'queue_replaced'})
+            self.trace.mark('notify_replaced')
+        if 'session_id' in result:
+            await self._start_session(result)
+            return
+        if result['status'] == 'duplicate':
+            await self._send_frame({'type': 'duplicate', 'message': 'Already searching in another tab'})
+            await self.close(code=4010)
+            return
+        self.waiting = True
+        worker_runtime.track_waiting(self.channel_name, self)
+        await self._send_frame({
+            'type': 'waiting',
+            'message': 'Looking for someone...',
+            'position': result['position'],
+            'eta': async_matchmaking_queue.estimate_wait(self.user_id, result['position']),
+        })
+        self.trace.mark('waiting_frame')
+
+    def _stop_waiting(self):
+        self.waiting = False
+        worker_runtime.untrack_waiting(self.channel_name)
+
+    async def requeue(self):
+        """Our queue entry may have been evicted while this worker looked dead: queue again."""
+        if not self.waiting or self.closing:
+            return
+        await async_matchmaking_queue.leave_queue(self.channel_name, rejoining=True)
+        if not self.waiting or self.closing:
+            # Matched (matched_from_queue) or closing while we left: don't queue again
+            return
+        self._stop_waiting()
+        await self._enter_queue(rejoining=True)
+
+    async def _overloaded(self, reason: str):
+        """Turn the client away as AdmissionMiddleware does (4029 with a retry_after)."""
+        metrics.incr('connections_rejected')
+        metrics.incr(f'connections_rejected_{reason}')
+        retry_after = AdmissionMiddleware.retry_after()
+        self.closing = True
+        await self._send_frame(overloaded_frame(reason, retry_after))
+        await self.close(code=OVERLOADED_CLOSE_CODE, reason=f'retry-after={retry_after}')
+
+    async def _start_session(self, session):
+        """We completed a match: bind to the session and notify the waiting partner."""
+        user1 = session['user1']
+        user2 = session['user2']
+        if user1['channel_name'] == self.channel_name:
+            me, partner = user1, user2
+        else:
+            me, partner = user2, user1
+        self.session_id = session['session_id']
+        self.partner_channel = partner['channel_name']
+        self.partner_worker = partner.get('worker')
+        worker_runtime.track_session(self.session_id, self)
+        metrics.incr('sessions_matched')
+        self._observe_match()
+        if getattr(settings, 'CHAT_ROUTING', 'direct') == 'group':
+            self.room_group_name = f'session_{self.session_id}'
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+            self.trace.mark('group_add')
+        # Notify the other user (who was waiting) via direct channel send
+        await self.channel_layer.send(self.partner_channel, {
+            'type': 'matched_from_queue',
+            'session_id': self.session_id,
+            'room_group_name': self.room_group_name,
+            'partner': me,
+            'is_initiator': True,
+        })
+        self.trace.mark('notify_partner')
+        if self.room_group_name:
+            await self.channel_layer.group_send(self.room_group_name, {
+                'type': 'session_matched',
+                'session_id': self.session_id,
+                'user1': user1,
+                'user2': user2,
+            })
+        else:
+            await self._send_frame({
+                'type': 'matched',
+                'session_id': self.session_id,
+                'partner': partner,
+                'is_initiator': False,
+                'resume_token': resume_token(self.session_id, self.channel_name),
+            })
+        self.trace.mark('matched_frame')
+        log_match(self.session_id, [str(user1.get('user_id')), str(user2.get('user_id'))], str(session.get('started_at', '')), None)
+        self.trace.mark('log_match')
+
+    async def _resume(self, token: str) -> bool:
+        """Rebind this new connection into the session a dropped one held; False to matchmake instead."""
+        user = self.scope.get('user') or AnonymousUser()
+        resume = read_resume_token(token)
+        if resume is None:
+            session = None
+        else:
+            session_id, old_channel = resume
+            session = await async_matchmaking_queue.resume_session(
+                session_id, old_channel, self.channel_name, self.user_id if user.is_authenticated else None,
+            )
+            self.trace.mark('resume')
+        if not session:
+            await self._send_frame({'type': 'resume_failed'})
+            return False
+        metrics.incr('sessions_resumed')
+        is_initiator = session['user1']['channel_name'] == self.channel_name
+        me, partner = (session['user1'], session['user2']) if is_initiator else (session['user2'], session['user1'])
+        if not user.is_authenticated:
+            # A per-socket anonymous id: take over the one the session knows us by. A signed-in
+            # user keeps their own, which RESUME_SCRIPT has checked against the session's
+            self.user_id = me['user_id']
+        self.session_id = session_id
+        self.partner_channel = partner['channel_name']
+        self.partner_worker = partner.get('worker')
+        worker_runtime.track_session(self.session_id, self)
+        if getattr(settings, 'CHAT_ROUTING', 'direct') == 'group':
+            self.room_group_name = f'session_{self.session_id}'
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self._relay({
+            'type': 'partner_resumed',
+            'channel': self.channel_name,
+            'session_id': self.session_id,
+            'partner': me,
+        })
+        await self._send_frame({
+            'type': 'resumed',
+            'session_id': self.session_id,
+            'partner': partner,
+            'is_initiator': is_initiator,
+            'resume_token': resume_token(self.session_id, self.channel_name),
+        })
+        return True
+
+    async def _suspend_session(self) -> bool:
+        """
+        Keep the session for CHAT_RESUME_GRACE seconds; the partner ends it if we
+        don't return. False when the partner is suspended too: the caller leaves.
+        """
+        grace = _resume_grace()
+        if not await async_matchmaking_queue.suspend_session(
+            self.session_id, self.channel_name, self.partner_channel, grace,
+        ):
+            return False
+        metrics.incr('sessions_suspended')
+        await self._relay({
+            'type': 'partner_suspended',
+            'channel': self.channel_name,
+            'session_id': self.session_id,
+            'grace': grace,
+        })
+        worker_runtime.untrack_session(self.session_id, self)
+        if self.room_group_name:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        return True
+
+    async def _await_partner(self, session_id: str, old_channel: str, grace: float):
+        await asyncio.sleep(grace)
+        self._partner_grace = None
+        if self.session_id == session_id and await async_matchmaking_queue.expire_resume(session_id, old_channel):
+            metrics.incr('sessions_resume_expired')
+            await self.partner_left({'channel': None, 'session_id': session_id})
+
+    def _cancel_partner_grace(self):
+        if self._partner_grace is not None:
+            self._partner_grace.cancel()
+        self._partner_grace = None
+
+    async def _end_session(self):
+        """
+        Drop our binding to the current session. Whichever peer gets there first
+        deletes the Redis session and logs the match end; the other is a no-op.
+        """
+        session_id = self.session_id
+        worker_runtime.untrack_session(session_id, self)
+        self._drop_signals()
+        self._cancel_partner_grace()
+        if self.room_group_name:
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        self.session_id = self.partner_channel = self.partner_worker = self.room_group_name = None
+        session = await async_matchmaking_queue.end_session(session_id)
+        if session:
+            log_match_end(session_id, session.get('started_at'))
+
+    async def partner_lost(self):
+        """The partner's worker stopped heartbeating: end the session as if they left."""
+        await self.partner_left({'channel': None, 'session_id': self.session_id})
+
+    async def banned(self):
+        """We were banned while connected: leave now, rather than when the socket finishes closing."""
+        if self.closing:
+            return
+        self.closing = True
+        await self._leave()
+        await self.close(code=4003)
+
+    def _observe_match(self):
+        if self.queued_at is not None:
+            metrics.observe('time_to_match_seconds', time.monotonic() - self.queued_at)
+            self.queued_at = None
+
+    async def _relay(self, event):
+        """
+        Deliver an event to the partner. Paired sessions send straight to the
+        partner's channel; sessions with a group (CHAT_ROUTING='group', future
+        multi-party rooms) fan out to it and handlers drop their own echo.
+        Fields above CHANNEL_COMPRESS_THRESHOLD bytes travel zlib-compressed.
+        """
+        is_local = getattr(self.channel_layer, 'is_local', None)
+        # Same-process deliveries (HybridChannelLayer) never reach Redis: not worth compressing
+        if self.room_group_name or not (is_local and is_local(self.partner_channel)):
+            event, saved = codec.compress_event(event, getattr(settings, 'CHANNEL_COMPRESS_THRESHOLD', 0))
+            if saved:
+                metrics.incr('channel_compressed')
+                metrics.incr('channel_bytes_saved', saved)
+        start = time.perf_counter()
+        if self.room_group_name:
+            await self.channel_layer.group_send(self.room_group_name, event)
+        elif self.partner_channel:
+            await self.channel_layer.send(self.partner_channel, event)
+        metrics.observe('channel_send_seconds', time.perf_counter() - start)
+
+    async def _relay_signal(self, payload):
+        """
+        Forward a WebRTC signal. With SIGNAL_BATCH_MS set, trickle-ICE candidates
+        are held for that long and sent as one 'signals' frame; anything else
+        (SDP offers/answers) flushes the pending candidates and goes out at once.
+        """
+        batch_ms = getattr(settings, 'SIGNAL_BATCH_MS', 0)
+        if batch_ms > 0 and _is_ice_candidate(payload):
+            self._signal_batch.append(payload)
+            if self._signal_flush is None:
+                self._signal_flush = asyncio.get_running_loop().create_task(self._flush_signals_later(batch_ms / 1000))
+            return
+        await self._flush_signals()
+        await self._relay({
+            'type': 'webrtc_signal',
+            'channel': self.channel_name,
+            'session_id': self.session_id,
+            'payload': payload,
+        })
+
+    async def _flush_signals_later(self, delay: float):
+        await asyncio.sleep(delay)
+        await self._flush_signals()
+
+    async def _flush_signals(self):
+        task, self._signal_flush = self._signal_flush, None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        batch, self._signal_batch = self._signal_batch, []
+        if len(batch) == 1:
+            await self._relay({
+                'type': 'webrtc_signal',
+                'channel': self.channel_name,
+                'session_id': self.session_id,
+                'payload': batch[0],
+            })
+        elif batch:
+            await self._relay({
+                'type': 'webrtc_signals',
+                'channel': self.channel_name,
+                'session_id': self.session_id,
+                'payloads': batch,
+            })
+
+    def _drop_signals(self):
+        """Pending candidates belong to a session that is over."""
+        if self._signal_flush is not None:
+            self._signal_flush.cancel()
+        self._signal_flush = None
+        self._signal_batch = []
+
+    async def dispatch(self, message):
+        # Peers compress large fields in _relay(); handlers always see plain events
+        await super().dispatch(codec.expand_event(message))
+
+    async def _send_frame(self, frame: dict, droppable: bool = False):
+        """
+        Queue a frame for the client. Droppable frames are shed first when the
+        client falls behind; a client that stays stalled is disconnected (4009).
+        """
+        if self.binary:
+            data = codec.packb(frame)
+            message = {'type': 'websocket.send', 'bytes': data}
+        else:
+            data = codec.dumps(frame)
+            message = {'type': 'websocket.send', 'text': data}
+        if not self.outbox.put(message, len(data), droppable) and not self.closing:
+            metrics.incr('slow_consumer_disconnects')
+            self.closing = True
+            await self.outbox.abort({'type': 'websocket.close', 'code': 4009})
+
+    async def close(self, code=None, reason=None):
+        # Through the outbox, so frames queued before the close still go out first
+        message = {'type': 'websocket.close'}
+        if code is not None and code is not True:
+            message['code'] = code
+        if reason:
+            message['reason'] = reason
+        if not self.outbox.put(message, 0):
+            await self.outbox.abort(message)
+
+    def _ignore(self, event) -> bool:
+        """Our own group echo, or a late event from a session we already left."""
+        return event['channel'] == self.channel_name or event.get('session_id') != self.session_id
 
     async def matched_from_queue(self, event):
         """Called when we were in queue and someone matched with us (we are initiator for WebRTC)."""
+        self._stop_waiting()
         self.session_id = event['session_id']
+        self.partner_channel = event['partner']['channel_name']
+        self.partner_worker = event['partner'].get('worker')
+        worker_runtime.track_session(self.session_id, self)
+        self._observe_match()
         self.room_group_name = event['room_group_name']
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.send(text_data=json.dumps({
+        if self.room_group_name:
+            await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self._send_frame({
             'type': 'matched',
             'session_id': event['session_id'],
             'partner': event['partner'],
             'is_initiator': event.get('is_initiator', True),
-        }))
+            'resume_token': resume_token(event['session_id'], self.channel_name),
+        })
 
     async def session_matched(self, event):
         is_initiator = event['user1']['channel_name'] == self.channel_name
-        await self.send(text_data=json.dumps({
+        await self._send_frame({
             'type': 'matched',
             'session_id': event['session_id'],
             'partner': event['user2'] if is_initiator else event['user1'],
             'is_initiator': is_initiator,
-        }))
+            'resume_token': resume_token(event['session_id'], self.channel_name),
+        })
 
     async def chat_message(self, event):
-        if event['channel'] == self.channel_name:
+        if self._ignore(event):
             return
-        await self.send(text_data=json.dumps({
+        await self._send_frame({
             'type': 'chat',
             'message': event['message'],
             'sender_id': event['sender_id'],
-        }))
+        }, droppable=True)
 
     async def webrtc_signal(self, event):
-        if event['channel'] == self.channel_name:
+        if self._ignore(event):
             return
-        await self.send(text_data=json.dumps({
+        await self._send_frame({
             'type': 'signal',
             'payload': event['payload'],
-        }))
+        }, droppable=_is_ice_candidate(event['payload']))
+
+    async def webrtc_signals(self, event):
+        """A batch of trickle-ICE candidates, delivered as one frame."""
+        if self._ignore(event):
+            return
+        await self._send_frame({
+            'type': 'signals',
+            'payloads': event['payloads'],
+        }, droppable=True)
 
     async def user_next(self, event):
-        if event['channel'] == self.channel_name:
+        """Partner pressed next: the session is over, go back into matchmaking on this socket."""
+        if self._ignore(event):
             return
-        await self.send(text_data=json.dumps({'type': 'partner_next'}))
+        await self._send_frame({'type': 'partner_next'})
+        await self._end_session()
+        await self._enter_queue()
+
+    async def queue_replaced(self, event):
+        """The same user queued from another connection, which took our place."""
+        self._stop_waiting()
+        await self._send_frame({'type': 'duplicate', 'message': 'Searching in another tab'})
+        await self.close(code=4010)
+
+    async def partner_suspended(self, event):
+        """The partner's socket dropped; they have the grace period to resume."""
+        if self._ignore(event):
+            return
+        self._cancel_partner_grace()
+        self._partner_grace = asyncio.get_running_loop().create_task(
+            self._await_partner(self.session_id, event['channel'], event['grace'])
+        )
+        await self._send_frame({'type': 'partner_reconnecting', 'grace': event['grace']})
+
+    async def partner_resumed(self, event):
+        """The partner is back on a new connection: route to it from now on."""
+        if self._ignore(event):
+            return
+        self._cancel_partner_grace()
+        self.partner_channel = event['partner']['channel_name']
+        self.partner_worker = event['partner'].get('worker')
+        await self._send_frame({'type': 'partner_resumed'})
 
     async def partner_left(self, event):
-        await self.send(text_data=json.dumps({'type': 'partner_left'}))
+        if self._ignore(event):
+            return
+        await self._end_session()
+        await self._send_frame({'type': 'partner_left'})
@@ -0,0 +1,97 @@
+"""
+Channel layer that keeps traffic between consumers of the same process in memory.
+
+channels_redis names process-specific channels '<prefix>.<client_prefix>!<id>'
+and hands their messages to per-channel buffers after reading them from Redis.
+A send to one of this process's live channels can go straight into its buffer,
+skipping the Redis write and the read back. Everything else (other processes,
+groups, general channels) goes through Redis as before.
+
+In channels_redis one of the waiting consumers holds the Redis read for the
+whole process, and would not see a buffer filled by anything but that read
+until it times out. Here a single pump task per process channel does the Redis
+reads and every consumer only waits on its own buffer, so a local send wakes
+its receiver at once.
+"""
+import asyncio
+import logging
+
+from channels_redis.core import RedisChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_sends = 0
+        # Channels handed out by this layer whose consumer has not stopped receiving
+        self._local_channels = set()
+        self._pumps = {}  # process channel name ('<prefix>.<client_prefix>!') -> task
+
+    async def new_channel(self, prefix='specific'):
+        channel = await super().new_channel(prefix)
+        self._local_channels.add(channel)
+        return channel
+
+    def is_local(self, channel: str) -> bool:
+        return channel in self._local_channels
+
+    async def send(self, channel, message):
+        if channel in self._local_channels:
+            assert isinstance(message, dict), 'message is not a dict'
+            # Copy, as the Redis round trip would, so sender and receiver never share a dict
+            self.receive_buffer[channel].put_nowait(dict(message))
+            self.local_sends += 1
+            return
+        await super().send(channel, message)
+
+    async def receive(self, channel):
+        if channel not in self._local_channels:
+            return await super().receive(channel)
+        self._ensure_pump(self.non_local_name(channel))
+        try:
+            return await self.receive_buffer[channel].get()
+        except asyncio.CancelledError:
+            # Consumers only cancel their receive when they stop
+            self._local_channels.discard(channel)
+            self.receive_buffer.pop(channel, None)
+            if not self._local_channels:
+                self._stop_pumps()
+            raise
+
+    async def flush(self):
+        self._stop_pumps()
+        await super().flush()
+
+    async def close_pools(self):
+        self._stop_pumps()
+        await super().close_pools()
+
+    def _ensure_pump(self, real_channel: str):
+        pump = self._pumps.get(real_channel)
+        loop = asyncio.get_running_loop()
+        if pump is None or pump.done() or pump.get_loop() is not loop:
+            self._pumps[real_channel] = loop.create_task(self._pump(real_channel))
+
+    def _stop_pumps(self):
+        for pump in self._pumps.values():
+            pump.cancel()
+        self._pumps.clear()
+
+    async def _pump(self, real_channel: str):
+        """Move messages for this process's channels from Redis into their buffers."""
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('Channel layer receive failed: %s', e)
+                await asyncio.sleep(1)
+                continue
+            targets = message_channel if isinstance(message_channel, list) else [message_channel]
+            for channel in targets:
+                # Messages for consumers that have gone would otherwise sit in a buffer forever
+                if channel in self._local_channels:
+                    self.receive_buffer[channel].put_nowait(message)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.services.queue import matchmaking_queue
+
+
+class Command(BaseCommand):
+    help = 'Evict matchmaking queue entries left behind by workers that stopped heartbeating.'
+
+    def handle(self, *args, **options):
+        evicted = matchmaking_queue.reap_stale()
+        self.stdout.write(f'Evicted {evicted} stale queue entries.')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import UserProfile
+from chat.services.bans import BANNED_KEY, sync_bans
+from chat.services.queue import matchmaking_queue
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Redis ban set from UserProfile.is_banned and have every worker reload it.'
+
+    def handle(self, *args, **options):
+        user_ids = UserProfile.objects.filter(is_banned=True).values_list('user_id', flat=True)
+        count = sync_bans(matchmaking_queue.client_for(BANNED_KEY), user_ids)
+        self.stdout.write(f'{count} banned users in the ban set.')
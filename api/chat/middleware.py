@@ -1,20 +1,58 @@
 """
-JWT auth for WebSocket: read token from query string and set scope['user'].
+WebSocket middleware: admission control (per-worker connection cap and global
+queue-depth ceiling) and JWT auth, which reads the token from the query string
+and sets scope['user'].
 """
 import logging
+import random
 from urllib.parse import parse_qs
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core import signing
 from rest_framework_simplejwt.tokens import AccessToken
-from django.contrib.auth import get_user_model
 
-User = get_user_model()
+from chat import codec
+from chat.services.identity import get_identity
+from chat.services.metrics import metrics
+from chat.services.queue import async_matchmaking_queue
+from chat.services.tracing import start_trace
+
+OVERLOADED_CLOSE_CODE = 4029
+_RESUME_SALT = "chat.resume"
+
 logger = logging.getLogger(__name__)
 
 
+def resume_token(session_id: str, channel_name: str) -> str:
+    """Signed token letting whoever holds channel_name's place in the session reclaim it."""
+    return signing.dumps([session_id, channel_name], salt=_RESUME_SALT)
+
+
+def read_resume_token(token: str) -> tuple[str, str] | None:
+    """(session_id, channel_name) from a resume token, or None if it is not one of ours."""
+    try:
+        session_id, channel_name = signing.loads(token, salt=_RESUME_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    return session_id, channel_name
+
+
+def queue_full() -> bool:
+    """Whether the queue depth this worker last saw is at MATCHMAKING_MAX_QUEUE_DEPTH."""
+    max_depth = getattr(settings, "MATCHMAKING_MAX_QUEUE_DEPTH", 0)
+    return bool(max_depth) and async_matchmaking_queue.depth >= max_depth
+
+
+def overloaded_frame(reason: str, retry_after: float) -> dict:
+    return {"type": "overloaded", "reason": reason, "retry_after": retry_after}
+
+
 class JWTWebSocketAuthMiddleware:
     """
     Resolve user from JWT in query string (e.g. ?token=...) for WebSocket.
     If no token or invalid, scope['user'] remains AnonymousUser.
+    scope['identity'] carries the cached ban state and profile for the consumer,
+    scope['trace'] the connect trace the consumer finishes (see chat.services.tracing).
     """
 
     def __init__(self, app):
@@ -24,32 +62,92 @@ class JWTWebSocketAuthMiddleware:
         if scope["type"] != "websocket":
             return await self.app(scope, receive, send)
 
+        trace = scope["trace"] = start_trace("connect")
         query = parse_qs(scope.get("query_string", b"").decode())
         tokens = query.get("token") or query.get("access")
         scope["user"] = AnonymousUser()
+        scope["identity"] = None
         if tokens:
             try:
                 token = AccessToken(tokens[0])
-                user = await self._get_user(token)
-                if user:
-                    scope["user"] = user
+                trace.mark("jwt_decode")
+                identity = await self._get_identity(token)
+                trace.mark("identity")
+                if identity:
+                    scope["user"] = identity["user"]
+                    scope["identity"] = identity
             except Exception as e:
+                metrics.incr("auth_failures")
                 logger.debug("WebSocket JWT invalid: %s", e)
 
         return await self.app(scope, receive, send)
 
     @staticmethod
-    async def _get_user(token):
-        from asgiref.sync import sync_to_async
+    async def _get_identity(token):
+        """User, ban state and display name in one cached lookup."""
         user_id = token.get("user_id")
         if not user_id:
             return None
+        return await get_identity(user_id)
 
-        @sync_to_async
-        def _fetch():
-            try:
-                return User.objects.get(pk=user_id)
-            except User.DoesNotExist:
-                return None
 
-        return await _fetch()
+class AdmissionMiddleware:
+    """
+    Turn WebSocket connects away while this worker is full or the matchmaking
+    queue is too deep, before any auth, DB or Redis work. Rejected sockets are
+    accepted just long enough to receive an 'overloaded' frame with a jittered
+    retry_after (so rejected clients don't all come back at once) and close code
+    4029. Connects with a validly signed resume token skip the queue check: they
+    return to a session (the consumer applies it if the resume fails). Queue
+    depth is the one the worker last saw, so the check costs no round trip.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.active = 0  # sockets this worker is serving
+        metrics.gauge("websocket_connections", lambda: self.active)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "websocket":
+            return await self.app(scope, receive, send)
+
+        reason = self._rejection(scope)
+        if reason:
+            metrics.incr("connections_rejected")
+            metrics.incr(f"connections_rejected_{reason}")
+            return await self._reject(reason, receive, send)
+
+        self.active += 1
+        try:
+            return await self.app(scope, receive, send)
+        finally:
+            self.active -= 1
+
+    def _rejection(self, scope) -> str | None:
+        max_connections = getattr(settings, "CHAT_MAX_CONNECTIONS", 0)
+        if max_connections and self.active >= max_connections:
+            return "worker_full"
+        if queue_full():
+            token = parse_qs(scope.get("query_string", b"").decode()).get("resume", [""])[0]
+            if not (token and read_resume_token(token)):
+                return "queue_full"
+        return None
+
+    @staticmethod
+    def retry_after() -> float:
+        """Seconds a rejected client should wait, spread over [base, 2 * base)."""
+        base = getattr(settings, "CHAT_RETRY_AFTER", 5)
+        return round(base * (1 + random.random()), 1)
+
+    async def _reject(self, reason: str, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+        retry_after = self.retry_after()
+        await send({"type": "websocket.accept"})
+        await send({"type": "websocket.send", "text": codec.dumps(overloaded_frame(reason, retry_after))})
+        await send({
+            "type": "websocket.close",
+            "code": OVERLOADED_CLOSE_CODE,
+            "reason": f"retry-after={retry_after}",
+        })
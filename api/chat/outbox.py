@@ -0,0 +1,107 @@
+"""
+Outbound backpressure for WebSocket connections.
+
+Frames for a client go through a per-connection Outbox drained by one writer
+task, so a client whose socket is slow to accept data never blocks the
+consumer's handlers (and with them the channel-layer inbox). The bytes queued
+per connection are accounted: above the high-water mark droppable traffic
+(chat, trickle-ICE candidates) is discarded, and a connection that stays above
+it for the stall timeout, or reaches the hard cap, is reported as a slow
+consumer so the caller can disconnect it. Worker memory per client stays
+bounded by the cap.
+
+Frames only back up here if the writer waits for the socket. Daphne's send()
+returns as soon as the frame is handed to Twisted, whose write buffer grows
+without limit, so under Daphne the outbox registers itself as a push producer
+on the connection's transport (follow_transport) and the writer holds frames
+while Twisted has paused it. Servers whose send() waits for the socket (e.g.
+uvicorn) need nothing extra.
+"""
+import asyncio
+import time
+from collections import deque
+from functools import partial
+
+from chat.services.metrics import metrics
+
+
+class Outbox:
+    def __init__(self, send, high_water: int, max_bytes: int, stall_timeout: float):
+        self._send = send  # async callable taking an ASGI message
+        self.high_water = high_water
+        self.max_bytes = max_bytes
+        self.stall_timeout = stall_timeout
+        self.size = 0  # bytes queued, including the frame being written
+        self._frames = deque()  # (message, size)
+        self._stalled_since = None
+        self._writer = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def follow_transport(self, send) -> bool:
+        """
+        Pause the writer while the server's transport buffer is full. send is
+        the ASGI send callable; under Daphne it is bound to the Twisted protocol.
+        Returns False (and changes nothing) under other servers.
+        """
+        protocol = send.args[0] if isinstance(send, partial) and send.args else None
+        if not hasattr(protocol, 'registerProducer') or getattr(protocol, 'transport', None) is None:
+            return False
+        try:
+            protocol.registerProducer(self, True)
+        except RuntimeError:  # the transport already has a producer
+            return False
+        return True
+
+    # Twisted IPushProducer, called from the reactor (same thread and loop)
+    def pauseProducing(self):
+        self._writable.clear()
+
+    def resumeProducing(self):
+        self._writable.set()
+
+    def stopProducing(self):
+        self._writable.set()
+
+    def put(self, message: dict, size: int, droppable: bool = False) -> bool:
+        """Queue a frame. Returns False when the client is too slow to keep."""
+        if self.size + size > self.high_water:
+            now = time.monotonic()
+            if self._stalled_since is None:
+                self._stalled_since = now
+            elif now - self._stalled_since >= self.stall_timeout:
+                return False
+            if droppable:
+                metrics.incr('outbound_dropped')
+                metrics.incr('outbound_dropped_bytes', size)
+                return True
+            if self.size + size > self.max_bytes:
+                return False
+        self._frames.append((message, size))
+        self.size += size
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._drain())
+        return True
+
+    async def _drain(self):
+        while self._frames:
+            await self._writable.wait()
+            message, size = self._frames[0]
+            await self._send(message)
+            self._frames.popleft()
+            self.size -= size
+            if self.size <= self.high_water:
+                self._stalled_since = None
+
+    async def abort(self, message: dict):
+        """Discard everything queued and send message (a close) right away."""
+        self.discard()
+        await self._send(message)
+
+    def discard(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        self._frames.clear()
+        self.size = 0
+        self._stalled_since = None
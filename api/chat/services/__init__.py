@@ -1,4 +1,4 @@
-from .queue import matchmaking_queue
-from .mongo import log_match, get_mongo_db
+from .queue import matchmaking_queue, async_matchmaking_queue
+from .mongo import log_match, log_match_end, get_mongo_db
 
-__all__ = ['matchmaking_queue', 'log_match', 'get_mongo_db']
+__all__ = ['matchmaking_queue', 'async_matchmaking_queue', 'log_match', 'log_match_end', 'get_mongo_db']
@@ -0,0 +1,139 @@
+"""
+Ban state for the WebSocket path, mirrored from UserProfile.is_banned into a
+Redis set so that every worker learns of a ban at once.
+
+Profile saves update the set and publish the change on BANS_CHANNEL (see
+chat.signals). Each worker keeps an in-process copy of the set, loaded when its
+listener subscribes and kept current from the channel, so the connect-time
+check is a set lookup with no I/O. A worker told of a ban closes that user's
+sockets (4003), which ends their sessions and queue entries. Until the copy is
+loaded, the cached identity's is_banned is the only check.
+`python manage.py sync_bans` rebuilds the set from the database.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+
+from redis.exceptions import RedisError
+
+from chat import codec
+
+from .identity import invalidate_identity
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+BANNED_KEY = 'blinkchat:bans'  # set of banned user ids
+BANS_CHANNEL = 'blinkchat:bans:changes'  # pub/sub: {'user_id', 'banned'} or {'reload': true}
+
+
+class BanList:
+    """This worker's copy of the ban set, and its sockets by user id."""
+
+    def __init__(self):
+        self.loaded = False
+        self._banned = set()
+        self._consumers = defaultdict(set)
+
+    def is_banned(self, user_id, identity: dict = None) -> bool:
+        if identity and identity['is_banned']:
+            return True
+        return self.loaded and str(user_id) in self._banned
+
+    def track(self, user_id, consumer) -> None:
+        self._consumers[str(user_id)].add(consumer)
+
+    def untrack(self, user_id, consumer) -> None:
+        consumers = self._consumers.get(str(user_id))
+        if consumers is not None:
+            consumers.discard(consumer)
+            if not consumers:
+                del self._consumers[str(user_id)]
+
+    async def listen(self, client, retry: float) -> None:
+        """Follow BANS_CHANNEL on client, resubscribing (and reloading) after errors."""
+        while True:
+            pubsub = client.pubsub()
+            try:
+                # Subscribe before loading, so no change falls between the two
+                await pubsub.subscribe(BANS_CHANNEL)
+                await self._load(client)
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        await self._apply(client, message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.incr('errors', where='ban_listener')
+                logger.warning('Ban listener failed: %s', e)
+            finally:
+                self.loaded = False
+                await pubsub.aclose()
+            await asyncio.sleep(retry)
+
+    async def _load(self, client) -> None:
+        self._banned = {member.decode() async for member in client.sscan_iter(BANNED_KEY, count=1000)}
+        self.loaded = True
+        await self._kick_banned()
+
+    async def _apply(self, client, data) -> None:
+        try:
+            change = codec.loads(data)
+        except codec.DecodeError:
+            return
+        if change.get('reload'):
+            await self._load(client)
+            return
+        user_id = str(change['user_id'])
+        # The identity cache of every worker holds is_banned too
+        invalidate_identity(user_id)
+        if not change.get('banned'):
+            self._banned.discard(user_id)
+            return
+        self._banned.add(user_id)
+        await self._kick(user_id)
+
+    async def _kick_banned(self) -> None:
+        for user_id in [user_id for user_id in self._consumers if user_id in self._banned]:
+            await self._kick(user_id)
+
+    async def _kick(self, user_id: str) -> None:
+        for consumer in list(self._consumers.pop(user_id, ())):
+            metrics.incr('ban_disconnects')
+            try:
+                await consumer.banned()
+            except Exception as e:
+                logger.warning('Closing a banned socket failed: %s', e)
+
+
+def mirror_ban(client, user_id, banned: bool) -> None:
+    """Record user_id's ban state in Redis and tell every worker if it changed (sync client)."""
+    try:
+        changed = client.sadd(BANNED_KEY, str(user_id)) if banned else client.srem(BANNED_KEY, str(user_id))
+        if changed:
+            client.publish(BANS_CHANNEL, codec.dumps({'user_id': str(user_id), 'banned': banned}))
+    except RedisError as e:
+        # The database stays authoritative: connects still see the profile's is_banned
+        metrics.incr('errors', where='ban_mirror')
+        logger.warning('Mirroring the ban state of user %s failed: %s', user_id, e)
+
+
+def sync_bans(client, user_ids) -> int:
+    """Replace the Redis set with user_ids and have every worker reload it; returns the count."""
+    members = [str(user_id) for user_id in user_ids]
+    staging = f'{BANNED_KEY}:sync'
+    pipe = client.pipeline(transaction=False)
+    pipe.delete(staging)
+    for start in range(0, len(members), 1000):
+        pipe.sadd(staging, *members[start:start + 1000])
+    pipe.execute()
+    if members:
+        client.rename(staging, BANNED_KEY)
+    else:
+        client.delete(BANNED_KEY)
+    client.publish(BANS_CHANNEL, codec.dumps({'reload': True}))
+    return len(members)
+
+
+ban_list = BanList()
+metrics.gauge('banned_users', lambda: len(ban_list._banned))
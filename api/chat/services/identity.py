@@ -0,0 +1,104 @@
+"""
+Cached identity lookup for the WebSocket connect path.
+
+One select_related query returns the user, their ban state and display name;
+results are kept in a small in-process TTL/LRU cache so reconnect storms don't
+hit the database. Profile and user saves invalidate the entry (see chat.signals);
+other workers pick up changes when their entry expires, except ban changes,
+which chat.services.bans broadcasts to every worker.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ObjectDoesNotExist
+
+from .metrics import metrics
+
+User = get_user_model()
+
+
+class IdentityCache:
+    """Thread-safe LRU of user_id -> identity with a per-entry TTL."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, identity = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return identity
+
+    def set(self, user_id, identity: dict):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, identity)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+identity_cache = IdentityCache(
+    max_size=getattr(settings, 'IDENTITY_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'IDENTITY_CACHE_TTL', 30),
+)
+
+
+def load_identity(user_id) -> dict | None:
+    """Fetch user, ban state and display name in a single query."""
+    user = User.objects.select_related('profile').filter(pk=user_id).first()
+    if user is None:
+        return None
+    try:
+        profile = user.profile
+    except ObjectDoesNotExist:
+        profile = None
+    return {
+        'user': user,
+        'is_banned': bool(profile and profile.is_banned),
+        'profile': {
+            'user_id': user.id,
+            'username': user.username,
+            'display_name': (profile and profile.display_name) or user.username,
+        },
+    }
+
+
+async def get_identity(user_id) -> dict | None:
+    """Cached identity for user_id; None if the user doesn't exist."""
+    # Tokens carry the id as a string, model signals as an int: key the cache on one form
+    key = str(user_id)
+    identity = identity_cache.get(key)
+    if identity is None:
+        start = time.perf_counter()
+        identity = await database_sync_to_async(load_identity)(user_id)
+        metrics.observe('orm_query_seconds', time.perf_counter() - start, op='identity')
+        if identity is not None:
+            identity_cache.set(key, identity)
+    return identity
+
+
+def invalidate_identity(user_id) -> None:
+    identity_cache.invalidate(str(user_id))
@@ -0,0 +1,204 @@
+"""
+In-process metrics for the realtime path: counters (bytes saved by channel-layer
+compression, rejected frames, messages by type, ...), latency histograms and
+gauges read at export time. Each worker process keeps its own; the worker loop
+publishes them to Redis and the /api/metrics/ endpoint sums every live worker's
+export into the Prometheus text format at scrape time.
+
+Updates never take a lock: every thread writes to its own store (the event loop
+thread, the match-log writer, sync_to_async executors), and exports add the
+stores up.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+from chat import codec
+
+PREFIX = 'blinkchat_'
+METRICS_KEY = 'blinkchat:metrics:workers'  # hash of worker id -> JSON export
+# Histogram bucket bounds in seconds, from Redis round trips up to long queue waits
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+
+def _key(name: str, labels: dict) -> str:
+    """Series key: name, or name{label="value",...} in Prometheus syntax."""
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+_series = {}  # (name, *label items) -> key, so labelled updates don't format strings
+
+
+def _series_key(name: str, labels: dict) -> str:
+    ident = (name, *labels.items())
+    key = _series.get(ident)
+    if key is None:
+        key = _series[ident] = _key(name, labels)
+    return key
+
+
+def _split(key: str) -> tuple:
+    name, _, labels = key.partition('{')
+    return name, labels[:-1]
+
+
+class _Store:
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}  # key -> per-bucket counts (last = +Inf), then the sum
+
+
+class Counters:
+    """Named counters and histograms with lock-free updates, plus gauge callbacks."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._stores = []
+        self._lock = threading.Lock()  # guards _stores, taken once per thread
+        self._gauges = {}
+
+    def _store(self) -> _Store:
+        try:
+            return self._local.store
+        except AttributeError:
+            store = self._local.store = _Store()
+            with self._lock:
+                self._stores.append(store)
+            return store
+
+    def incr(self, name: str, value: int = 1, **labels):
+        self._store().counters[_series_key(name, labels) if labels else name] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Record a duration in the name histogram."""
+        histograms = self._store().histograms
+        key = _series_key(name, labels) if labels else name
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(BUCKETS) + 2)
+        counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        counts[-1] += seconds
+
+    def gauge(self, name: str, read):
+        """Register read() as the current value of name, evaluated on export."""
+        self._gauges[name] = read
+
+    def get(self, name: str) -> int:
+        return self.snapshot().get(name, 0)
+
+    def snapshot(self) -> dict:
+        """Counter totals of this process."""
+        totals = defaultdict(int)
+        for store in list(self._stores):
+            for key, value in list(store.counters.items()):
+                totals[key] += value
+        return dict(totals)
+
+    def export(self) -> dict:
+        """Counters, histograms and gauges of this process as JSON-friendly dicts."""
+        histograms = {}
+        for store in list(self._stores):
+            for key, counts in list(store.histograms.items()):
+                total = histograms.setdefault(key, [0] * len(counts))
+                for i, value in enumerate(list(counts)):
+                    total[i] += value
+        gauges = {}
+        for name, read in list(self._gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception:
+                continue
+        return {'counters': self.snapshot(), 'histograms': histograms, 'gauges': gauges}
+
+    def reset(self):
+        for store in list(self._stores):
+            store.counters.clear()
+            store.histograms.clear()
+
+    async def publish(self, client, worker_id: str):
+        """Store this process's export under worker_id for scrapes from any process."""
+        await client.hset(METRICS_KEY, worker_id, codec.dumps({'at': time.time(), **self.export()}))
+
+
+def collect(client, worker_id: str, max_age: float) -> dict:
+    """
+    Exports of every worker that published within max_age seconds, by worker id;
+    this process's live export replaces its own entry. Stale entries are removed.
+    """
+    exports = {}
+    cutoff = time.time() - max_age
+    stale = []
+    for worker, raw in client.hgetall(METRICS_KEY).items():
+        worker = worker.decode()
+        try:
+            export = codec.loads(raw)
+        except codec.DecodeError:
+            export = None
+        if not isinstance(export, dict) or export.get('at', 0) < cutoff:
+            stale.append(worker)
+        else:
+            exports[worker] = export
+    if stale:
+        client.hdel(METRICS_KEY, *stale)
+    exports[worker_id] = metrics.export()
+    return exports
+
+
+def render(exports: dict, gauges: dict = None) -> str:
+    """
+    Prometheus text exposition of worker exports: counters and histograms summed
+    over workers, per-worker gauges labelled with the worker id, and the given
+    cluster-wide gauges.
+    """
+    counters = defaultdict(int)
+    histograms = {}
+    worker_gauges = defaultdict(dict)
+    for worker, export in sorted(exports.items()):
+        for key, value in export.get('counters', {}).items():
+            counters[key] += value
+        for key, counts in export.get('histograms', {}).items():
+            total = histograms.setdefault(key, [0] * len(counts))
+            for i, value in enumerate(counts):
+                total[i] += value
+        for name, value in export.get('gauges', {}).items():
+            worker_gauges[name][worker] = value
+
+    lines = []
+    for name, value in sorted((gauges or {}).items()):
+        lines += [f'# TYPE {PREFIX}{name} gauge', f'{PREFIX}{name} {value}']
+    for name, values in sorted(worker_gauges.items()):
+        lines.append(f'# TYPE {PREFIX}{name} gauge')
+        lines += [f'{PREFIX}{name}{{worker="{worker}"}} {value}' for worker, value in values.items()]
+    typed = set()
+    for key in sorted(counters):
+        name, labels = _split(key)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {PREFIX}{name}_total counter')
+        lines.append(f'{PREFIX}{name}_total{{{labels}}} {counters[key]}' if labels else f'{PREFIX}{name}_total {counters[key]}')
+    for key in sorted(histograms):
+        name, labels = _split(key)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+        counts, total = histograms[key][:-1], histograms[key][-1]
+        sep = ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'{PREFIX}{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{PREFIX}{name}_sum{suffix} {round(total, 6)}')
+        lines.append(f'{PREFIX}{name}_count{suffix} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Counters()
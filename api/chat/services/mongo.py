@@ -1,10 +1,30 @@
 """
 MongoDB service for match logs and optional storage.
+
+Match events are buffered in memory and written by a background thread in
+batches (bulk_write), so the WebSocket path only ever enqueues. When the
+buffer is full or MongoDB is unreachable, events are spilled to a file of
+this process, MATCH_LOG_SPILL_PATH.<pid> (JSON lines, replayed with the next
+batch and adopted by any process once <pid> has exited), or dropped if no
+spill path is configured.
 """
+import atexit
+import glob
+import json
+import logging
 import os
-from pymongo import MongoClient
+import queue
+import threading
+import time
+
+from django.conf import settings
+from pymongo import MongoClient, UpdateOne
 from pymongo.database import Database
 
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
 _client = None
 
 
@@ -13,20 +33,212 @@ def get_mongo_db() -> Database:
     if _client is None:
         uri = os.environ.get('MONGODB_URI') or os.environ.get('MONGO_URI', 'mongodb://127.0.0.1:27017')
         db_name = os.environ.get('MONGO_DB_NAME', 'blinkchat')
-        _client = MongoClient(uri)
+        _client = MongoClient(uri, serverSelectionTimeoutMS=getattr(settings, 'MONGO_TIMEOUT_MS', 2000))
         return _client[db_name]
     return _client[os.environ.get('MONGO_DB_NAME', 'blinkchat')]
 
 
+class MatchLogWriter:
+    """Bounded queue of match events drained into bulk writes by a daemon thread."""
+
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float, spill_path: str = ''):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.dropped = 0
+        self._indexed = False
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, event: dict) -> None:
+        """Hand an event to the writer without blocking."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._spill([event])
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='match-log-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def flush(self) -> None:
+        """Write whatever is buffered right now (used at interpreter exit)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch: list) -> None:
+        # Spilled events go first so a replayed start never lands after its end.
+        events, ops = [], []
+        for event in self._take_spill() + batch:
+            try:
+                ops.append(_to_op(event))
+            except (KeyError, TypeError) as e:
+                # Spilling it would only fail again on every replay
+                self._drop(1, 'Dropping malformed match log event %r: %s', event, e)
+                continue
+            events.append(event)
+        if not ops:
+            return
+        start = time.perf_counter()
+        try:
+            matches = get_mongo_db().matches
+            if not self._indexed:
+                matches.create_index('session_id')
+                self._indexed = True
+            matches.bulk_write(ops, ordered=True)
+        except Exception as e:
+            metrics.incr('errors', where='mongo_write')
+            logger.warning('Match log write of %d events failed: %s', len(events), e)
+            self._spill(events)
+        finally:
+            metrics.observe('mongo_write_seconds', time.perf_counter() - start)
+
+    def _drop(self, count: int, message: str, *args) -> None:
+        self.dropped += count
+        metrics.incr('match_log_dropped', count)
+        logger.warning(message, *args)
+
+    def _spill(self, events: list) -> None:
+        if not self.spill_path:
+            self.dropped += len(events)
+            metrics.incr('match_log_dropped', len(events))
+            return
+        with self._spill_lock:
+            try:
+                # One file per process: no other process appends to it, so it can be read and removed safely
+                with open(f'{self.spill_path}.{os.getpid()}', 'a') as f:
+                    for event in events:
+                        f.write(json.dumps(event) + '\n')
+            except OSError as e:
+                metrics.incr('errors', where='match_log_spill')
+                self._drop(len(events), 'Match log spill failed: %s', e)
+
+    def _take_spill(self) -> list:
+        """Read and remove this process's spill file and those left by processes that have exited."""
+        if not self.spill_path:
+            return []
+        events = []
+        with self._spill_lock:
+            for path in glob.glob(f'{glob.escape(self.spill_path)}.*'):
+                pid = path[len(self.spill_path) + 1:]
+                if not pid.isdigit() or (int(pid) != os.getpid() and _is_running(int(pid))):
+                    continue
+                # Claim it first, so two processes adopting the same file don't both replay it
+                taken = f'{path}.replay-{os.getpid()}'
+                try:
+                    os.rename(path, taken)
+                except OSError:
+                    continue
+                events += self._read_spill(taken)
+        return events
+
+    def _read_spill(self, path: str) -> list:
+        events, bad = [], 0
+        try:
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # e.g. a line cut short by a crash in the middle of a spill
+                        bad += 1
+            os.remove(path)
+        except OSError as e:
+            metrics.incr('errors', where='match_log_spill')
+            logger.warning('Reading match log spill %s failed: %s', path, e)
+        if bad:
+            metrics.incr('errors', where='match_log_spill')
+            self._drop(bad, 'Skipped %d unreadable lines of match log spill %s', bad, path)
+        return events
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # exists, owned by another user
+    return True
+
+
+def _to_op(event: dict):
+    # Upserts keyed by session_id keep start/end writes idempotent and order-independent.
+    if event['kind'] == 'start':
+        return UpdateOne(
+            {'session_id': event['session_id']},
+            {
+                '$set': {'user_ids': event['user_ids'], 'started_at': event['started_at']},
+                '$setOnInsert': {'ended_at': event['ended_at']},
+            },
+            upsert=True,
+        )
+    return UpdateOne(
+        {'session_id': event['session_id']},
+        {'$set': {'ended_at': event['ended_at'], 'duration': event['duration']}},
+        upsert=True,
+    )
+
+
+match_log_writer = MatchLogWriter(
+    max_queue=getattr(settings, 'MATCH_LOG_QUEUE_SIZE', 10000),
+    batch_size=getattr(settings, 'MATCH_LOG_BATCH_SIZE', 200),
+    flush_interval=getattr(settings, 'MATCH_LOG_FLUSH_INTERVAL', 1.0),
+    spill_path=getattr(settings, 'MATCH_LOG_SPILL_PATH', ''),
+)
+
+
 def log_match(session_id: str, user_ids: list, started_at: str, ended_at: str = None):
-    """Store match event in MongoDB (optional, non-blocking)."""
+    """Queue a match start for MongoDB (non-blocking, never raises)."""
+    match_log_writer.enqueue({
+        'kind': 'start',
+        'session_id': session_id,
+        'user_ids': user_ids,
+        'started_at': started_at,
+        'ended_at': ended_at,
+    })
+
+
+def log_match_end(session_id: str, started_at=None, ended_at: float = None):
+    """Queue the end time and duration (seconds) of a match."""
+    ended_at = ended_at or time.time()
     try:
-        db = get_mongo_db()
-        db.matches.insert_one({
-            'session_id': session_id,
-            'user_ids': user_ids,
-            'started_at': started_at,
-            'ended_at': ended_at,
-        })
-    except Exception:
-        pass  # Don't fail request if MongoDB is down
+        duration = round(ended_at - float(started_at), 3)
+    except (TypeError, ValueError):
+        duration = None
+    match_log_writer.enqueue({
+        'kind': 'end',
+        'session_id': session_id,
+        'ended_at': str(ended_at),
+        'duration': duration,
+    })
@@ -1,80 +1,1270 @@
 """
 Redis-based random matchmaking queue.
 """
-import json
+import asyncio
+import math
+import random
 import uuid
 import logging
 import time
 from django.conf import settings
 import redis
+import redis.asyncio as aioredis
+
+from chat import codec
+from .metrics import metrics
+from .sharding import HashRing, shard_urls
 
 logger = logging.getLogger(__name__)
 
-QUEUE_KEY = 'blinkchat:matchmaking:queue'
+# Waiting users: a sorted set of channel names scored by enqueue time in ms
+# (FIFO) plus a hash of channel name -> JSON payload, so leaving is O(log N).
+QUEUE_KEY = 'blinkchat:matchmaking:waiting'
+PAYLOAD_KEY = 'blinkchat:matchmaking:payloads'
 SESSION_PREFIX = 'blinkchat:session:'
-SESSION_TTL = 3600  # 1 hour
+# Sessions are kept alive by the heartbeats of the workers holding them.
+SESSION_TTL = getattr(settings, 'MATCHMAKING_SESSION_TTL', 120)
+
+# Sharding (REDIS_SHARD_URLS): every node runs a complete queue. Users join on
+# their home node (consistent hash of the user id, which also holds their
+# presence and recent partners) and, finding nobody there, take a partner from
+# the other nodes before queueing at home. Sessions live on the node their id
+# hashes to: each script creating one on a node is handed an id that maps there.
+# Every script reply carries the node's queue depth; a client skips nodes it last
+# saw empty and, when all others look empty, queues at home in one round trip.
+# Workers periodically move waiters left unmatched by cross-node races or stale
+# depths to the deepest node (rebalance), leaving a short-lived tombstone on leave
+# so a waiter in transit is not re-queued after its socket has gone.
+TOMBSTONE_PREFIX = 'blinkchat:matchmaking:left:'
+TOMBSTONE_TTL = 60
+# A move takes entries out of the source node into a transit record there, queues
+# them on the target (which marks the move id as landed) and then drops the record.
+# Records older than WORKER_TIMEOUT belong to a mover that died or stalled: the
+# next rebalance fences the target (marks the id aborted unless it landed) and
+# puts the entries back on the source if it wins. A waiter moved off the node
+# holding its presence leaves a pointer there, so a second tab still finds it.
+MIGRATIONS_KEY = 'blinkchat:matchmaking:migrations'  # move ids in transit by start time (source node)
+TRANSIT_PREFIX = 'blinkchat:matchmaking:transit:'  # move id -> {target, entries} (source node)
+MIGRATED_PREFIX = 'blinkchat:matchmaking:migrated:'  # move id -> landed (1) or aborted (target node)
+MOVED_PREFIX = 'blinkchat:matchmaking:moved:'  # user id -> channel moved to another node
+MIGRATION_TTL = 3600
+MOVED_RETRIES = 3  # moved entries settled per join before giving up (a rebalance kept moving the user's entry)
+REBALANCE_AFTER = getattr(settings, 'MATCHMAKING_REBALANCE_AFTER', 2)  # seconds unmatched before a move
+REBALANCE_MAX = 100  # waiters moved per node per rebalance
+
+# Load estimates: every session created on a node increments MATCHES_KEY there.
+# Workers sample it with the queue depth each tick (sample()), which gives each
+# node's match rate; a waiter's estimated wait is its queue position over that
+# rate, and admission control reads the summed depth without a round trip.
+MATCH_RATE_SMOOTHING = 0.5  # weight of the newest sample in the moving average
+MATCHES_KEY = 'blinkchat:matchmaking:matches'
+
+# Resumable sessions: when a matched socket drops, its channel is parked under
+# RESUME_PREFIX for the grace period; a reconnect presenting the resume token
+# rebinds its new channel into the session record (see ChatConsumer).
+RESUME_PREFIX = 'blinkchat:resume:'
+
+# Liveness: every worker process heartbeats its id into WORKERS_KEY (score =
+# Redis server time) and indexes its waiting channels in a per-worker set, so
+# entries of a crashed worker can be skipped by join and evicted in bulk.
+WORKERS_KEY = 'blinkchat:matchmaking:workers'
+WORKER_WAITING_PREFIX = 'blinkchat:matchmaking:worker:'
+WORKER_ID = uuid.uuid4().hex
+WORKER_TIMEOUT = getattr(settings, 'MATCHMAKING_WORKER_TIMEOUT', 20)
+JOIN_MAX_SCAN = 100  # candidates inspected per bucket before moving on (bounds join cost)
+
+# Attribute buckets: each waiter is also indexed in one sorted set per bucket it
+# belongs to (language+region, interest tags, language, region, anyone), scored
+# by enqueue time plus the bucket's relaxation delay. A joiner looks through its
+# immediate buckets, most specific first, for the oldest waiter whose delay has
+# elapsed; a periodic sweep pairs waiters as their criteria relax. Lookups are
+# O(buckets * log N) and nobody starves.
+BUCKET_PREFIX = 'blinkchat:matchmaking:bucket:'
+ANY_BUCKET = '*'
+# Seconds before a waiter is offered to language/region-only matches, then to anyone
+RELAX_DELAYS = getattr(settings, 'MATCHMAKING_RELAX_DELAYS', (5, 15))
+MAX_INTERESTS = 5
+SWEEP_MAX_PAIRS = 50  # waiter pairs the periodic relaxation sweep may create per run
+
+# Presence: user id -> the one channel that user has queued, maintained by the
+# same scripts as the queue, so a second tab either replaces the first entry or
+# is turned away (MATCHMAKING_DUPLICATE_POLICY = 'replace' | 'reject').
+PRESENCE_KEY = 'blinkchat:matchmaking:presence'
+DUPLICATE_POLICY = getattr(settings, 'MATCHMAKING_DUPLICATE_POLICY', 'replace')
+
+# Recent partners: per-user sorted set of partner user ids scored by match time,
+# capped in size and age, so pairing skips people you've just been matched with.
+RECENT_PREFIX = 'blinkchat:matchmaking:recent:'
+RECENT_PARTNER_TTL = getattr(settings, 'MATCHMAKING_RECENT_PARTNER_TTL', 300)
+RECENT_PARTNER_MAX = getattr(settings, 'MATCHMAKING_RECENT_PARTNER_MAX', 20)
+
+# Same-worker preference: with at least PREFER_LOCAL_DEPTH users waiting, a joiner
+# looks at up to PREFER_LOCAL_SCAN further eligible waiters in its best bucket for
+# one connected to its own worker process, whose traffic then never leaves the
+# process (see chat.layers.HybridChannelLayer). 0 disables it.
+PREFER_LOCAL_DEPTH = getattr(settings, 'MATCHMAKING_PREFER_LOCAL_DEPTH', 0)
+PREFER_LOCAL_SCAN = getattr(settings, 'MATCHMAKING_PREFER_LOCAL_SCAN', 20)
+
+# Shared Lua prelude. KEYS: queue, payloads, workers, presence (the same for every
+# script below); bucket, worker-set and session keys are derived from their prefixes.
+_LUA_PRELUDE = """
+local QUEUE, PAYLOADS, WORKERS, PRESENCE = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local BUCKET_PREFIX = '%(bucket_prefix)s'
+local WAITING_PREFIX = '%(waiting_prefix)s'
+local SESSION_PREFIX = '%(session_prefix)s'
+local RECENT_PREFIX = '%(recent_prefix)s'
+local RECENT_TTL = %(recent_ttl)d
+local RECENT_MAX = %(recent_max)d
+local TOMBSTONE_PREFIX = '%(tombstone_prefix)s'
+local MOVED_PREFIX = '%(moved_prefix)s'
+local MATCHES = '%(matches)s'
+
+local function clock()
+    local t = redis.call('TIME')
+    return tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000), tonumber(t[1])
+end
+
+local function decode(raw)
+    if not raw then
+        return nil
+    end
+    local ok, entry = pcall(cjson.decode, raw)
+    if ok and type(entry) == 'table' then
+        return entry
+    end
+    return nil
+end
+
+local function remove_entry(channel, entry)
+    redis.call('ZREM', QUEUE, channel)
+    redis.call('HDEL', PAYLOADS, channel)
+    if entry then
+        if type(entry['buckets']) == 'table' then
+            for _, bucket in ipairs(entry['buckets']) do
+                redis.call('ZREM', BUCKET_PREFIX .. bucket[1], channel)
+            end
+        end
+        if entry['worker'] then
+            redis.call('SREM', WAITING_PREFIX .. entry['worker'], channel)
+        end
+        local user = tostring(entry['user_id'])
+        if redis.call('HGET', PRESENCE, user) == channel then
+            redis.call('HDEL', PRESENCE, user)
+        end
+        if redis.call('GET', MOVED_PREFIX .. user) == channel then
+            redis.call('DEL', MOVED_PREFIX .. user)
+        end
+    end
+end
+
+local function is_live(entry, cutoff)
+    if not entry['worker'] then
+        return true
+    end
+    local seen = redis.call('ZSCORE', WORKERS, entry['worker'])
+    return seen and tonumber(seen) >= cutoff
+end
+
+-- Oldest live waiter eligible now in any of the buckets the searcher itself has
+-- relaxed into after waiting waited_ms, most specific bucket first. Both sides
+-- must have reached a bucket for it to pair them. With prefer_worker set, up to
+-- prefer_scan more eligible waiters of that bucket are checked for one on that
+-- worker before settling for the oldest. Users in exclude (a set) are skipped
+-- too. Malformed, orphaned and dead entries met on the way are removed.
+local function find_partner(self_channel, self_entry, now, waited_ms, cutoff, max_scan, prefer_worker, prefer_scan, exclude)
+    local self_user = tostring(self_entry['user_id'])
+    local recent_key = RECENT_PREFIX .. self_user
+    local recent_since = math.floor(now / 1000) - RECENT_TTL
+    for _, bucket in ipairs(self_entry['buckets']) do
+        local key = BUCKET_PREFIX .. bucket[1]
+        local candidates = {}
+        if bucket[2] <= waited_ms then
+            candidates = redis.call('ZRANGEBYSCORE', key, '-inf', now, 'LIMIT', 0, max_scan)
+        end
+        local oldest, oldest_raw, oldest_entry
+        local passed = 0
+        for _, channel in ipairs(candidates) do
+            if channel ~= self_channel then
+                local raw = redis.call('HGET', PAYLOADS, channel)
+                local entry = decode(raw)
+                if entry and is_live(entry, cutoff) then
+                    -- Ourselves (another tab) and recent partners stay queued; keep scanning.
+                    local user = tostring(entry['user_id'])
+                    local met = redis.call('ZSCORE', recent_key, user)
+                    if user ~= self_user and (not met or tonumber(met) < recent_since) and not (exclude and exclude[user]) then
+                        if not prefer_worker or entry['worker'] == prefer_worker then
+                            return channel, raw, entry
+                        end
+                        if not oldest then
+                            oldest, oldest_raw, oldest_entry = channel, raw, entry
+                        end
+                        passed = passed + 1
+                        if passed > prefer_scan then
+                            break
+                        end
+                    end
+                else
+                    if raw then
+                        remove_entry(channel, entry)
+                    end
+                    redis.call('ZREM', key, channel)
+                end
+            end
+        end
+        if oldest then
+            return oldest, oldest_raw, oldest_entry
+        end
+    end
+    return nil
+end
+
+local function remember_partner(user_id, partner_id, now_s)
+    local key = RECENT_PREFIX .. tostring(user_id)
+    redis.call('ZADD', key, now_s, tostring(partner_id))
+    redis.call('ZREMRANGEBYRANK', key, 0, -RECENT_MAX - 1)
+    redis.call('EXPIRE', key, RECENT_TTL)
+end
+
+local function create_session(session_id, raw1, entry1, raw2, entry2, started_at, ttl, now_s)
+    local session = '{"session_id":' .. cjson.encode(session_id)
+        .. ',"user1":' .. raw1
+        .. ',"user2":' .. raw2
+        .. ',"started_at":' .. started_at .. '}'
+    redis.call('SETEX', SESSION_PREFIX .. session_id, ttl, session)
+    remember_partner(entry1['user_id'], entry2['user_id'], now_s)
+    remember_partner(entry2['user_id'], entry1['user_id'], now_s)
+    redis.call('INCR', MATCHES)
+    return session
+end
+
+local function enqueue(channel, raw, entry, now)
+    redis.call('ZADD', QUEUE, now, channel)
+    redis.call('HSET', PAYLOADS, channel, raw)
+    redis.call('HSET', PRESENCE, tostring(entry['user_id']), channel)
+    redis.call('SADD', WAITING_PREFIX .. entry['worker'], channel)
+    for _, bucket in ipairs(entry['buckets']) do
+        redis.call('ZADD', BUCKET_PREFIX .. bucket[1], now + bucket[2], channel)
+    end
+end
+""" % {
+    'bucket_prefix': BUCKET_PREFIX,
+    'waiting_prefix': WORKER_WAITING_PREFIX,
+    'session_prefix': SESSION_PREFIX,
+    'recent_prefix': RECENT_PREFIX,
+    'recent_ttl': RECENT_PARTNER_TTL,
+    'recent_max': RECENT_PARTNER_MAX,
+    'tombstone_prefix': TOMBSTONE_PREFIX,
+    'moved_prefix': MOVED_PREFIX,
+    'matches': MATCHES_KEY,
+}
+
+# ARGV: channel, payload, session_id, ttl, started_at, worker_id, worker_timeout, max_scan,
+#       duplicate_policy, prefer_local_depth, prefer_local_scan, enqueue ('1' or '0').
+# Pairs the caller with the best eligible waiter and returns the new session, or
+# queues the caller. One atomic round trip either way. Returns {result, replaced,
+# recent, depth}: result is the session JSON or a {"status": ...} object, replaced
+# the channel of this user's older queue entry that was dropped (or ''), depth the
+# number of waiters left on this node. Without enqueue an unmatched caller gets
+# status "none" and, in recent, the JSON list of partners to skip on other shards.
+# A user whose entry was moved to another node gets status "moved" with that
+# channel in replaced, for the caller to settle there before joining again.
+JOIN_SCRIPT = _LUA_PRELUDE + """
+local now, now_s = clock()
+redis.call('ZADD', WORKERS, now_s, ARGV[6])
+local cutoff = now_s - tonumber(ARGV[7])
+local entry = cjson.decode(ARGV[2])
+local replaced = ''
+local existing = redis.call('HGET', PRESENCE, tostring(entry['user_id']))
+if existing and existing ~= ARGV[1] and redis.call('HEXISTS', PAYLOADS, existing) == 1 then
+    if ARGV[9] == 'reject' then
+        return {'{"status":"duplicate"}', '', '', redis.call('ZCARD', QUEUE)}
+    end
+    remove_entry(existing, decode(redis.call('HGET', PAYLOADS, existing)))
+    replaced = existing
+else
+    local moved = redis.call('GET', MOVED_PREFIX .. tostring(entry['user_id']))
+    if moved and moved ~= ARGV[1] then
+        return {'{"status":"moved"}', moved, '', redis.call('ZCARD', QUEUE)}
+    end
+end
+local prefer_worker = nil
+if tonumber(ARGV[10]) > 0 and redis.call('ZCARD', QUEUE) >= tonumber(ARGV[10]) then
+    prefer_worker = ARGV[6]
+end
+local channel, raw, other = find_partner(ARGV[1], entry, now, 0, cutoff, tonumber(ARGV[8]), prefer_worker, tonumber(ARGV[11]))
+if channel then
+    remove_entry(channel, other)
+    local session = create_session(ARGV[3], raw, other, ARGV[2], entry, ARGV[5], ARGV[4], now_s)
+    return {session, replaced, '', redis.call('ZCARD', QUEUE)}
+end
+if ARGV[12] == '0' then
+    local recent = redis.call('ZRANGEBYSCORE', RECENT_PREFIX .. tostring(entry['user_id']), now_s - RECENT_TTL, '+inf')
+    return {'{"status":"none"}', replaced, cjson.encode(recent), redis.call('ZCARD', QUEUE)}
+end
+enqueue(ARGV[1], ARGV[2], entry, now)
+return {'{"status":"waiting"}', replaced, '', redis.call('ZCARD', QUEUE)}
+"""
+
+# ARGV: channel, payload, session_id, ttl, started_at, worker_timeout, max_scan, exclude
+#       (JSON list of user ids).
+# A joiner from another shard takes the best eligible waiter here; returns the
+# {session JSON or '', depth} for the session created on this shard and the
+# waiters left here. The joiner is never queued here.
+TAKE_SCRIPT = _LUA_PRELUDE + """
+local now, now_s = clock()
+local entry = cjson.decode(ARGV[2])
+local exclude = {}
+for _, user in ipairs(cjson.decode(ARGV[8])) do
+    exclude[tostring(user)] = true
+end
+local channel, raw, other = find_partner(ARGV[1], entry, now, 0, now_s - tonumber(ARGV[6]), tonumber(ARGV[7]), nil, 0, exclude)
+if not channel then
+    return {'', redis.call('ZCARD', QUEUE)}
+end
+remove_entry(channel, other)
+local session = create_session(ARGV[3], raw, other, ARGV[2], entry, ARGV[5], ARGV[4], now_s)
+return {session, redis.call('ZCARD', QUEUE)}
+"""
+
+# ARGV: min_wait_ms, max, move_id, target shard, migration_ttl, stale_s. Removes up
+# to max waiters queued for at least min_wait into the move's transit record.
+# Returns {moved, stale}: the waiters as a flat {channel, payload, enqueued_ms, ...}
+# list, and {move_id, target, ...} for moves in transit here for stale_s or longer.
+MIGRATE_OUT_SCRIPT = _LUA_PRELUDE + """
+local now, now_s = clock()
+local oldest = redis.call('ZRANGEBYSCORE', QUEUE, '-inf', now - tonumber(ARGV[1]), 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[2]))
+local moved = {}
+for i = 1, #oldest, 2 do
+    local channel = oldest[i]
+    local raw = redis.call('HGET', PAYLOADS, channel)
+    local entry = decode(raw)
+    local user = entry and tostring(entry['user_id'])
+    local present = entry and redis.call('HGET', PRESENCE, user) == channel
+    remove_entry(channel, entry)
+    if entry then
+        if present then
+            redis.call('SET', MOVED_PREFIX .. user, channel, 'EX', ARGV[5])
+        end
+        table.insert(moved, channel)
+        table.insert(moved, raw)
+        table.insert(moved, oldest[i + 1])
+    end
+end
+if #moved > 0 then
+    redis.call('SET', '%(transit_prefix)s' .. ARGV[3], cjson.encode({target = tonumber(ARGV[4]), entries = moved}))
+    redis.call('ZADD', '%(migrations)s', now_s, ARGV[3])
+end
+local stale = {}
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', '%(migrations)s', '-inf', now_s - tonumber(ARGV[6]))) do
+    local record = decode(redis.call('GET', '%(transit_prefix)s' .. id))
+    table.insert(stale, id)
+    table.insert(stale, record and record['target'] or -1)
+end
+return {moved, stale}
+""" % {'transit_prefix': TRANSIT_PREFIX, 'migrations': MIGRATIONS_KEY}
+
+# ARGV: move_id, migration_ttl, channel, payload, enqueued_ms, ... Marks the move
+# landed and queues the waiters with their original enqueue time, unless they left
+# while in transit; 0 (nothing queued) when the move was aborted first.
+MIGRATE_IN_SCRIPT = _LUA_PRELUDE + """
+if not redis.call('SET', '%(migrated_prefix)s' .. ARGV[1], 1, 'NX', 'EX', ARGV[2]) then
+    return 0
+end
+for i = 3, #ARGV, 3 do
+    local entry = decode(ARGV[i + 1])
+    if entry and redis.call('EXISTS', TOMBSTONE_PREFIX .. ARGV[i]) == 0 then
+        enqueue(ARGV[i], ARGV[i + 1], entry, tonumber(ARGV[i + 2]))
+    end
+end
+return 1
+""" % {'migrated_prefix': MIGRATED_PREFIX}
+
+# ARGV: move_id, restore ('1' or '0'). Drops the move's transit record, first putting
+# its waiters back here with restore (the move was aborted), except those that left
+# or queued again meanwhile; returns how many were put back.
+MIGRATE_END_SCRIPT = _LUA_PRELUDE + """
+local record = decode(redis.call('GET', '%(transit_prefix)s' .. ARGV[1]))
+redis.call('DEL', '%(transit_prefix)s' .. ARGV[1])
+redis.call('ZREM', '%(migrations)s', ARGV[1])
+local restored = 0
+if record and ARGV[2] == '1' then
+    local moved = record['entries']
+    for i = 1, #moved, 3 do
+        local entry = decode(moved[i + 1])
+        if entry and redis.call('EXISTS', TOMBSTONE_PREFIX .. moved[i]) == 0
+                and redis.call('HEXISTS', PAYLOADS, moved[i]) == 0 then
+            enqueue(moved[i], moved[i + 1], entry, tonumber(moved[i + 2]))
+            restored = restored + 1
+        end
+    end
+end
+return restored
+""" % {'transit_prefix': TRANSIT_PREFIX, 'migrations': MIGRATIONS_KEY}
+
+# KEYS: the move's landed marker on its target. ARGV: migration_ttl. Marks a stale
+# move aborted unless it landed; returns the marker ('1' landed, 'aborted').
+MIGRATE_FENCE_SCRIPT = """
+redis.call('SET', KEYS[1], 'aborted', 'NX', 'EX', ARGV[1])
+return redis.call('GET', KEYS[1])
+"""
+
+# ARGV: channel, tombstone_ttl (0 = none). Returns 1 if the channel was queued here.
+LEAVE_SCRIPT = _LUA_PRELUDE + """
+local raw = redis.call('HGET', PAYLOADS, ARGV[1])
+remove_entry(ARGV[1], decode(raw))
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', TOMBSTONE_PREFIX .. ARGV[1], 1, 'EX', ARGV[2])
+end
+return raw and 1 or 0
+"""
+
+# ARGV: worker_timeout. Evicts every waiting entry of workers that stopped
+# heartbeating; returns the count.
+REAP_SCRIPT = _LUA_PRELUDE + """
+local _, now_s = clock()
+local dead = redis.call('ZRANGEBYSCORE', WORKERS, '-inf', '(' .. (now_s - tonumber(ARGV[1])))
+local evicted = 0
+for _, worker in ipairs(dead) do
+    local waiting_key = WAITING_PREFIX .. worker
+    for _, channel in ipairs(redis.call('SMEMBERS', waiting_key)) do
+        remove_entry(channel, decode(redis.call('HGET', PAYLOADS, channel)))
+        evicted = evicted + 1
+    end
+    redis.call('DEL', waiting_key)
+    redis.call('ZREM', WORKERS, worker)
+end
+return evicted
+"""
+
+# ARGV: min_wait_ms, ttl, started_at, worker_timeout, max_scan, session_id...
+# Relaxation sweep: waiters queued for at least min_wait look for a partner
+# through the buckets they have relaxed into, so two relaxed waiters are paired
+# even when no new joiner arrives. Returns the sessions created (at most one per session_id).
+SWEEP_SCRIPT = _LUA_PRELUDE + """
+local now, now_s = clock()
+local cutoff = now_s - tonumber(ARGV[4])
+local max_scan = tonumber(ARGV[5])
+local next_id = 6
+local sessions = {}
+local oldest = redis.call('ZRANGEBYSCORE', QUEUE, '-inf', now - tonumber(ARGV[1]), 'WITHSCORES', 'LIMIT', 0, 2 * (#ARGV - 5))
+for i = 1, #oldest, 2 do
+    if next_id > #ARGV then
+        break
+    end
+    local channel = oldest[i]
+    local raw = redis.call('HGET', PAYLOADS, channel)
+    local entry = decode(raw)
+    if entry and is_live(entry, cutoff) then
+        local waited = now - tonumber(oldest[i + 1])
+        local partner, partner_raw, partner_entry = find_partner(channel, entry, now, waited, cutoff, max_scan)
+        if partner then
+            remove_entry(channel, entry)
+            remove_entry(partner, partner_entry)
+            table.insert(sessions, create_session(ARGV[next_id], raw, entry, partner_raw, partner_entry, ARGV[3], ARGV[2], now_s))
+            next_id = next_id + 1
+        end
+    elseif raw then
+        remove_entry(channel, entry)
+    end
+end
+return sessions
+"""
+
+# KEYS: workers, then session keys held by this worker. ARGV: worker_id, session_ttl,
+# worker_timeout. Records the heartbeat and refreshes the sessions; returns {added,
+# live workers}, added 1 when the worker was missing (reaped as dead).
+HEARTBEAT_SCRIPT = """
+local now = redis.call('TIME')
+local added = redis.call('ZADD', KEYS[1], now[1], ARGV[1])
+for i = 2, #KEYS do
+    redis.call('EXPIRE', KEYS[i], ARGV[2])
+end
+return {added, redis.call('ZRANGEBYSCORE', KEYS[1], tonumber(now[1]) - tonumber(ARGV[3]), '+inf')}
+"""
+
+# KEYS: resume marker of the dropped channel, session. ARGV: session_id, old channel,
+# new channel, worker_id, session_ttl, user_id ('' for anonymous). Moves the user's
+# side of the session to the new channel; returns the updated session or nil.
+# Only those two fields of the stored JSON are rewritten: a cjson decode/encode
+# round trip would turn empty objects ({}) into arrays and round started_at.
+RESUME_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return false
+end
+local raw = redis.call('GET', KEYS[2])
+if not raw then
+    return false
+end
+local session = cjson.decode(raw)
+-- The session is '{"session_id":..,"user1":{..},"user2":{..},..}' (see create_session)
+local split = string.find(raw, ',"user2":', 1, true)
+if not split then
+    return false
+end
+local sides = {string.sub(raw, 1, split - 1), string.sub(raw, split)}
+
+local function replace_once(text, old, new)
+    local first, last = string.find(text, old, 1, true)
+    if not first then
+        return nil
+    end
+    return string.sub(text, 1, first - 1) .. new .. string.sub(text, last + 1)
+end
+
+for i, side in ipairs({'user1', 'user2'}) do
+    local user = session[side]
+    if user['channel_name'] == ARGV[2] then
+        if ARGV[6] ~= '' and tostring(user['user_id']) ~= ARGV[6] then
+            return false
+        end
+        local edited = replace_once(sides[i], '"channel_name":' .. cjson.encode(ARGV[2]), '"channel_name":' .. cjson.encode(ARGV[3]))
+        edited = edited and replace_once(edited, '"worker":' .. cjson.encode(user['worker']), '"worker":' .. cjson.encode(ARGV[4]))
+        if not edited then
+            return false
+        end
+        sides[i] = edited
+        raw = sides[1] .. sides[2]
+        redis.call('SETEX', KEYS[2], ARGV[5], raw)
+        redis.call('DEL', KEYS[1])
+        return raw
+    end
+end
+return false
+"""
+
+# KEYS: resume marker of the dropped channel, the partner's marker. ARGV: session_id,
+# marker TTL. Parks the dropped side (1), unless the partner is parked already (0):
+# the partner's consumer, which would have ended the grace period, is gone too.
+SUSPEND_SCRIPT = """
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+# KEYS: resume marker. ARGV: session_id. Claims an unresumed marker (1) so the grace
+# period can end without racing a late resume; 0 when the user already came back.
+EXPIRE_RESUME_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+"""
+
+_KEYS = [QUEUE_KEY, PAYLOAD_KEY, WORKERS_KEY, PRESENCE_KEY]
+
+# Script -> op label of the redis_call_seconds histogram
+_SCRIPT_OPS = {
+    JOIN_SCRIPT: 'join', TAKE_SCRIPT: 'take', MIGRATE_OUT_SCRIPT: 'migrate_out', MIGRATE_IN_SCRIPT: 'migrate_in',
+    MIGRATE_END_SCRIPT: 'migrate_end', MIGRATE_FENCE_SCRIPT: 'migrate_fence',
+    LEAVE_SCRIPT: 'leave', REAP_SCRIPT: 'reap', SWEEP_SCRIPT: 'sweep', HEARTBEAT_SCRIPT: 'heartbeat',
+    RESUME_SCRIPT: 'resume', SUSPEND_SCRIPT: 'suspend', EXPIRE_RESUME_SCRIPT: 'expire_resume',
+}
+
+
+def _timed(script, op: str):
+    def call(**kwargs):
+        start = time.perf_counter()
+        try:
+            return script(**kwargs)
+        except redis.RedisError:
+            metrics.incr('errors', where='redis')
+            raise
+        finally:
+            metrics.observe('redis_call_seconds', time.perf_counter() - start, op=op)
+    return call
+
+
+def _timed_async(script, op: str):
+    async def call(**kwargs):
+        start = time.perf_counter()
+        try:
+            return await script(**kwargs)
+        except redis.RedisError:
+            metrics.incr('errors', where='redis')
+            raise
+        finally:
+            metrics.observe('redis_call_seconds', time.perf_counter() - start, op=op)
+    return call
+
+
+def match_buckets(meta: dict) -> list:
+    """
+    Buckets a waiter with these attributes is indexed under, most specific
+    first, as [name, delay_ms] pairs: how long other joiners must wait before
+    they may take this waiter from that bucket.
+    """
+    lang = meta.get('lang')
+    region = meta.get('region')
+    specific = [f'lr:{lang}:{region}'] if lang and region else []
+    specific += [f'tag:{tag}' for tag in (meta.get('interests') or [])[:MAX_INTERESTS]]
+    partial = ([f'l:{lang}'] if lang else []) + ([f'r:{region}'] if region else [])
+    buckets = [[name, 0] for name in specific]
+    buckets += [[name, RELAX_DELAYS[0] * 1000 if specific else 0] for name in partial]
+    buckets.append([ANY_BUCKET, RELAX_DELAYS[1] * 1000 if specific or partial else 0])
+    return buckets
+
+
+def _join_call(channel_name: str, user_id: str, meta: dict = None, session_id: str = None, enqueue: bool = True):
+    """Build the args for JOIN_SCRIPT."""
+    meta = meta or {}
+    payload = {
+        'channel_name': channel_name,
+        'user_id': str(user_id),
+        'meta': meta,
+        'worker': WORKER_ID,
+        'buckets': match_buckets(meta),
+    }
+    return [
+        channel_name, codec.dumps(payload), session_id or str(uuid.uuid4()), SESSION_TTL, repr(time.time()),
+        WORKER_ID, WORKER_TIMEOUT, JOIN_MAX_SCAN, DUPLICATE_POLICY, PREFER_LOCAL_DEPTH, PREFER_LOCAL_SCAN,
+        '1' if enqueue else '0',
+    ]
+
+
+def _take_call(join_args: list, session_id: str, exclude: list):
+    channel_name, payload, _, ttl, started_at = join_args[:5]
+    return [channel_name, payload, session_id, ttl, started_at, WORKER_TIMEOUT, JOIN_MAX_SCAN, codec.dumps(exclude)]
+
+
+def _sweep_call(max_pairs: int, session_ids: list = None):
+    return [RELAX_DELAYS[0] * 1000, SESSION_TTL, repr(time.time()), WORKER_TIMEOUT, JOIN_MAX_SCAN] + (
+        session_ids or [str(uuid.uuid4()) for _ in range(max_pairs)]
+    )
+
+
+def _heartbeat_call(session_ids):
+    keys = [WORKERS_KEY] + [f'{SESSION_PREFIX}{sid}' for sid in session_ids]
+    return keys, [WORKER_ID, SESSION_TTL, WORKER_TIMEOUT]
+
+
+def _resume_ttl(grace: float) -> int:
+    # The partner's consumer ends the grace period; the margin only covers both sides dropping
+    return int(grace) + WORKER_TIMEOUT
+
+
+def _suspend_call(session_id: str, channel_name: str, partner_channel: str, grace: float):
+    keys = [f'{RESUME_PREFIX}{channel_name}', f'{RESUME_PREFIX}{partner_channel}']
+    return keys, [session_id, _resume_ttl(grace)]
+
+
+def _resume_call(session_id: str, old_channel: str, channel_name: str, user_id):
+    keys = [f'{RESUME_PREFIX}{old_channel}', f'{SESSION_PREFIX}{session_id}']
+    return keys, [session_id, old_channel, channel_name, WORKER_ID, SESSION_TTL, '' if user_id is None else str(user_id)]
+
+
+def _join_result(reply) -> dict:
+    raw, replaced = reply[:2]
+    result = _decode(raw) or {'status': 'waiting'}
+    if replaced:
+        result['replaced'] = replaced.decode()
+    if result.get('status') == 'waiting':
+        # Newest entry on the node, so the depth is our place in line
+        result['position'] = int(reply[3])
+    return result
+
+
+def _join_recent(reply) -> list:
+    """Partners to skip on other shards, from an unmatched JOIN_SCRIPT reply without enqueue."""
+    recent = _decode(reply[2])
+    return recent if isinstance(recent, list) else []
+
+
+def _with_replaced(result: dict, first: dict) -> dict:
+    """Carry 'replaced' over from the first JOIN_SCRIPT call of a sharded join."""
+    if 'replaced' in first:
+        result['replaced'] = first['replaced']
+    return result
+
+
+def _decode(raw) -> dict | None:
+    if not raw:
+        return None
+    try:
+        return codec.loads(raw)
+    except codec.DecodeError:
+        return None
+
+
+class _Shards:
+    """Shard selection shared by both queue classes: one client per Redis node."""
+
+    def _setup(self, clients: list, nodes: list):
+        self._clients = clients
+        self._ring = HashRing(nodes)
+        self._scripts = {}
+        self._depths = [None] * len(clients)  # queue depth per shard as last seen (None = unknown)
+        self._matches = [None] * len(clients)  # MATCHES_KEY per shard at the last sample()
+        self._match_rates = [0.0] * len(clients)  # sessions created per second, per shard
+        self._sampled_at = None
+
+    @property
+    def _redis(self):
+        """The first (with a single node, the only) shard's client."""
+        return self._clients[0]
+
+    @property
+    def sharded(self) -> bool:
+        return len(self._clients) > 1
+
+    def _script(self, source: str, shard: int = 0):
+        script = self._scripts.get((shard, source))
+        if script is None:
+            script = self._scripts[(shard, source)] = self._timed(
+                self._clients[shard].register_script(source), _SCRIPT_OPS.get(source, 'script'),
+            )
+        return script
+
+    def client_for(self, key):
+        """The client of the shard owning key, for other features keeping state in Redis."""
+        return self._clients[self._ring.node(str(key))]
 
+    def _home(self, user_id) -> int:
+        return self._ring.node(str(user_id))
 
-class MatchmakingQueue:
-    def __init__(self):
-        self._redis = redis.from_url(getattr(settings, 'REDIS_URL', 'redis://127.0.0.1:6379'))
+    def _session_shard(self, session_id: str) -> int:
+        return self._ring.node(session_id)
 
-    def join(self, channel_name: str, user_id: str, meta: dict = None) -> str | None:
+    def _session_id(self, shard: int) -> str:
+        """A new session id that hashes to shard (N tries on average)."""
+        while True:
+            session_id = str(uuid.uuid4())
+            if self._ring.node(session_id) == shard:
+                return session_id
+
+    def _probes(self, home: int) -> list:
+        """Other shards a joiner unmatched at home should try, in random order; skips ones seen empty."""
+        others = [i for i in range(len(self._clients)) if i != home and self._depths[i] != 0]
+        random.shuffle(others)
+        return others
+
+    def _rebalanced(self, depths: list, target: int, moved: dict) -> int:
+        """Record depths after a rebalance that moved {shard: count} to target; returns the total."""
+        total = sum(moved.values())
+        self._depths = [depth - moved.get(shard, 0) for shard, depth in enumerate(depths)]
+        self._depths[target] += total
+        return total
+
+    @property
+    def depth(self) -> int:
+        """Waiters across all shards as last seen by this process (no round trip)."""
+        return sum(d or 0 for d in self._depths) if self._clients else 0
+
+    @property
+    def match_rate(self) -> float:
+        """Sessions created per second across all shards, as of the last sample()."""
+        return sum(self._match_rates) if self._clients else 0.0
+
+    def _record_sample(self, samples: list, now: float) -> int:
+        """Update depths and match rates from [(depth, matches), ...] per shard; returns the total depth."""
+        elapsed = now - self._sampled_at if self._sampled_at else 0
+        for shard, (depth, matches) in enumerate(samples):
+            matches = int(matches or 0)
+            self._depths[shard] = int(depth)
+            previous = self._matches[shard]
+            if elapsed > 0 and previous is not None and matches >= previous:
+                rate = (matches - previous) / elapsed
+                self._match_rates[shard] += MATCH_RATE_SMOOTHING * (rate - self._match_rates[shard])
+            self._matches[shard] = matches
+        self._sampled_at = now
+        return self.depth
+
+    def estimate_wait(self, user_id, position: int) -> int | None:
+        """Seconds until a waiter at position on the user's home shard is likely matched (None = unknown)."""
+        rate = self._match_rates[self._home(user_id)] if self._clients else 0
+        if rate <= 0:
+            return None
+        return math.ceil(position / rate)
+
+    def _recent_writes(self, session: dict, shard: int) -> dict:
+        """
+        create_session() records the pair as recent partners on the shard it ran
+        on; users whose home is elsewhere need the record there. Returns
+        {home shard: [(user_id, partner_id), ...]}.
+        """
+        if not self.sharded:
+            return {}
+        user1, user2 = str(session['user1']['user_id']), str(session['user2']['user_id'])
+        writes = {}
+        for user, partner in ((user1, user2), (user2, user1)):
+            home = self._home(user)
+            if home != shard:
+                writes.setdefault(home, []).append((user, partner))
+        return writes
+
+
+def _remember(pipe, user: str, partner: str, now_s: int):
+    key = f'{RECENT_PREFIX}{user}'
+    pipe.zadd(key, {partner: now_s})
+    pipe.zremrangebyrank(key, 0, -RECENT_PARTNER_MAX - 1)
+    pipe.expire(key, RECENT_PARTNER_TTL)
+    # Matched away from home: the entry a moved pointer there refers to is gone
+    pipe.delete(f'{MOVED_PREFIX}{user}')
+
+
+def _migrate_out_call(move_id: str, target: int, limit: int) -> list:
+    return [REBALANCE_AFTER * 1000, limit, move_id, target, MIGRATION_TTL, WORKER_TIMEOUT]
+
+
+def _migrate_in_call(move_id: str, moved: list) -> list:
+    return [move_id, MIGRATION_TTL] + [v.decode() if isinstance(v, bytes) else v for v in moved]
+
+
+def _stale_moves(stale: list) -> list:
+    """[(move_id, target shard), ...] from a MIGRATE_OUT_SCRIPT reply."""
+    return [(move_id.decode(), int(target)) for move_id, target in zip(stale[::2], stale[1::2])]
+
+
+def _join_moved(reply) -> str | None:
+    """The channel a JOIN_SCRIPT reply says this user has queued on another node, if any."""
+    if reply[0] == b'{"status":"moved"}':
+        return reply[1].decode()
+    return None
+
+
+class MatchmakingQueue(_Shards):
+    """Synchronous queue API (management commands, tests, scripts)."""
+
+    _timed = staticmethod(_timed)
+
+    def __init__(self, client=None, clients: list = None):
+        if clients is None and client is not None:
+            clients = [client]
+        if clients is None:
+            urls = shard_urls()
+            timeout = getattr(settings, 'REDIS_SOCKET_TIMEOUT', 2)
+            self._setup([
+                redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout) for url in urls
+            ], urls)
+        else:
+            self._setup(clients, [str(i) for i in range(len(clients))])
+
+    def join(self, channel_name: str, user_id: str, meta: dict = None) -> dict:
         """
-        Add user to queue. If someone is waiting, pop them and return session_id.
-        Otherwise add current user to queue and return None.
+        Add user to queue. If someone suitable is waiting, pop them and return the
+        new session (a dict with 'session_id'). Otherwise add current user to queue
+        and return {'status': 'waiting'}, or {'status': 'duplicate'} when the user
+        is already queued and the duplicate policy is 'reject'. Under 'replace' the
+        older entry is dropped and its channel reported in result['replaced'].
+
+        Pop-or-enqueue and session creation run as one server-side script, so a
+        match costs a single round trip and concurrent joiners can't miss each other.
+        meta may carry 'lang', 'region' and 'interests' to pick the buckets searched.
+        With several shards a joiner unmatched at home also tries the other shards
+        that have waiters, one round trip each, before queueing at home.
         """
-        meta = meta or {}
-        payload = {'channel_name': channel_name, 'user_id': str(user_id), 'meta': meta}
-        # Try to pop a waiting user (FIFO for fairness)
-        raw = self._redis.lpop(QUEUE_KEY)
-        if raw:
-            try:
-                other = json.loads(raw)
-                session_id = str(uuid.uuid4())
-                started_at = time.time()
-                self._redis.setex(
-                    f'{SESSION_PREFIX}{session_id}',
-                    SESSION_TTL,
-                    json.dumps({
-                        'session_id': session_id,
-                        'user1': other,
-                        'user2': payload,
-                        'started_at': started_at,
-                    })
+        home = self._home(user_id)
+        probes = self._probes(home)
+        args = _join_call(channel_name, user_id, meta, self._session_id(home), enqueue=not probes)
+        reply, settled = self._join_home(home, user_id, args)
+        if reply is None:
+            return settled
+        self._depths[home] = int(reply[3])
+        result = _with_replaced(_join_result(reply), settled)
+        if result.get('status') == 'none':
+            exclude = _join_recent(reply)
+            for shard in probes:
+                raw, depth = self._script(TAKE_SCRIPT, shard)(
+                    keys=_KEYS, args=_take_call(args, self._session_id(shard), exclude),
                 )
-                return session_id
-            except (json.JSONDecodeError, TypeError):
-                pass
-        self._redis.rpush(QUEUE_KEY, json.dumps(payload))
-        return None
+                self._depths[shard] = int(depth)
+                session = _decode(raw)
+                if session:
+                    self._remember_remote(session, shard)
+                    return _with_replaced(session, result)
+            args[-1] = '1'
+            reply, settled = self._join_home(home, user_id, args)
+            if reply is None:
+                return _with_replaced(settled, result)
+            self._depths[home] = int(reply[3])
+            result = _with_replaced(_join_result(reply), _with_replaced(settled, result))
+        if 'session_id' in result:
+            self._remember_remote(result, home)
+        return result
+
+    def _join_home(self, home: int, user_id, args: list) -> tuple:
+        """
+        Run JOIN_SCRIPT at home, settling (see _settle_moved) each entry of this
+        user it finds moved off home by a rebalance and running it again. Returns
+        (reply, settled); reply is None when the join ends with settled, a
+        {'status': 'duplicate'}.
+        """
+        settled = {}
+        for _ in range(MOVED_RETRIES):
+            reply = self._script(JOIN_SCRIPT, home)(keys=_KEYS, args=args)
+            moved = _join_moved(reply)
+            if not moved:
+                return reply, settled
+            settled = {**settled, **self._settle_moved(home, user_id, moved)}
+            if settled.get('status') == 'duplicate':
+                return None, settled
+        return None, {**settled, 'status': 'duplicate'}
+
+    def _settle_moved(self, home: int, user_id, channel: str) -> dict:
+        """
+        Apply the duplicate policy to the user's entry that a rebalance moved off
+        home, then drop the pointer to it. Returns {'status': 'duplicate'},
+        {'replaced': channel} or {} (the entry is gone).
+        """
+        others = [shard for shard in range(len(self._clients)) if shard != home]
+        result = {}
+        if DUPLICATE_POLICY == 'reject':
+            if any(self._clients[shard].hexists(PAYLOAD_KEY, channel) for shard in others):
+                return {'status': 'duplicate'}
+        elif sum(self._script(LEAVE_SCRIPT, shard)(keys=_KEYS, args=[channel, TOMBSTONE_TTL]) for shard in others):
+            result['replaced'] = channel
+        self._clients[home].delete(f'{MOVED_PREFIX}{user_id}')
+        return result
+
+    def _remember_remote(self, session: dict, shard: int) -> None:
+        for home, pairs in self._recent_writes(session, shard).items():
+            pipe = self._clients[home].pipeline(transaction=False)
+            for user, partner in pairs:
+                _remember(pipe, user, partner, int(time.time()))
+            pipe.execute()
+
+    def leave_queue(self, channel_name: str, rejoining: bool = False) -> None:
+        """
+        Remove this channel from the queue and its buckets (e.g. on disconnect).
+        rejoining skips the tombstone, so the channel can queue again at once.
+        """
+        tombstone = TOMBSTONE_TTL if self.sharded and not rejoining else 0
+        for shard in range(len(self._clients)):
+            self._script(LEAVE_SCRIPT, shard)(keys=_KEYS, args=[channel_name, tombstone])
+
+    def match_waiting(self, max_pairs: int = SWEEP_MAX_PAIRS) -> list:
+        """Pair waiters whose criteria have relaxed enough; returns the new sessions."""
+        sessions = []
+        for shard in range(len(self._clients)):
+            session_ids = [self._session_id(shard) for _ in range(max_pairs)]
+            raws = self._script(SWEEP_SCRIPT, shard)(keys=_KEYS, args=_sweep_call(max_pairs, session_ids))
+            for session in filter(None, map(_decode, raws)):
+                self._remember_remote(session, shard)
+                sessions.append(session)
+        return sessions
+
+    def rebalance(self) -> int:
+        """Move waiters unmatched for REBALANCE_AFTER to the deepest shard; returns how many."""
+        if not self.sharded:
+            return 0
+        depths = [client.zcard(QUEUE_KEY) for client in self._clients]
+        target = depths.index(max(depths))
+        moved = {}
+        for shard in range(len(self._clients)):
+            # The target moves nobody out, but its stale moves are recovered too
+            move_id = uuid.uuid4().hex
+            limit = 0 if shard == target else REBALANCE_MAX
+            entries, stale = self._script(MIGRATE_OUT_SCRIPT, shard)(
+                keys=_KEYS, args=_migrate_out_call(move_id, target, limit),
+            )
+            if entries:
+                landed = self._script(MIGRATE_IN_SCRIPT, target)(keys=_KEYS, args=_migrate_in_call(move_id, entries))
+                self._script(MIGRATE_END_SCRIPT, shard)(keys=_KEYS, args=[move_id, '0' if landed else '1'])
+                if landed:
+                    moved[shard] = len(entries) // 3
+            for stale_id, stale_target in _stale_moves(stale):
+                self._recover_move(shard, stale_id, stale_target)
+        return self._rebalanced(depths, target, moved)
+
+    def _recover_move(self, shard: int, move_id: str, target: int) -> None:
+        """End a move whose mover died or stalled: its waiters go back to shard unless they landed."""
+        landed = 0 <= target < len(self._clients) and self._script(MIGRATE_FENCE_SCRIPT, target)(
+            keys=[f'{MIGRATED_PREFIX}{move_id}'], args=[MIGRATION_TTL],
+        ) == b'1'
+        restored = self._script(MIGRATE_END_SCRIPT, shard)(keys=_KEYS, args=[move_id, '0' if landed else '1'])
+        metrics.incr('queue_moves_recovered')
+        logger.warning('Recovered an interrupted queue move (%d waiters restored)', restored)
 
-    def leave_queue(self, channel_name: str) -> None:
-        """Remove this channel from the queue (e.g. on disconnect)."""
-        raw_list = self._redis.lrange(QUEUE_KEY, 0, -1)
-        new_list = []
-        for raw in raw_list or []:
-            try:
-                data = json.loads(raw)
-                if data.get('channel_name') != channel_name:
-                    new_list.append(raw)
-            except (json.JSONDecodeError, TypeError):
-                new_list.append(raw)
-        self._redis.delete(QUEUE_KEY)
-        for item in new_list:
-            self._redis.rpush(QUEUE_KEY, item)
+    def sample(self) -> int:
+        """Refresh per-shard depth and match rate (one round trip per shard); returns the total depth."""
+        samples = []
+        for client in self._clients:
+            pipe = client.pipeline(transaction=False)
+            pipe.zcard(QUEUE_KEY)
+            pipe.get(MATCHES_KEY)
+            samples.append(pipe.execute())
+        return self._record_sample(samples, time.monotonic())
 
     def get_session(self, session_id: str) -> dict | None:
-        raw = self._redis.get(f'{SESSION_PREFIX}{session_id}')
-        if not raw:
-            return None
-        try:
-            return json.loads(raw)
-        except (json.JSONDecodeError, TypeError):
-            return None
+        return _decode(self._clients[self._session_shard(session_id)].get(f'{SESSION_PREFIX}{session_id}'))
 
     def delete_session(self, session_id: str) -> None:
-        self._redis.delete(f'{SESSION_PREFIX}{session_id}')
+        self._clients[self._session_shard(session_id)].delete(f'{SESSION_PREFIX}{session_id}')
+
+    def end_session(self, session_id: str) -> dict | None:
+        """Delete the session and return it; only the first caller gets it back."""
+        pipe = self._clients[self._session_shard(session_id)].pipeline(transaction=True)
+        pipe.get(f'{SESSION_PREFIX}{session_id}')
+        pipe.delete(f'{SESSION_PREFIX}{session_id}')
+        raw, _ = pipe.execute()
+        return _decode(raw)
+
+    def suspend_session(self, session_id: str, channel_name: str, partner_channel: str, grace: float) -> bool:
+        """Park a dropped channel's place in the session for a resume; False if the partner is parked."""
+        keys, args = _suspend_call(session_id, channel_name, partner_channel, grace)
+        return bool(self._script(SUSPEND_SCRIPT, self._session_shard(session_id))(keys=keys, args=args))
+
+    def resume_session(self, session_id: str, old_channel: str, channel_name: str, user_id=None) -> dict | None:
+        """Rebind a parked user to channel_name; returns the session, or None if it has ended."""
+        keys, args = _resume_call(session_id, old_channel, channel_name, user_id)
+        return _decode(self._script(RESUME_SCRIPT, self._session_shard(session_id))(keys=keys, args=args))
+
+    def expire_resume(self, session_id: str, old_channel: str) -> bool:
+        """End the grace period of old_channel; False if it has already resumed."""
+        script = self._script(EXPIRE_RESUME_SCRIPT, self._session_shard(session_id))
+        return bool(script(keys=[f'{RESUME_PREFIX}{old_channel}'], args=[session_id]))
+
+    def heartbeat(self, session_ids=()) -> tuple[set, bool]:
+        """
+        Mark this worker alive and refresh its sessions' TTL. Returns the live
+        worker ids, and whether some shard had reaped this worker (its waiting
+        entries there are gone).
+        """
+        by_shard = [[] for _ in self._clients]
+        for session_id in session_ids:
+            by_shard[self._session_shard(session_id)].append(session_id)
+        live, reaped = set(), False
+        for shard, ids in enumerate(by_shard):
+            keys, args = _heartbeat_call(ids)
+            added, workers = self._script(HEARTBEAT_SCRIPT, shard)(keys=keys, args=args)
+            reaped = reaped or bool(added)
+            live.update(w.decode() for w in workers)
+        return live, reaped
+
+    def reap_stale(self) -> int:
+        """Evict waiting entries of workers that stopped heartbeating; returns how many."""
+        return sum(
+            self._script(REAP_SCRIPT, shard)(keys=_KEYS, args=[WORKER_TIMEOUT])
+            for shard in range(len(self._clients))
+        )
+
+
+class AsyncMatchmakingQueue(_Shards):
+    """
+    Same API as MatchmakingQueue on redis.asyncio, awaited directly by consumers.
+    The clients are created lazily so their size-bounded pools are shared by every
+    consumer on the worker's event loop.
+    """
+
+    _timed = staticmethod(_timed_async)
+
+    def __init__(self, client=None, clients: list = None):
+        if clients is None and client is not None:
+            clients = [client]
+        self._injected = clients
+        self._clients = None
+
+    def _ensure_clients(self):
+        if self._clients is not None:
+            return
+        if self._injected is not None:
+            self._setup(self._injected, [str(i) for i in range(len(self._injected))])
+            return
+        urls = shard_urls()
+        self._setup([
+            aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+                url,
+                max_connections=getattr(settings, 'REDIS_POOL_MAX_CONNECTIONS', 50),
+                timeout=getattr(settings, 'REDIS_POOL_TIMEOUT', 5),
+            ))
+            for url in urls
+        ], urls)
+
+    @property
+    def _redis(self):
+        self._ensure_clients()
+        return self._clients[0]
+
+    def _script(self, source: str, shard: int = 0):
+        self._ensure_clients()
+        return super()._script(source, shard)
+
+    def client_for(self, key):
+        """The pooled redis.asyncio client of the shard owning key, for other realtime-path features."""
+        self._ensure_clients()
+        return super().client_for(key)
+
+    async def join(self, channel_name: str, user_id: str, meta: dict = None) -> dict:
+        self._ensure_clients()
+        home = self._home(user_id)
+        probes = self._probes(home)
+        args = _join_call(channel_name, user_id, meta, self._session_id(home), enqueue=not probes)
+        reply, settled = await self._join_home(home, user_id, args)
+        if reply is None:
+            return settled
+        self._depths[home] = int(reply[3])
+        result = _with_replaced(_join_result(reply), settled)
+        if result.get('status') == 'none':
+            exclude = _join_recent(reply)
+            for shard in probes:
+                raw, depth = await self._script(TAKE_SCRIPT, shard)(
+                    keys=_KEYS, args=_take_call(args, self._session_id(shard), exclude),
+                )
+                self._depths[shard] = int(depth)
+                session = _decode(raw)
+                if session:
+                    await self._remember_remote(session, shard)
+                    return _with_replaced(session, result)
+            args[-1] = '1'
+            reply, settled = await self._join_home(home, user_id, args)
+            if reply is None:
+                return _with_replaced(settled, result)
+            self._depths[home] = int(reply[3])
+            result = _with_replaced(_join_result(reply), _with_replaced(settled, result))
+        if 'session_id' in result:
+            await self._remember_remote(result, home)
+        return result
+
+    async def _join_home(self, home: int, user_id, args: list) -> tuple:
+        settled = {}
+        for _ in range(MOVED_RETRIES):
+            reply = await self._script(JOIN_SCRIPT, home)(keys=_KEYS, args=args)
+            moved = _join_moved(reply)
+            if not moved:
+                return reply, settled
+            settled = {**settled, **await self._settle_moved(home, user_id, moved)}
+            if settled.get('status') == 'duplicate':
+                return None, settled
+        return None, {**settled, 'status': 'duplicate'}
+
+    async def _settle_moved(self, home: int, user_id, channel: str) -> dict:
+        others = [shard for shard in range(len(self._clients)) if shard != home]
+        result = {}
+        if DUPLICATE_POLICY == 'reject':
+            found = await asyncio.gather(*(self._clients[shard].hexists(PAYLOAD_KEY, channel) for shard in others))
+            if any(found):
+                return {'status': 'duplicate'}
+        elif sum(await asyncio.gather(*(
+            self._script(LEAVE_SCRIPT, shard)(keys=_KEYS, args=[channel, TOMBSTONE_TTL]) for shard in others
+        ))):
+            result['replaced'] = channel
+        await self._clients[home].delete(f'{MOVED_PREFIX}{user_id}')
+        return result
+
+    async def _remember_remote(self, session: dict, shard: int) -> None:
+        for home, pairs in self._recent_writes(session, shard).items():
+            pipe = self._clients[home].pipeline(transaction=False)
+            for user, partner in pairs:
+                _remember(pipe, user, partner, int(time.time()))
+            await pipe.execute()
+
+    async def leave_queue(self, channel_name: str, rejoining: bool = False) -> None:
+        self._ensure_clients()
+        tombstone = TOMBSTONE_TTL if self.sharded and not rejoining else 0
+        await asyncio.gather(*(
+            self._script(LEAVE_SCRIPT, shard)(keys=_KEYS, args=[channel_name, tombstone])
+            for shard in range(len(self._clients))
+        ))
+
+    async def match_waiting(self, max_pairs: int = SWEEP_MAX_PAIRS) -> list:
+        self._ensure_clients()
+        sessions = []
+        for shard in range(len(self._clients)):
+            session_ids = [self._session_id(shard) for _ in range(max_pairs)]
+            raws = await self._script(SWEEP_SCRIPT, shard)(keys=_KEYS, args=_sweep_call(max_pairs, session_ids))
+            for session in filter(None, map(_decode, raws)):
+                await self._remember_remote(session, shard)
+                sessions.append(session)
+        return sessions
+
+    async def rebalance(self) -> int:
+        self._ensure_clients()
+        if not self.sharded:
+            return 0
+        depths = await asyncio.gather(*(client.zcard(QUEUE_KEY) for client in self._clients))
+        target = depths.index(max(depths))
+        moved = {}
+        for shard in range(len(self._clients)):
+            move_id = uuid.uuid4().hex
+            limit = 0 if shard == target else REBALANCE_MAX
+            entries, stale = await self._script(MIGRATE_OUT_SCRIPT, shard)(
+                keys=_KEYS, args=_migrate_out_call(move_id, target, limit),
+            )
+            if entries:
+                landed = await self._script(MIGRATE_IN_SCRIPT, target)(
+                    keys=_KEYS, args=_migrate_in_call(move_id, entries),
+                )
+                await self._script(MIGRATE_END_SCRIPT, shard)(keys=_KEYS, args=[move_id, '0' if landed else '1'])
+                if landed:
+                    moved[shard] = len(entries) // 3
+            for stale_id, stale_target in _stale_moves(stale):
+                await self._recover_move(shard, stale_id, stale_target)
+        return self._rebalanced(list(depths), target, moved)
+
+    async def _recover_move(self, shard: int, move_id: str, target: int) -> None:
+        landed = 0 <= target < len(self._clients) and await self._script(MIGRATE_FENCE_SCRIPT, target)(
+            keys=[f'{MIGRATED_PREFIX}{move_id}'], args=[MIGRATION_TTL],
+        ) == b'1'
+        restored = await self._script(MIGRATE_END_SCRIPT, shard)(keys=_KEYS, args=[move_id, '0' if landed else '1'])
+        metrics.incr('queue_moves_recovered')
+        logger.warning('Recovered an interrupted queue move (%d waiters restored)', restored)
+
+    async def sample(self) -> int:
+        self._ensure_clients()
+
+        async def one(client):
+            pipe = client.pipeline(transaction=False)
+            pipe.zcard(QUEUE_KEY)
+            pipe.get(MATCHES_KEY)
+            return await pipe.execute()
+
+        samples = await asyncio.gather(*(one(client) for client in self._clients))
+        return self._record_sample(samples, time.monotonic())
+
+    def _session_client(self, session_id: str):
+        self._ensure_clients()
+        return self._clients[self._session_shard(session_id)]
+
+    async def get_session(self, session_id: str) -> dict | None:
+        return _decode(await self._session_client(session_id).get(f'{SESSION_PREFIX}{session_id}'))
+
+    async def delete_session(self, session_id: str) -> None:
+        await self._session_client(session_id).delete(f'{SESSION_PREFIX}{session_id}')
+
+    async def end_session(self, session_id: str) -> dict | None:
+        pipe = self._session_client(session_id).pipeline(transaction=True)
+        pipe.get(f'{SESSION_PREFIX}{session_id}')
+        pipe.delete(f'{SESSION_PREFIX}{session_id}')
+        raw, _ = await pipe.execute()
+        return _decode(raw)
+
+    async def suspend_session(self, session_id: str, channel_name: str, partner_channel: str, grace: float) -> bool:
+        self._ensure_clients()
+        keys, args = _suspend_call(session_id, channel_name, partner_channel, grace)
+        return bool(await self._script(SUSPEND_SCRIPT, self._session_shard(session_id))(keys=keys, args=args))
+
+    async def resume_session(self, session_id: str, old_channel: str, channel_name: str, user_id=None) -> dict | None:
+        self._ensure_clients()
+        keys, args = _resume_call(session_id, old_channel, channel_name, user_id)
+        return _decode(await self._script(RESUME_SCRIPT, self._session_shard(session_id))(keys=keys, args=args))
+
+    async def expire_resume(self, session_id: str, old_channel: str) -> bool:
+        self._ensure_clients()
+        script = self._script(EXPIRE_RESUME_SCRIPT, self._session_shard(session_id))
+        return bool(await script(keys=[f'{RESUME_PREFIX}{old_channel}'], args=[session_id]))
+
+    async def heartbeat(self, session_ids=()) -> tuple[set, bool]:
+        self._ensure_clients()
+        by_shard = [[] for _ in self._clients]
+        for session_id in session_ids:
+            by_shard[self._session_shard(session_id)].append(session_id)
+        live, reaped = set(), False
+        for shard, ids in enumerate(by_shard):
+            keys, args = _heartbeat_call(ids)
+            added, workers = await self._script(HEARTBEAT_SCRIPT, shard)(keys=keys, args=args)
+            reaped = reaped or bool(added)
+            live.update(w.decode() for w in workers)
+        return live, reaped
+
+    async def reap_stale(self) -> int:
+        self._ensure_clients()
+        return sum([
+            await self._script(REAP_SCRIPT, shard)(keys=_KEYS, args=[WORKER_TIMEOUT])
+            for shard in range(len(self._clients))
+        ])
 
 
 matchmaking_queue = MatchmakingQueue()
+async_matchmaking_queue = AsyncMatchmakingQueue()
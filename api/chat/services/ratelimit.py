@@ -0,0 +1,127 @@
+"""
+Message rate limiting for WebSocket connections.
+
+Every connection gets an in-process token bucket per message type, so a check
+is a few float operations. With CHAT_RATE_LIMIT_SHARED on, authenticated users
+also draw from a per-user bucket in Redis shared by all their sockets; tokens
+are leased from it in chunks of CHAT_RATE_LIMIT_LEASE, so Redis is hit once per
+lease rather than once per message. The shared limit fails open: while Redis
+is unreachable only the per-connection buckets apply.
+"""
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from .metrics import metrics
+
+RATE_LIMIT_PREFIX = 'blinkchat:ratelimit:'
+
+# KEYS: bucket hash. ARGV: rate (tokens/s), burst, tokens wanted. Returns tokens granted.
+LEASE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate, burst, want = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local granted = math.min(want, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return granted
+"""
+
+
+class TokenBucket:
+    """Refills at rate tokens per second up to burst; each allowed event takes one."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class ConnectionLimiter:
+    """
+    Per-connection limits: one bucket per message type in rules
+    ({type: (rate, burst)}; other types are not limited) plus a bucket of
+    violations, so a client that keeps exceeding its limits can be disconnected.
+    """
+
+    def __init__(self, rules: dict, max_violations: int):
+        self._buckets = {t: TokenBucket(rate, burst) for t, (rate, burst) in rules.items()}
+        # Violations are forgiven at max_violations per minute
+        self._violations = TokenBucket(max_violations / 60, max_violations) if max_violations > 0 else None
+
+    def allow(self, msg_type) -> bool:
+        bucket = self._buckets.get(msg_type)
+        return bucket is None or bucket.allow()
+
+    def violation(self) -> bool:
+        """Record a violation; False once the client has used up its allowance."""
+        return self._violations is None or self._violations.allow()
+
+
+class SharedLimiter:
+    """Per-user limit in Redis, consumed through locally held leases."""
+
+    def __init__(self, client, user_id, rules: dict, lease: int):
+        self._script = client.register_script(LEASE_SCRIPT)
+        self._user_id = user_id
+        self._rules = rules
+        self._lease = lease
+        self._held = {}
+
+    async def allow(self, msg_type) -> bool:
+        rule = self._rules.get(msg_type)
+        if rule is None:
+            return True
+        held = self._held.get(msg_type, 0)
+        if held <= 0:
+            rate, burst = rule
+            try:
+                held = int(await self._script(
+                    keys=[f'{RATE_LIMIT_PREFIX}{self._user_id}:{msg_type}'],
+                    args=[rate, burst, min(self._lease, burst)],
+                ))
+            except RedisError:
+                # Fail open rather than cut everyone off; the connection's own bucket still applies
+                metrics.incr('errors', where='rate_limit')
+                return True
+            if held <= 0:
+                self._held[msg_type] = 0
+                return False
+        self._held[msg_type] = held - 1
+        return True
+
+
+def connection_limiter() -> ConnectionLimiter:
+    return ConnectionLimiter(
+        getattr(settings, 'CHAT_RATE_LIMITS', {}),
+        getattr(settings, 'CHAT_RATE_LIMIT_MAX_VIOLATIONS', 0),
+    )
+
+
+def shared_limiter(client, user_id) -> SharedLimiter | None:
+    """The Redis-backed per-user limiter, or None when CHAT_RATE_LIMIT_SHARED is off."""
+    if not getattr(settings, 'CHAT_RATE_LIMIT_SHARED', False):
+        return None
+    return SharedLimiter(
+        client, user_id,
+        getattr(settings, 'CHAT_RATE_LIMITS', {}),
+        getattr(settings, 'CHAT_RATE_LIMIT_LEASE', 10),
+    )
@@ -0,0 +1,44 @@
+"""
+Consistent hashing over the Redis nodes listed in REDIS_SHARD_URLS.
+
+Keys are mapped to nodes through a ring of virtual points per node, so adding
+or removing a node only moves about 1/N of the keys. With a single node every
+key maps to it.
+"""
+import bisect
+import hashlib
+
+from django.conf import settings
+
+RING_REPLICAS = 100  # virtual points per node
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, nodes: list, replicas: int = RING_REPLICAS):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_hash(f'{node}#{replica}'), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, key: str) -> int:
+        """Index of the node owning key."""
+        if len(self.nodes) == 1:
+            return 0
+        return self._indexes[bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+def shard_urls() -> list:
+    """Redis URLs of the matchmaking/session shards, in a stable order."""
+    urls = getattr(settings, 'REDIS_SHARD_URLS', None)
+    return list(urls) if urls else [getattr(settings, 'REDIS_URL', 'redis://127.0.0.1:6379')]
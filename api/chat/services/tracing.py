@@ -0,0 +1,139 @@
+"""
+Opt-in phase tracing for the WebSocket path (auth middleware, ChatConsumer
+connect/disconnect/receive).
+
+A trace timestamps each phase as it ends (trace.mark('join')). Finished traces
+feed a per-process slow-log holding the worst CHAT_TRACE_SLOWLOG_SIZE of each
+kind, and CHAT_TRACE_SAMPLE_RATE of them are also logged as JSON on the
+'chat.trace' logger. With both settings at 0 (the default) start_trace()
+returns NULL_TRACE, whose methods do nothing. The worker loop publishes the
+slow-log to Redis so /api/debug/slowlog/ can show the worst traces of every
+live worker.
+"""
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from django.conf import settings
+
+from chat import codec
+
+logger = logging.getLogger('chat.trace')
+
+SLOWLOG_KEY = 'blinkchat:traces:slowlog'  # hash of worker id -> JSON slow-log
+SAMPLE_RATE = getattr(settings, 'CHAT_TRACE_SAMPLE_RATE', 0)
+SLOWLOG_SIZE = getattr(settings, 'CHAT_TRACE_SLOWLOG_SIZE', 0)
+
+
+class Trace:
+    def __init__(self, kind: str, sampled: bool):
+        self.kind = kind
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.tags = {}
+        self.phases = []
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, phase: str):
+        """End phase now; its duration runs from the previous mark (or the start)."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def finish(self):
+        total = time.perf_counter() - self._start
+        record = {
+            'kind': self.kind,
+            'at': round(self.started_at, 3),
+            'total_ms': round(total * 1000, 3),
+            'phases': [[phase, round(seconds * 1000, 3)] for phase, seconds in self.phases],
+            **self.tags,
+        }
+        slowlog.add(record)
+        if self.sampled:
+            logger.info(codec.dumps(record))
+
+
+class _NullTrace:
+    """Stand-in while tracing is off."""
+
+    sampled = False
+
+    def mark(self, phase: str):
+        pass
+
+    def tag(self, **tags):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+def start_trace(kind: str):
+    if not (SAMPLE_RATE or SLOWLOG_SIZE):
+        return NULL_TRACE
+    return Trace(kind, SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE)
+
+
+class SlowLog:
+    """The size slowest trace records of each kind (min-heaps, evicting the fastest)."""
+
+    def __init__(self):
+        self._heaps = {}
+        self._seq = itertools.count()
+
+    def add(self, record: dict):
+        size = SLOWLOG_SIZE
+        if size <= 0:
+            return
+        heap = self._heaps.setdefault(record['kind'], [])
+        item = (record['total_ms'], next(self._seq), record)
+        if len(heap) < size:
+            heapq.heappush(heap, item)
+        elif item[0] > heap[0][0]:
+            heapq.heapreplace(heap, item)
+
+    def records(self) -> list:
+        """Slowest first."""
+        items = [item for heap in list(self._heaps.values()) for item in list(heap)]
+        return [record for _, _, record in sorted(items, key=lambda item: -item[0])]
+
+    def clear(self):
+        self._heaps.clear()
+
+    async def publish(self, client, worker_id: str):
+        if SLOWLOG_SIZE > 0:
+            await client.hset(SLOWLOG_KEY, worker_id, codec.dumps({'at': time.time(), 'records': self.records()}))
+
+
+def collect(client, worker_id: str, max_age: float, kind: str = None, limit: int = None) -> list:
+    """Slow-log records of every worker that published within max_age seconds, slowest first."""
+    cutoff = time.time() - max_age
+    by_worker = {}
+    for worker, raw in client.hgetall(SLOWLOG_KEY).items():
+        try:
+            entry = codec.loads(raw)
+        except codec.DecodeError:
+            continue
+        if isinstance(entry, dict) and entry.get('at', 0) >= cutoff:
+            by_worker[worker.decode()] = entry.get('records', [])
+    by_worker[worker_id] = slowlog.records()
+    records = [
+        {**record, 'worker': worker}
+        for worker, worker_records in by_worker.items()
+        for record in worker_records
+        if kind is None or record.get('kind') == kind
+    ]
+    records.sort(key=lambda record: -record.get('total_ms', 0))
+    return records[:limit or SLOWLOG_SIZE or None]
+
+
+slowlog = SlowLog()
@@ -0,0 +1,126 @@
+"""
+Per-process background loop for the realtime path: heartbeats this worker's
+liveness, keeps its sessions' Redis keys alive, re-queues its waiters if other
+workers took it for dead and evicted them (a stalled event loop or Redis outage
+longer than MATCHMAKING_WORKER_TIMEOUT), tells local consumers when their
+partner's worker has died, sweeps queue entries left by dead workers, gathers
+long waiters of a sharded queue onto one shard, pairs waiters whose matching
+criteria have relaxed, samples queue depth and match rate for admission
+control and wait estimates, and publishes its metrics and trace slow-log.
+Alongside it runs the ban listener (chat.services.bans).
+"""
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .bans import BANNED_KEY, ban_list
+from .metrics import METRICS_KEY, metrics
+from .mongo import log_match
+from .queue import WORKER_ID, WORKER_TIMEOUT, async_matchmaking_queue
+from .tracing import SLOWLOG_KEY, slowlog
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerRuntime:
+    def __init__(self, interval: float):
+        self.interval = interval
+        # (session_id, channel_name) -> consumer on this worker; both peers of a session may be here
+        self._sessions = {}
+        self._waiting = {}  # channel_name -> queued consumer on this worker
+        self._last_beat = None  # monotonic time of the last successful heartbeat
+        self._task = None
+        self._bans_task = None
+
+    def ensure_started(self) -> None:
+        """Start the loop and the ban listener on the running event loop (idempotent)."""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        if self._bans_task is None or self._bans_task.done():
+            client = async_matchmaking_queue.client_for(BANNED_KEY)
+            self._bans_task = loop.create_task(ban_list.listen(client, retry=self.interval))
+
+    def track_session(self, session_id: str, consumer) -> None:
+        self._sessions[session_id, consumer.channel_name] = consumer
+
+    def untrack_session(self, session_id: str, consumer) -> None:
+        self._sessions.pop((session_id, consumer.channel_name), None)
+
+    def session_ids(self) -> set:
+        return {session_id for session_id, _ in self._sessions}
+
+    def track_waiting(self, channel_name: str, consumer) -> None:
+        self._waiting[channel_name] = consumer
+
+    def untrack_waiting(self, channel_name: str) -> None:
+        self._waiting.pop(channel_name, None)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.incr('errors', where='worker_tick')
+                logger.warning('Worker heartbeat failed: %s', e)
+            await asyncio.sleep(self.interval)
+
+    async def tick(self) -> None:
+        started = time.monotonic()
+        live, reaped = await async_matchmaking_queue.heartbeat(list(self.session_ids()))
+        # A join from this worker re-adds it too, so a long gap counts even if the heartbeat found it present
+        stalled = self._last_beat is not None and started - self._last_beat >= WORKER_TIMEOUT
+        self._last_beat = started
+        if (reaped or stalled) and self._waiting:
+            await self._requeue_waiting()
+        for (session_id, _), consumer in list(self._sessions.items()):
+            partner_worker = getattr(consumer, 'partner_worker', None)
+            if partner_worker and partner_worker not in live:
+                self.untrack_session(session_id, consumer)
+                await consumer.partner_lost()
+        evicted = await async_matchmaking_queue.reap_stale()
+        if evicted:
+            logger.info('Evicted %d stale queue entries', evicted)
+        moved = await async_matchmaking_queue.rebalance()
+        if moved:
+            logger.debug('Moved %d waiters between queue shards', moved)
+        for session in await async_matchmaking_queue.match_waiting():
+            await self._notify_matched(session)
+        await async_matchmaking_queue.sample()
+        await metrics.publish(async_matchmaking_queue.client_for(METRICS_KEY), WORKER_ID)
+        await slowlog.publish(async_matchmaking_queue.client_for(SLOWLOG_KEY), WORKER_ID)
+
+    async def _requeue_waiting(self) -> None:
+        logger.warning('Worker was taken for dead; re-queueing %d waiters', len(self._waiting))
+        for consumer in list(self._waiting.values()):
+            metrics.incr('waiters_requeued')
+            try:
+                await consumer.requeue()
+            except Exception as e:
+                logger.warning('Re-queueing a waiter failed: %s', e)
+
+    async def _notify_matched(self, session: dict) -> None:
+        """Both sides of a swept match were waiting: tell each about the other."""
+        metrics.incr('sessions_matched')
+        channel_layer = get_channel_layer()
+        session_id = session['session_id']
+        room_group_name = f'session_{session_id}' if getattr(settings, 'CHAT_ROUTING', 'direct') == 'group' else None
+        user1, user2 = session['user1'], session['user2']
+        for me, partner, is_initiator in ((user1, user2, True), (user2, user1, False)):
+            await channel_layer.send(me['channel_name'], {
+                'type': 'matched_from_queue',
+                'session_id': session_id,
+                'room_group_name': room_group_name,
+                'partner': partner,
+                'is_initiator': is_initiator,
+            })
+        log_match(session_id, [str(user1.get('user_id')), str(user2.get('user_id'))], str(session.get('started_at', '')), None)
+
+
+worker_runtime = WorkerRuntime(interval=getattr(settings, 'MATCHMAKING_HEARTBEAT_INTERVAL', 5))
+metrics.gauge('active_sessions', lambda: len(worker_runtime.session_ids()))
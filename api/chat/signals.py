@@ -0,0 +1,38 @@
+"""
+Model signal handlers: keep the WebSocket identity cache and the Redis ban set
+in step with edits.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import UserProfile
+from .services.bans import BANNED_KEY, mirror_ban
+from .services.identity import invalidate_identity
+from .services.queue import matchmaking_queue
+
+
+@receiver(post_init, sender=UserProfile)
+def profile_loaded(sender, instance, **kwargs):
+    # The ban state as loaded, so saves that leave it alone skip Redis (None if deferred)
+    instance._saved_is_banned = instance.__dict__.get('is_banned')
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def profile_changed(sender, instance, signal, created=False, update_fields=None, **kwargs):
+    invalidate_identity(instance.user_id)
+    if update_fields is not None and 'is_banned' not in update_fields:
+        return
+    banned = instance.is_banned and signal is post_save
+    previous = False if created else instance._saved_is_banned
+    instance._saved_is_banned = banned
+    if previous is not None and bool(previous) == banned:
+        return
+    # After commit, so no worker reloads the identity before the change is visible
+    transaction.on_commit(lambda: mirror_ban(matchmaking_queue.client_for(BANNED_KEY), instance.user_id, banned))
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, **kwargs):
+    invalidate_identity(instance.pk)
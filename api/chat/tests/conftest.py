@@ -0,0 +1,43 @@
+import os
+from collections import defaultdict
+
+import django
+import pytest
+
+# chat.services reads its settings at import, so Django is set up before collection
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+django.setup()
+
+
+@pytest.fixture
+def realtime(monkeypatch):
+    """
+    The WebSocket path on in-process stand-ins, as bench._common.use_local_backends
+    sets it up: fakeredis behind the matchmaking queue, the in-memory channel layer,
+    no match logging, and fresh worker and ban state. Returns a sync client on the
+    same fake Redis.
+    """
+    import fakeredis
+    from channels.layers import channel_layers
+    from django.conf import settings
+
+    from chat import consumers
+    from chat.services import queue, worker
+    from chat.services.bans import ban_list
+    from chat.services.identity import identity_cache
+
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(settings, 'CHANNEL_LAYERS', {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+    channel_layers.backends.clear()
+    monkeypatch.setattr(queue.async_matchmaking_queue, '_injected', [fakeredis.FakeAsyncRedis(server=server)])
+    monkeypatch.setattr(queue.async_matchmaking_queue, '_clients', None)
+    for module, name in ((consumers, 'log_match'), (consumers, 'log_match_end'), (worker, 'log_match')):
+        monkeypatch.setattr(module, name, lambda *args, **kwargs: None)
+    runtime = worker.worker_runtime
+    for name, value in (('_sessions', {}), ('_waiting', {}), ('_task', None), ('_bans_task', None), ('_last_beat', None)):
+        monkeypatch.setattr(runtime, name, value)
+    for name, value in (('loaded', False), ('_banned', set()), ('_consumers', defaultdict(set))):
+        monkeypatch.setattr(ban_list, name, value)
+    yield fakeredis.FakeRedis(server=server)
+    channel_layers.backends.clear()
+    identity_cache.clear()
@@ -0,0 +1,48 @@
+"""
+Mirroring ban state into Redis (chat.services.bans).
+"""
+import fakeredis
+
+from chat import codec
+from chat.services.bans import BANNED_KEY, BANS_CHANNEL, mirror_ban, sync_bans
+from chat.services.metrics import metrics
+
+
+def published(pubsub) -> list:
+    messages = []
+    while (message := pubsub.get_message(timeout=0.01)) is not None:
+        if message['type'] == 'message':
+            messages.append(codec.loads(message['data']))
+    return messages
+
+
+def test_mirror_publishes_only_changes():
+    client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    pubsub = client.pubsub()
+    pubsub.subscribe(BANS_CHANNEL)
+    mirror_ban(client, 9, True)
+    mirror_ban(client, 9, True)
+    mirror_ban(client, 9, False)
+    mirror_ban(client, 9, False)
+    assert published(pubsub) == [{'user_id': '9', 'banned': True}, {'user_id': '9', 'banned': False}]
+    assert client.smembers(BANNED_KEY) == set()
+
+
+def test_mirror_never_raises_without_redis():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    errors = metrics.snapshot().get('errors{where="ban_mirror"}', 0)
+    mirror_ban(fakeredis.FakeRedis(server=server), 9, True)
+    assert metrics.snapshot()['errors{where="ban_mirror"}'] == errors + 1
+
+
+def test_sync_replaces_the_set_and_asks_for_a_reload():
+    client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    client.sadd(BANNED_KEY, 'stale')
+    pubsub = client.pubsub()
+    pubsub.subscribe(BANS_CHANNEL)
+    assert sync_bans(client, [1, 2]) == 2
+    assert client.smembers(BANNED_KEY) == {b'1', b'2'}
+    assert sync_bans(client, []) == 0
+    assert not client.exists(BANNED_KEY)
+    assert published(pubsub) == [{'reload': True}, {'reload': True}]
@@ -0,0 +1,58 @@
+"""
+Wire codecs (chat.codec): compact JSON, MessagePack client frames and
+compression of large channel-layer fields.
+"""
+import msgpack
+import pytest
+
+from chat import codec
+
+
+def test_json_is_compact_and_round_trips():
+    frame = {'type': 'chat', 'message': 'héllo', 'meta': {}, 'interests': []}
+    assert codec.dumps(frame) == '{"type":"chat","message":"héllo","meta":{},"interests":[]}'
+    assert codec.loads(codec.dumps(frame)) == frame
+
+
+@pytest.mark.parametrize('data', ['', '{"type":', 'nan-sense'])
+def test_malformed_json_raises_decode_error(data):
+    with pytest.raises(codec.DecodeError):
+        codec.loads(data)
+
+
+def test_msgpack_frames_round_trip():
+    frame = {'type': 'signal', 'payload': {'sdp': 'v=0', 'candidates': [1, 2.5, None, True]}}
+    assert codec.unpackb(codec.packb(frame)) == frame
+
+
+@pytest.mark.parametrize('value', [
+    b'raw bytes',
+    msgpack.ExtType(1, b'x'),
+    {1: 'int key'},
+    {'nested': [{'deep': b'bin'}]},
+])
+def test_msgpack_values_json_cannot_carry_are_rejected(value):
+    with pytest.raises(codec.DecodeError):
+        codec.unpackb(msgpack.packb({'type': 'chat', 'message': value}, use_bin_type=True))
+
+
+@pytest.mark.parametrize('data', [b'\x81', msgpack.packb({'type': 'chat'}) + b'\x00', b'\xc1'])
+def test_malformed_msgpack_raises_decode_error(data):
+    with pytest.raises(codec.DecodeError):
+        codec.unpackb(data)
+
+
+def test_large_fields_are_compressed_and_expanded():
+    event = {'type': 'chat_message', 'message': 'a' * 2000, 'sender_id': 9}
+    packed, saved = codec.compress_event(event, threshold=1024)
+    assert 'message' not in packed and isinstance(packed['message_z'], bytes)
+    assert saved > 1500
+    assert codec.expand_event(packed) == event
+
+
+def test_small_fields_are_left_alone_and_zero_turns_compression_off():
+    small = {'type': 'chat_message', 'message': 'hi'}
+    assert codec.compress_event(small, threshold=1024) == (small, 0)
+    large = {'type': 'signal_message', 'payload': {'sdp': 'a' * 2000}}
+    assert codec.compress_event(large, threshold=0) == (large, 0)
+    assert codec.expand_event(small) is small
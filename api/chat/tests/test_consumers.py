@@ -0,0 +1,297 @@
+"""
+ChatConsumer through the full ASGI app (config.asgi) with WebsocketCommunicator,
+on fakeredis and the in-memory channel layer (see the realtime fixture).
+"""
+import asyncio
+import json
+
+import msgpack
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import codec
+from chat.middleware import resume_token
+from chat.services import queue
+from chat.services.bans import ban_list, mirror_ban
+from chat.services.identity import identity_cache
+from chat.services.metrics import metrics
+from chat.services.worker import worker_runtime
+from config.asgi import application
+
+
+def sign_in(user_id: int) -> str:
+    """A JWT for user_id, whose identity is cached so the connect needs no database."""
+    user = get_user_model()(id=user_id, username=f'user{user_id}')
+    identity_cache.set(str(user_id), {
+        'user': user,
+        'is_banned': False,
+        'profile': {'user_id': user_id, 'username': user.username, 'display_name': user.username},
+    })
+    return str(AccessToken.for_user(user))
+
+
+def communicator(query: str = '', **kwargs) -> WebsocketCommunicator:
+    return WebsocketCommunicator(application, f'/ws/chat/?{query}' if query else '/ws/chat/', **kwargs)
+
+
+async def frames(client: WebsocketCommunicator, timeout: float = 0.1) -> list:
+    """Every frame the client receives until it has been quiet for timeout seconds."""
+    received = []
+    while not await client.receive_nothing(timeout):
+        received.append(await client.receive_json_from())
+    return received
+
+
+async def matched_pair(query_a: str = '', query_b: str = '') -> tuple:
+    """Connect a then b, which are paired with each other; returns (a, b, a's frames, b's frames)."""
+    a, b = communicator(query_a), communicator(query_b)
+    assert (await a.connect())[0]
+    assert [f['type'] for f in await frames(a)] == ['connected', 'waiting']
+    assert (await b.connect())[0]
+    b_frames = await frames(b)
+    a_frames = await frames(a)
+    assert b_frames[-1]['type'] == 'matched' and a_frames[-1]['type'] == 'matched'
+    return a, b, a_frames, b_frames
+
+
+def test_peers_on_one_worker_are_tracked_apart(realtime, monkeypatch):
+    monkeypatch.setattr(settings, 'CHAT_RESUME_GRACE', 5)
+
+    async def scenario():
+        a, b, a_frames, _ = await matched_pair()
+        session_id = a_frames[-1]['session_id']
+        assert len(worker_runtime._sessions) == 2
+        # a drops without a close frame and is suspended; b is still in the session here
+        await a.disconnect(code=1006)
+        assert [f['type'] for f in await frames(b)] == ['partner_reconnecting']
+        assert worker_runtime.session_ids() == {session_id}
+        assert len(worker_runtime._sessions) == 1
+        await b.disconnect()
+        assert worker_runtime.session_ids() == set()
+
+    asyncio.run(scenario())
+
+
+def test_resume_keeps_the_session_and_the_user_id(realtime, monkeypatch):
+    monkeypatch.setattr(settings, 'CHAT_RESUME_GRACE', 5)
+
+    async def scenario():
+        token = sign_in(9)
+        # a: signed in; b: anonymous with no attributes, so its queue meta is {}
+        a, b, a_frames, b_frames = await matched_pair(f'token={token}')
+        session_id = a_frames[-1]['session_id']
+        assert b_frames[-1]['partner']['meta'] == {'user_id': 9, 'username': 'user9', 'display_name': 'user9'}
+        before = realtime.get(f'{queue.SESSION_PREFIX}{session_id}').decode()
+        await a.disconnect(code=1006)
+        await frames(b)
+
+        back = communicator(f'token={token}&resume={a_frames[-1]["resume_token"]}')
+        assert (await back.connect())[0]
+        resumed = (await frames(back))[-1]
+        assert resumed['type'] == 'resumed' and resumed['session_id'] == session_id
+        assert resumed['partner']['meta'] == {}
+        assert [f['type'] for f in await frames(b)] == ['partner_resumed']
+        # Only our channel changed in the stored session (same worker), started_at and {} included
+        after = realtime.get(f'{queue.SESSION_PREFIX}{session_id}').decode()
+        session = json.loads(after)
+        me = session['user1'] if session['user1']['user_id'] == '9' else session['user2']
+        assert after == before.replace(b_frames[-1]['partner']['channel_name'], me['channel_name'])
+        assert '"meta":{}' in after
+
+        await back.send_json_to({'type': 'chat', 'message': 'hi'})
+        chat = (await frames(b))[-1]
+        assert chat['type'] == 'chat' and chat['sender_id'] == 9
+        await back.disconnect()
+        await b.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_requeue_stops_if_matched_while_leaving(realtime, monkeypatch):
+    async def scenario():
+        a = communicator()
+        await a.connect()
+        await frames(a)
+        (channel, consumer), = worker_runtime._waiting.items()
+        leave_queue = queue.async_matchmaking_queue.leave_queue
+
+        async def matched_while_leaving(*args, **kwargs):
+            await leave_queue(*args, **kwargs)
+            await get_channel_layer().send(channel, {
+                'type': 'matched_from_queue',
+                'session_id': 'swept',
+                'room_group_name': None,
+                'partner': {'channel_name': 'specific.elsewhere!1', 'user_id': 'p', 'meta': {}, 'worker': queue.WORKER_ID},
+                'is_initiator': True,
+            })
+            await asyncio.sleep(0.05)
+
+        monkeypatch.setattr(queue.async_matchmaking_queue, 'leave_queue', matched_while_leaving)
+        await consumer.requeue()
+        assert [f['type'] for f in await frames(a)] == ['matched']
+        assert consumer.session_id == 'swept'
+        assert not realtime.hexists(queue.PAYLOAD_KEY, channel)
+        await a.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_rate_limited_messages_are_dropped_then_the_socket_closed(realtime, monkeypatch):
+    monkeypatch.setattr(settings, 'CHAT_RATE_LIMITS', {'chat': (0.001, 2)})
+    monkeypatch.setattr(settings, 'CHAT_RATE_LIMIT_MAX_VIOLATIONS', 2)
+
+    async def scenario():
+        a, b, _, _ = await matched_pair()
+        for n in range(3):
+            await a.send_json_to({'type': 'chat', 'message': str(n)})
+        assert [f['type'] for f in await frames(a)] == ['warning']
+        assert [f['message'] for f in await frames(b)] == ['0', '1']
+        await a.send_json_to({'type': 'signal', 'payload': {'sdp': 'offer'}})
+        assert [f['type'] for f in await frames(b)] == ['signal']
+        await a.send_json_to({'type': 'chat', 'message': '3'})
+        await a.send_json_to({'type': 'chat', 'message': '4'})
+        assert (await a.receive_output())['type'] == 'websocket.send'
+        assert await a.receive_output() == {'type': 'websocket.close', 'code': 4008}
+        await b.disconnect()
+
+    asyncio.run(scenario())
+
+
+async def binary_frames(client: WebsocketCommunicator, timeout: float = 0.1) -> list:
+    received = []
+    while not await client.receive_nothing(timeout):
+        received.append(codec.unpackb(await client.receive_from()))
+    return received
+
+
+def test_msgpack_client_talks_to_a_json_client(realtime):
+    async def scenario():
+        a = communicator(subprotocols=[codec.MSGPACK_SUBPROTOCOL])
+        connected, subprotocol = await a.connect()
+        assert connected and subprotocol == codec.MSGPACK_SUBPROTOCOL
+        assert [f['type'] for f in await binary_frames(a)] == ['connected', 'waiting']
+        b = communicator()
+        await b.connect()
+        await frames(b)
+        assert (await binary_frames(a))[-1]['type'] == 'matched'
+
+        await a.send_to(bytes_data=codec.packb({'type': 'chat', 'message': 'from msgpack'}))
+        assert [f['message'] for f in await frames(b)] == ['from msgpack']
+        await b.send_json_to({'type': 'chat', 'message': 'from json'})
+        assert [f['message'] for f in await binary_frames(a)] == ['from json']
+        # Values JSON can't carry never reach the partner
+        await a.send_to(bytes_data=msgpack.packb({'type': 'chat', 'message': b'\x00'}, use_bin_type=True))
+        assert await frames(b) == []
+        await a.disconnect()
+        await b.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_oversized_frames_are_rejected_and_large_ones_relayed_compressed(realtime, monkeypatch):
+    monkeypatch.setattr(settings, 'CHAT_MAX_FRAME_BYTES', 4096)
+    monkeypatch.setattr(settings, 'CHANNEL_COMPRESS_THRESHOLD', 1024)
+    compressed = metrics.snapshot().get('channel_compressed', 0)
+
+    async def scenario():
+        a, b, _, _ = await matched_pair()
+        await a.send_json_to({'type': 'chat', 'message': 'x' * 5000})
+        assert await frames(a) == [{'type': 'error', 'code': 'message_too_large', 'limit': 4096}]
+        assert await frames(b) == []
+        # Under the limit but over the threshold: zlib on the channel layer, intact for the partner
+        await a.send_json_to({'type': 'chat', 'message': 'y' * 3000})
+        assert [f['message'] for f in await frames(b)] == ['y' * 3000]
+        await a.disconnect()
+        await b.disconnect()
+
+    asyncio.run(scenario())
+    assert metrics.snapshot()['channel_compressed'] == compressed + 1
+
+
+async def eventually(condition, timeout: float = 1.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+def test_ban_closes_the_users_sockets_and_refuses_new_ones(realtime):
+    async def scenario():
+        token = sign_in(9)
+        a, b, _, _ = await matched_pair(f'token={token}')
+        await eventually(lambda: ban_list.loaded)
+        mirror_ban(realtime, 9, True)
+        assert await a.receive_output(1) == {'type': 'websocket.close', 'code': 4003}
+        assert [f['type'] for f in await frames(b)] == ['partner_left']
+        # The cached identity still says not banned; the ban set overrides it
+        sign_in(9)
+        assert await communicator(f'token={token}').connect() == (False, 4003)
+        mirror_ban(realtime, 9, False)
+        await eventually(lambda: not ban_list.is_banned(9))
+        sign_in(9)
+        again = communicator(f'token={token}')
+        assert (await again.connect())[0]
+        assert [f['type'] for f in await frames(again)] == ['connected', 'waiting']
+        await again.disconnect()
+        await b.disconnect()
+
+    asyncio.run(scenario())
+
+
+async def until_closed(client: WebsocketCommunicator) -> tuple:
+    """The frames a client receives, then its close message."""
+    received = []
+    while (message := await client.receive_output())['type'] == 'websocket.send':
+        received.append(json.loads(message['text']))
+    return received, message
+
+
+def assert_turned_away(frame: dict, close: dict, reason: str) -> None:
+    assert frame['type'] == 'overloaded' and frame['reason'] == reason
+    assert settings.CHAT_RETRY_AFTER <= frame['retry_after'] < 2 * settings.CHAT_RETRY_AFTER
+    assert close == {'type': 'websocket.close', 'code': 4029, 'reason': f'retry-after={frame["retry_after"]}'}
+
+
+def test_a_full_worker_turns_connects_away(realtime, monkeypatch):
+    monkeypatch.setattr(settings, 'CHAT_MAX_CONNECTIONS', 1)
+
+    async def scenario():
+        a = communicator()
+        await a.connect()
+        b = communicator()
+        assert (await b.connect())[0]
+        (frame,), close = await until_closed(b)
+        assert_turned_away(frame, close, 'worker_full')
+        await a.disconnect()
+        c = communicator()
+        await c.connect()
+        assert [f['type'] for f in await frames(c)] == ['connected', 'waiting']
+        await c.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_a_deep_queue_turns_new_searches_away_but_lets_resumes_try(realtime, monkeypatch):
+    monkeypatch.setattr(settings, 'MATCHMAKING_MAX_QUEUE_DEPTH', 1)
+
+    async def scenario():
+        a = communicator('interests=a')
+        await a.connect()
+        assert [f['type'] for f in await frames(a)] == ['connected', 'waiting']
+        b = communicator()
+        assert (await b.connect())[0]
+        (frame,), close = await until_closed(b)
+        assert_turned_away(frame, close, 'queue_full')
+        # A signed resume token gets past the middleware; the session is gone and the
+        # consumer turns the fallback search away instead
+        c = communicator(f'resume={resume_token("ended", "specific.gone!1")}')
+        assert (await c.connect())[0]
+        received, close = await until_closed(c)
+        assert [f['type'] for f in received] == ['connected', 'resume_failed', 'overloaded']
+        assert_turned_away(received[-1], close, 'queue_full')
+        await a.disconnect()
+
+    asyncio.run(scenario())
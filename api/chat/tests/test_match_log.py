@@ -0,0 +1,98 @@
+"""
+MatchLogWriter (chat.services.mongo): spilling while MongoDB is down and
+replaying the spill files once it is back.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+from chat.services import mongo
+
+
+def start_event(session_id: str) -> dict:
+    return {'kind': 'start', 'session_id': session_id, 'user_ids': ['1', '2'], 'started_at': '1.5', 'ended_at': None}
+
+
+class Matches:
+    """Records the session ids of the bulk-written upserts."""
+
+    def __init__(self):
+        self.session_ids = []
+
+    def create_index(self, key):
+        pass
+
+    def bulk_write(self, ops, ordered):
+        self.session_ids += [op._filter['session_id'] for op in ops]
+
+
+class Database:
+    def __init__(self):
+        self.matches = Matches()
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = Database()
+    monkeypatch.setattr(mongo, 'get_mongo_db', lambda: database)
+    return database
+
+
+@pytest.fixture
+def writer(tmp_path):
+    return mongo.MatchLogWriter(max_queue=10, batch_size=10, flush_interval=0, spill_path=str(tmp_path / 'spill'))
+
+
+def own_spill(writer) -> str:
+    return f'{writer.spill_path}.{os.getpid()}'
+
+
+def session_ids(db) -> list:
+    return sorted(db.matches.session_ids)
+
+
+def mongo_down(monkeypatch):
+    def unreachable():
+        raise ServerSelectionTimeoutError('down')
+    monkeypatch.setattr(mongo, 'get_mongo_db', unreachable)
+
+
+def test_spills_while_mongo_is_down_and_replays_after(writer, db, monkeypatch):
+    with monkeypatch.context() as patch:
+        mongo_down(patch)
+        writer._write([start_event('s1')])
+    assert os.path.exists(own_spill(writer))
+    writer._write([start_event('s2')])
+    assert session_ids(db) == ['s1', 's2']
+    assert os.listdir(os.path.dirname(writer.spill_path)) == []
+
+
+def test_replay_skips_a_torn_line(writer, db):
+    with open(own_spill(writer), 'w') as f:
+        f.write(json.dumps(start_event('s1')) + '\n' + json.dumps(start_event('s2'))[:20])
+    writer._write([start_event('s3')])
+    assert session_ids(db) == ['s1', 's3']
+    assert writer.dropped == 1
+    assert not os.path.exists(own_spill(writer))
+
+
+def test_malformed_event_is_dropped_not_spilled(writer, db):
+    writer._write([start_event('s1'), {'kind': 'end', 'ended_at': '2.0'}])
+    assert session_ids(db) == ['s1']
+    assert writer.dropped == 1
+    assert not os.path.exists(own_spill(writer))
+
+
+def test_adopts_spill_of_an_exited_process_only(writer, db):
+    exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True)
+    running = os.getppid()
+    for pid, session_id in ((int(exited.stdout), 'gone'), (running, 'alive')):
+        with open(f'{writer.spill_path}.{pid}', 'w') as f:
+            f.write(json.dumps(start_event(session_id)) + '\n')
+    writer._write([start_event('s1')])
+    assert session_ids(db) == ['gone', 's1']
+    assert os.path.exists(f'{writer.spill_path}.{running}')
@@ -0,0 +1,96 @@
+"""
+Metrics (chat.services.metrics): per-thread counters, exports gathered from
+Redis, the Prometheus rendering and the /api/metrics/ endpoint.
+"""
+import threading
+import time
+
+import fakeredis
+import pytest
+from django.conf import settings
+from django.test import Client
+
+from chat import codec, views_api
+from chat.services.metrics import METRICS_KEY, Counters, collect, metrics, render
+from chat.services.queue import MatchmakingQueue
+
+
+def test_counters_add_up_over_threads():
+    counters = Counters()
+    threads = [threading.Thread(target=lambda: [counters.incr('hits') for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counters.incr('errors', where='x')
+    assert counters.snapshot() == {'hits': 4000, 'errors{where="x"}': 1}
+
+
+def export(counters: dict = None, histograms: dict = None, gauges: dict = None) -> dict:
+    return {'counters': counters or {}, 'histograms': histograms or {}, 'gauges': gauges or {}}
+
+
+def test_render_sums_workers_into_prometheus_text():
+    one = Counters()
+    one.observe('redis_call_seconds', 0.003, op='join')
+    one.observe('redis_call_seconds', 7, op='join')
+    histogram = one.export()['histograms']['redis_call_seconds{op="join"}']
+    text = render({
+        'w1': export({'sessions_matched': 2, 'errors{where="x"}': 1}, {'redis_call_seconds{op="join"}': histogram}, {'active_sessions': 3}),
+        'w2': export({'sessions_matched': 5}, {'redis_call_seconds{op="join"}': histogram}, {'active_sessions': 1}),
+    }, {'queue_depth': 4})
+    lines = text.splitlines()
+    assert lines[:2] == ['# TYPE blinkchat_queue_depth gauge', 'blinkchat_queue_depth 4']
+    assert 'blinkchat_active_sessions{worker="w1"} 3' in lines and 'blinkchat_active_sessions{worker="w2"} 1' in lines
+    assert '# TYPE blinkchat_sessions_matched_total counter' in lines
+    assert 'blinkchat_sessions_matched_total 7' in lines
+    assert 'blinkchat_errors_total{where="x"} 1' in lines
+    assert '# TYPE blinkchat_redis_call_seconds histogram' in lines
+    # Cumulative buckets over both workers
+    assert 'blinkchat_redis_call_seconds_bucket{op="join",le="0.0025"} 0' in lines
+    assert 'blinkchat_redis_call_seconds_bucket{op="join",le="0.005"} 2' in lines
+    assert 'blinkchat_redis_call_seconds_bucket{op="join",le="5"} 2' in lines
+    assert 'blinkchat_redis_call_seconds_bucket{op="join",le="+Inf"} 4' in lines
+    assert 'blinkchat_redis_call_seconds_count{op="join"} 4' in lines
+    assert 'blinkchat_redis_call_seconds_sum{op="join"} 14.006' in lines
+    assert text.endswith('\n')
+
+
+def test_collect_keeps_live_workers_and_drops_stale_ones():
+    client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    client.hset(METRICS_KEY, mapping={
+        'live': codec.dumps({'at': time.time(), **export({'hits': 1})}),
+        'stale': codec.dumps({'at': time.time() - 60, **export({'hits': 1})}),
+        'broken': '{',
+    })
+    exports = collect(client, 'me', max_age=20)
+    assert sorted(exports) == ['live', 'me']
+    assert exports['me'] == metrics.export() | {'gauges': exports['me']['gauges']}
+    assert client.hkeys(METRICS_KEY) == [b'live']
+
+
+@pytest.fixture
+def metrics_settings(monkeypatch):
+    monkeypatch.setattr(settings, 'METRICS_TOKEN', 'scraper-secret')
+    monkeypatch.setattr(settings, 'METRICS_PUBLIC', False)
+
+
+@pytest.fixture
+def scrape(monkeypatch, metrics_settings):
+    monkeypatch.setattr(views_api, 'matchmaking_queue', MatchmakingQueue(client=fakeredis.FakeRedis(server=fakeredis.FakeServer())))
+    client = Client(HTTP_HOST='localhost')
+    return lambda **headers: client.get('/api/metrics/', headers=headers)
+
+
+def test_metrics_need_the_token(scrape):
+    assert scrape().status_code == 401
+    assert scrape(Authorization='Bearer wrong').status_code == 401
+    response = scrape(Authorization='Bearer scraper-secret')
+    assert response.status_code == 200
+    assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert 'blinkchat_queue_depth 0' in response.content.decode().splitlines()
+
+
+def test_metrics_can_be_made_public(scrape, monkeypatch):
+    monkeypatch.setattr(settings, 'METRICS_PUBLIC', True)
+    assert scrape().status_code == 200
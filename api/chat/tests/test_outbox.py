@@ -0,0 +1,123 @@
+"""
+Outbound backpressure (chat.outbox): ordering, dropping above the high-water
+mark, slow-consumer detection and pausing on Daphne's transport.
+"""
+import asyncio
+from functools import partial
+
+from chat.outbox import Outbox
+
+
+class Socket:
+    """ASGI send that records frames and can be held, like a client not reading."""
+
+    def __init__(self):
+        self.sent = []
+        self.open = asyncio.Event()
+        self.open.set()
+
+    async def send(self, message):
+        await self.open.wait()
+        self.sent.append(message['text'])
+
+
+def frame(text: str) -> dict:
+    return {'type': 'websocket.send', 'text': text}
+
+
+def test_frames_go_out_in_order_without_blocking_the_caller():
+    async def scenario():
+        socket = Socket()
+        socket.open.clear()
+        outbox = Outbox(socket.send, high_water=100, max_bytes=200, stall_timeout=10)
+        assert all(outbox.put(frame(str(n)), 10) for n in range(5))
+        assert outbox.size == 50 and socket.sent == []
+        socket.open.set()
+        await asyncio.sleep(0)
+        await outbox._writer
+        assert socket.sent == ['0', '1', '2', '3', '4'] and outbox.size == 0
+
+    asyncio.run(scenario())
+
+
+def test_above_high_water_drops_droppable_frames_and_caps_the_rest():
+    async def scenario():
+        socket = Socket()
+        socket.open.clear()
+        outbox = Outbox(socket.send, high_water=20, max_bytes=40, stall_timeout=10)
+        assert outbox.put(frame('a'), 20)
+        assert outbox.put(frame('chat'), 10, droppable=True)
+        assert outbox.put(frame('b'), 10) and outbox.put(frame('c'), 10)
+        # The hard cap: the client is too slow to keep
+        assert not outbox.put(frame('d'), 10)
+        socket.open.set()
+        await outbox._writer
+        assert socket.sent == ['a', 'b', 'c']
+
+    asyncio.run(scenario())
+
+
+def test_stalled_above_high_water_for_the_timeout_is_a_slow_consumer():
+    async def scenario():
+        socket = Socket()
+        socket.open.clear()
+        outbox = Outbox(socket.send, high_water=10, max_bytes=1000, stall_timeout=0.05)
+        assert outbox.put(frame('a'), 10) and outbox.put(frame('b'), 10)
+        await asyncio.sleep(0.06)
+        assert not outbox.put(frame('c'), 10)
+        outbox.discard()
+        assert outbox.size == 0
+
+    asyncio.run(scenario())
+
+
+def test_catching_up_clears_the_stall():
+    async def scenario():
+        socket = Socket()
+        socket.open.clear()
+        outbox = Outbox(socket.send, high_water=10, max_bytes=1000, stall_timeout=0.05)
+        outbox.put(frame('a'), 10)
+        outbox.put(frame('b'), 10)
+        socket.open.set()
+        await outbox._writer
+        await asyncio.sleep(0.06)
+        assert outbox.put(frame('c'), 10) and outbox.put(frame('d'), 10)
+
+    asyncio.run(scenario())
+
+
+class Protocol:
+    """The Twisted side of a Daphne connection, as far as the outbox uses it."""
+
+    def __init__(self):
+        self.transport = object()
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        if self.producer is not None:
+            raise RuntimeError('Cannot register producer, because one is already registered')
+        self.producer = producer
+
+    def handle_reply(self, message):
+        pass
+
+
+def test_follows_daphnes_transport_buffer():
+    async def scenario():
+        socket, protocol = Socket(), Protocol()
+        outbox = Outbox(socket.send, high_water=100, max_bytes=200, stall_timeout=10)
+        # Daphne's ASGI send is a partial with the protocol as its first argument
+        assert outbox.follow_transport(partial(Protocol.handle_reply, protocol))
+        assert protocol.producer is outbox
+        protocol.producer.pauseProducing()
+        outbox.put(frame('a'), 10)
+        await asyncio.sleep(0.01)
+        assert socket.sent == [] and outbox.size == 10
+        protocol.producer.resumeProducing()
+        await outbox._writer
+        assert socket.sent == ['a']
+        # A second registration, and servers other than Daphne, leave the outbox as is
+        assert not Outbox(socket.send, 100, 200, 10).follow_transport(partial(Protocol.handle_reply, protocol))
+        assert not outbox.follow_transport(socket.send)
+
+    asyncio.run(scenario())
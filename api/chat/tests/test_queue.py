@@ -0,0 +1,244 @@
+"""
+The matchmaking scripts (chat.services.queue) against fakeredis's Lua runtime:
+pairing order, duplicates, recent partners, relaxation, cleanup and the
+sharded rebalance.
+"""
+import time
+import uuid
+
+import fakeredis
+import pytest
+
+from chat.services import queue as q
+
+EN_EU = {'lang': 'en', 'region': 'eu'}
+
+
+def new_client():
+    return fakeredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+@pytest.fixture
+def client():
+    return new_client()
+
+
+@pytest.fixture
+def queue(client):
+    matchmaking = q.MatchmakingQueue(client=client)
+    matchmaking.heartbeat()
+    return matchmaking
+
+
+def partner_of(session: dict, channel: str) -> str:
+    users = (session['user1']['channel_name'], session['user2']['channel_name'])
+    assert channel in users
+    return users[1] if users[0] == channel else users[0]
+
+
+def matchmaking_keys(client) -> set:
+    return {key.decode() for key in client.keys('blinkchat:matchmaking:*')}
+
+
+def test_waits_then_pairs_with_the_next_joiner(queue):
+    assert queue.join('ch.a', 'a', EN_EU) == {'status': 'waiting', 'position': 1}
+    session = queue.join('ch.b', 'b', EN_EU)
+    assert partner_of(session, 'ch.b') == 'ch.a'
+    assert queue.get_session(session['session_id']) == session
+    assert queue.depth == 0
+
+
+def test_pairs_waiters_first_in_first_out(queue, monkeypatch):
+    monkeypatch.setattr(q, 'RELAX_DELAYS', (60, 0.2))
+    # Different interests: the waiters can only meet through the ANY bucket
+    for name in 'abc':
+        assert queue.join(f'ch.{name}', name, {'interests': [name]})['status'] == 'waiting'
+    time.sleep(0.25)
+    assert partner_of(queue.join('ch.d', 'd', {}), 'ch.d') == 'ch.a'
+    assert partner_of(queue.join('ch.e', 'e', {}), 'ch.e') == 'ch.b'
+    assert partner_of(queue.join('ch.f', 'f', {}), 'ch.f') == 'ch.c'
+
+
+def test_never_pairs_a_user_with_themselves(queue):
+    queue.join('ch.a1', 'a', EN_EU)
+    result = queue.join('ch.a2', 'a', EN_EU)
+    assert 'session_id' not in result
+    assert result['status'] == 'waiting'
+
+
+def test_duplicate_replaces_the_older_entry(queue, client):
+    queue.join('ch.a1', 'a', EN_EU)
+    result = queue.join('ch.a2', 'a', EN_EU)
+    assert result['replaced'] == 'ch.a1'
+    assert client.zrange(q.QUEUE_KEY, 0, -1) == [b'ch.a2']
+    assert client.hget(q.PRESENCE_KEY, 'a') == b'ch.a2'
+
+
+def test_duplicate_is_rejected_under_reject_policy(queue, client, monkeypatch):
+    monkeypatch.setattr(q, 'DUPLICATE_POLICY', 'reject')
+    queue.join('ch.a1', 'a', EN_EU)
+    assert queue.join('ch.a2', 'a', EN_EU) == {'status': 'duplicate'}
+    assert client.zrange(q.QUEUE_KEY, 0, -1) == [b'ch.a1']
+
+
+def test_skips_recent_partners(queue):
+    queue.join('ch.a', 'a', EN_EU)
+    queue.join('ch.b', 'b', EN_EU)
+    # Both back in the queue: they are not paired again, a third user takes the older one
+    assert queue.join('ch.a2', 'a', EN_EU)['status'] == 'waiting'
+    assert queue.join('ch.b2', 'b', EN_EU)['status'] == 'waiting'
+    assert partner_of(queue.join('ch.c', 'c', EN_EU), 'ch.c') == 'ch.a2'
+
+
+def test_relaxes_criteria_over_time(queue, monkeypatch):
+    monkeypatch.setattr(q, 'RELAX_DELAYS', (0.3, 0.6))
+    queue.join('ch.a', 'a', {'lang': 'en', 'region': 'eu'})
+    # Same language, other region: only through the language bucket, once both waited 0.3 s
+    assert queue.join('ch.b', 'b', {'lang': 'en', 'region': 'us'})['status'] == 'waiting'
+    queue.join('ch.c', 'c', {'lang': 'de', 'region': 'at'})
+    assert queue.match_waiting() == []
+    time.sleep(0.35)
+    sessions = queue.match_waiting()
+    assert len(sessions) == 1 and partner_of(sessions[0], 'ch.b') == 'ch.a'
+    # Anyone after 0.6 s
+    queue.join('ch.d', 'd', {'lang': 'fr', 'region': 'fr'})
+    assert queue.match_waiting() == []
+    time.sleep(0.65)
+    sessions = queue.match_waiting()
+    assert len(sessions) == 1 and partner_of(sessions[0], 'ch.c') == 'ch.d'
+
+
+def test_leave_removes_every_index(queue, client):
+    queue.join('ch.a', 'a', {'lang': 'en', 'region': 'eu', 'interests': ['music']})
+    queue.leave_queue('ch.a')
+    assert matchmaking_keys(client) == {q.WORKERS_KEY}
+    assert queue.join('ch.b', 'b', EN_EU)['status'] == 'waiting'
+
+
+def join_on_dead_worker(queue, client, monkeypatch, channel: str, user_id: str) -> None:
+    with monkeypatch.context() as patch:
+        patch.setattr(q, 'WORKER_ID', 'dead-worker')
+        queue.join(channel, user_id, EN_EU)
+    client.zadd(q.WORKERS_KEY, {'dead-worker': int(time.time()) - q.WORKER_TIMEOUT - 1})
+
+
+def test_reaps_entries_of_dead_workers(queue, client, monkeypatch):
+    join_on_dead_worker(queue, client, monkeypatch, 'ch.a', 'a')
+    assert queue.reap_stale() == 1
+    assert matchmaking_keys(client) == {q.WORKERS_KEY}
+
+
+def test_joiner_drops_rather_than_pairs_a_dead_waiter(queue, client, monkeypatch):
+    join_on_dead_worker(queue, client, monkeypatch, 'ch.a', 'a')
+    assert queue.join('ch.b', 'b', EN_EU) == {'status': 'waiting', 'position': 1}
+    assert not client.hexists(q.PAYLOAD_KEY, 'ch.a')
+    assert not client.hexists(q.PRESENCE_KEY, 'a')
+
+
+def test_heartbeat_reports_being_reaped(queue, client):
+    assert queue.heartbeat() == ({q.WORKER_ID}, False)
+    client.zadd(q.WORKERS_KEY, {q.WORKER_ID: int(time.time()) - q.WORKER_TIMEOUT - 1})
+    queue.reap_stale()
+    assert queue.heartbeat() == ({q.WORKER_ID}, True)
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    """Two shards; user x waits on its home shard, two others (unmatchable for now) on the other."""
+    monkeypatch.setattr(q, 'REBALANCE_AFTER', 0)
+    clients = [new_client(), new_client()]
+    matchmaking = q.MatchmakingQueue(clients=clients)
+    matchmaking.heartbeat()
+    users = [f'u{i}' for i in range(100)]
+    home = matchmaking._home('x')
+    others = [user for user in users if matchmaking._home(user) != home][:2]
+    matchmaking.join('ch.x1', 'x', EN_EU)
+    for i, user in enumerate(others):
+        assert matchmaking.join(f'ch.o{i}', user, {'lang': f'l{i}', 'region': f'r{i}'})['status'] == 'waiting'
+    return matchmaking, clients, home, 1 - home
+
+
+def shards_holding(clients, channel: str) -> list:
+    return [shard for shard, client in enumerate(clients) if client.hexists(q.PAYLOAD_KEY, channel)]
+
+
+def test_rebalance_moves_waiters_to_the_deepest_shard(shards):
+    matchmaking, clients, home, target = shards
+    assert matchmaking.rebalance() == 1
+    assert shards_holding(clients, 'ch.x1') == [target]
+    assert clients[home].zcard(q.MIGRATIONS_KEY) == 0
+
+
+def test_moved_waiter_is_still_replaced_by_a_second_tab(shards):
+    matchmaking, clients, home, target = shards
+    matchmaking.rebalance()
+    result = matchmaking.join('ch.x2', 'x', EN_EU)
+    assert result['replaced'] == 'ch.x1'
+    assert shards_holding(clients, 'ch.x1') == []
+
+
+def test_moved_waiter_still_rejects_a_second_tab(shards, monkeypatch):
+    matchmaking, clients, home, target = shards
+    monkeypatch.setattr(q, 'DUPLICATE_POLICY', 'reject')
+    matchmaking.rebalance()
+    assert matchmaking.join('ch.x2', 'x', EN_EU) == {'status': 'duplicate'}
+
+
+def interrupted_move(matchmaking, home: int, target: int, land: bool) -> str:
+    move_id = uuid.uuid4().hex
+    entries, _ = matchmaking._script(q.MIGRATE_OUT_SCRIPT, home)(
+        keys=q._KEYS, args=q._migrate_out_call(move_id, target, q.REBALANCE_MAX),
+    )
+    if land:
+        matchmaking._script(q.MIGRATE_IN_SCRIPT, target)(keys=q._KEYS, args=q._migrate_in_call(move_id, entries))
+    return move_id
+
+
+def test_move_interrupted_before_landing_is_put_back(shards):
+    matchmaking, clients, home, target = shards
+    move_id = interrupted_move(matchmaking, home, target, land=False)
+    assert shards_holding(clients, 'ch.x1') == []
+    matchmaking._recover_move(home, move_id, target)
+    assert shards_holding(clients, 'ch.x1') == [home]
+    # The mover, if only stalled, can no longer land it
+    entries = [b'ch.x1', clients[home].hget(q.PAYLOAD_KEY, 'ch.x1'), b'0']
+    assert matchmaking._script(q.MIGRATE_IN_SCRIPT, target)(
+        keys=q._KEYS, args=q._migrate_in_call(move_id, entries),
+    ) == 0
+
+
+def test_move_interrupted_after_landing_is_not_duplicated(shards):
+    matchmaking, clients, home, target = shards
+    move_id = interrupted_move(matchmaking, home, target, land=True)
+    matchmaking._recover_move(home, move_id, target)
+    assert shards_holding(clients, 'ch.x1') == [target]
+    assert not clients[home].exists(f'{q.TRANSIT_PREFIX}{move_id}')
+
+
+def test_rebalance_recovers_stale_moves(shards, monkeypatch):
+    matchmaking, clients, home, target = shards
+    interrupted_move(matchmaking, home, target, land=False)
+    monkeypatch.setattr(q, 'WORKER_TIMEOUT', 1)
+    time.sleep(1.1)
+    matchmaking.heartbeat()
+    matchmaking.rebalance()
+    assert len(shards_holding(clients, 'ch.x1')) == 1
+    assert clients[home].zcard(q.MIGRATIONS_KEY) == 0
+
+
+def test_join_settles_an_entry_moved_between_its_round_trips(shards, monkeypatch):
+    matchmaking, clients, home, target = shards
+    script = matchmaking._script
+
+    def move_another_tab_before_probing(source, shard):
+        if source is q.TAKE_SCRIPT:
+            monkeypatch.setattr(matchmaking, '_script', script)
+            assert matchmaking.join('ch.x3', 'x', EN_EU)['status'] == 'waiting'
+            assert matchmaking.rebalance() == 1
+        return script(source, shard)
+
+    monkeypatch.setattr(matchmaking, '_script', move_another_tab_before_probing)
+    result = matchmaking.join('ch.x2', 'x', EN_EU)
+    assert result['status'] == 'waiting' and result['position'] == 1
+    assert shards_holding(clients, 'ch.x2') == [home]
+    assert shards_holding(clients, 'ch.x3') == []
@@ -0,0 +1,70 @@
+"""
+Token buckets and the Redis-backed per-user limiter (chat.services.ratelimit).
+"""
+import asyncio
+
+import fakeredis
+import pytest
+
+from chat.services import ratelimit
+from chat.services.metrics import metrics
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ratelimit's monotonic clock, advanced by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_bucket_allows_a_burst_then_refills_at_its_rate(clock):
+    bucket = ratelimit.TokenBucket(rate=2, burst=3)
+    assert [bucket.allow() for _ in range(4)] == [True, True, True, False]
+    clock[0] += 0.5
+    assert [bucket.allow() for _ in range(2)] == [True, False]
+    clock[0] += 60
+    assert sum(bucket.allow() for _ in range(5)) == 3
+
+
+def test_connection_limits_only_listed_types(clock):
+    limiter = ratelimit.ConnectionLimiter({'chat': (1, 1)}, max_violations=2)
+    assert limiter.allow('chat') and not limiter.allow('chat')
+    assert all(limiter.allow('signal') for _ in range(100))
+    assert [limiter.violation() for _ in range(3)] == [True, True, False]
+
+
+def test_no_violation_allowance_never_disconnects():
+    limiter = ratelimit.ConnectionLimiter({}, max_violations=0)
+    assert all(limiter.violation() for _ in range(100))
+
+
+def shared(client, user_id='7', lease=2):
+    return ratelimit.SharedLimiter(client, user_id, {'chat': (0.001, 5)}, lease)
+
+
+def test_shared_limit_spans_connections_of_a_user():
+    client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+
+    async def scenario():
+        first, second, other = shared(client), shared(client), shared(client, user_id='8')
+        allowed = [await limiter.allow('chat') for limiter in (first, second) * 4]
+        # Five tokens between the two sockets, leased two at a time
+        assert allowed.count(True) == 5 and allowed[-2:] == [False, False]
+        assert await other.allow('chat')
+        assert await first.allow('signal')
+
+    asyncio.run(scenario())
+
+
+def test_shared_limit_fails_open_without_redis():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    limiter = shared(fakeredis.FakeAsyncRedis(server=server))
+    errors = metrics.snapshot().get('errors{where="rate_limit"}', 0)
+
+    async def scenario():
+        assert all([await limiter.allow('chat') for _ in range(10)])
+
+    asyncio.run(scenario())
+    assert metrics.snapshot()['errors{where="rate_limit"}'] == errors + 10
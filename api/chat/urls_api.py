@@ -1,7 +1,9 @@
 from django.urls import path
-from .views_api import ReportCreateView, api_root
+from .views_api import ReportCreateView, api_root, metrics_view, slowlog_view
 
 urlpatterns = [
     path('', api_root),
     path('reports/', ReportCreateView.as_view(), name='report-create'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('debug/slowlog/', slowlog_view, name='debug-slowlog'),
 ]
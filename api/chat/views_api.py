@@ -1,9 +1,18 @@
+import redis
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.crypto import constant_time_compare
 from rest_framework import generics
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import AllowAny
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from .models import Report
 from .serializers import ReportSerializer
+from .services.metrics import METRICS_KEY, collect, metrics, render
+from .services.queue import WORKER_ID, WORKER_TIMEOUT, matchmaking_queue
+from .services import tracing
 
 
 @api_view(['GET'])
@@ -13,6 +22,61 @@ def api_root(request):
     return Response({'ok': True})
 
 
+def _may_scrape(request) -> bool:
+    """METRICS_PUBLIC, 'Authorization: Bearer <METRICS_TOKEN>', or a staff user (session or JWT)."""
+    if getattr(settings, 'METRICS_PUBLIC', False):
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    if request.user.is_staff:
+        return True
+    try:
+        auth = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return auth is not None and auth[0].is_staff
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint: every live worker's metrics summed, plus queue
+    depth and match rate read from Redis now. Scrapers send
+    'Authorization: Bearer <METRICS_TOKEN>'; staff users may read it too.
+    """
+    if not _may_scrape(request):
+        return HttpResponse(status=401)
+    try:
+        exports = collect(matchmaking_queue.client_for(METRICS_KEY), WORKER_ID, max_age=WORKER_TIMEOUT)
+        depth = matchmaking_queue.sample()
+        gauges = {'queue_depth': depth, 'match_rate': round(matchmaking_queue.match_rate, 3), 'workers': len(exports)}
+    except redis.RedisError:
+        metrics.incr('errors', where='metrics_scrape')
+        exports, gauges = {WORKER_ID: metrics.export()}, {}
+    return HttpResponse(render(exports, gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def slowlog_view(request):
+    """
+    Slowest traced connects/receives/disconnects of every live worker (staff only);
+    ?kind=connect filters, ?limit=N caps the list. Needs CHAT_TRACE_SLOWLOG_SIZE.
+    """
+    kind = request.query_params.get('kind') or None
+    try:
+        limit = int(request.query_params.get('limit', 0)) or None
+    except ValueError:
+        limit = None
+    try:
+        records = tracing.collect(
+            matchmaking_queue.client_for(tracing.SLOWLOG_KEY), WORKER_ID, max_age=WORKER_TIMEOUT, kind=kind, limit=limit,
+        )
+    except redis.RedisError:
+        records = tracing.slowlog.records()
+    return Response({'size': tracing.SLOWLOG_SIZE, 'sample_rate': tracing.SAMPLE_RATE, 'records': records})
+
+
 class ReportCreateView(generics.CreateAPIView):
     serializer_class = ReportSerializer
 
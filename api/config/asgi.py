@@ -8,10 +8,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 django_asgi_app = get_asgi_application()
 
 from channels.routing import ProtocolTypeRouter, URLRouter
-from chat.middleware import JWTWebSocketAuthMiddleware
+from chat.middleware import AdmissionMiddleware, JWTWebSocketAuthMiddleware
 from chat.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
     'http': django_asgi_app,
-    'websocket': JWTWebSocketAuthMiddleware(URLRouter(websocket_urlpatterns)),
+    'websocket': AdmissionMiddleware(JWTWebSocketAuthMiddleware(URLRouter(websocket_urlpatterns))),
 })
@@ -104,20 +104,120 @@ SIMPLE_JWT = {
     'SIGNING_KEY': _jwt_signing_key,
 }
 
+# Redis URL for matchmaking queue (can use same Redis)
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379')
+# Comma-separated Redis nodes to shard the matchmaking queue, sessions and channel layer over
+# (consistent hashing: users by id, sessions by session id, channels by name). Defaults to REDIS_URL
+REDIS_SHARD_URLS = [url.strip() for url in os.environ.get('REDIS_SHARD_URLS', REDIS_URL).split(',') if url.strip()]
+
 # Channels - Redis as channel layer
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {'hosts': [os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379')]},
+        # The hybrid layer delivers in memory when both consumers share a process
+        'BACKEND': os.environ.get('CHANNEL_LAYER_BACKEND', 'chat.layers.HybridChannelLayer'),
+        # channels_redis applies capacity to each process's single inbox list, which every socket
+        # on a worker shares; its default of 100 raises ChannelFull on a busy worker
+        'CONFIG': {'hosts': REDIS_SHARD_URLS, 'capacity': int(os.environ.get('CHANNEL_LAYER_CAPACITY', '5000'))},
     }
 }
 
-# Redis URL for matchmaking queue (can use same Redis)
-REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379')
+# Peer message routing: 'direct' sends 1:1 session traffic straight to the partner's
+# channel; 'group' fans out through a per-session group (multi-party rooms)
+CHAT_ROUTING = os.environ.get('CHAT_ROUTING', 'direct')
+# Hold trickle-ICE candidates this many ms and forward them as one 'signals' frame (0 = off)
+SIGNAL_BATCH_MS = int(os.environ.get('SIGNAL_BATCH_MS', '0'))
+# Incoming WebSocket frames larger than this are rejected (0 = no limit)
+CHAT_MAX_FRAME_BYTES = int(os.environ.get('CHAT_MAX_FRAME_BYTES', '65536'))
+# Relayed payloads/messages at least this large are zlib-compressed on the channel layer (0 = off)
+CHANNEL_COMPRESS_THRESHOLD = int(os.environ.get('CHANNEL_COMPRESS_THRESHOLD', '1024'))
+# Per-connection token buckets, "type=rate/burst" (messages per second, burst size). Messages over the
+# limit are dropped with a warning frame; more than MAX_VIOLATIONS per minute closes the socket (4008).
+# An empty value turns the limits off
+CHAT_RATE_LIMITS = {
+    name.strip(): tuple(float(v) for v in limit.split('/'))
+    for name, limit in (
+        item.split('=')
+        for item in os.environ.get('CHAT_RATE_LIMITS', 'chat=5/10,signal=50/100,next=1/5').split(',')
+        if item.strip()
+    )
+}
+CHAT_RATE_LIMIT_MAX_VIOLATIONS = int(os.environ.get('CHAT_RATE_LIMIT_MAX_VIOLATIONS', '20'))
+# Also enforce CHAT_RATE_LIMITS per signed-in user across sockets and workers, via Redis
+# (tokens are leased LEASE at a time, so this costs one round trip per LEASE messages)
+CHAT_RATE_LIMIT_SHARED = os.environ.get('CHAT_RATE_LIMIT_SHARED', 'False').lower() == 'true'
+CHAT_RATE_LIMIT_LEASE = int(os.environ.get('CHAT_RATE_LIMIT_LEASE', '10'))
+# Outbound backpressure: above HIGH_WATER bytes queued for a client, chat and ICE-candidate frames
+# are dropped; a client above it for SLOW_CONSUMER_TIMEOUT seconds or at MAX_BYTES is closed (4009)
+CHAT_OUTBOX_HIGH_WATER = int(os.environ.get('CHAT_OUTBOX_HIGH_WATER', '262144'))
+CHAT_OUTBOX_MAX_BYTES = int(os.environ.get('CHAT_OUTBOX_MAX_BYTES', '1048576'))
+CHAT_SLOW_CONSUMER_TIMEOUT = float(os.environ.get('CHAT_SLOW_CONSUMER_TIMEOUT', '10'))
+
+# Admission control, checked before authentication: a worker holding MAX_CONNECTIONS sockets, or a
+# new matchmaking connect while MAX_QUEUE_DEPTH users wait across all shards, gets an 'overloaded'
+# frame with a jittered retry_after (RETRY_AFTER to twice that, in seconds) and close code 4029 (0 = no limit)
+CHAT_MAX_CONNECTIONS = int(os.environ.get('CHAT_MAX_CONNECTIONS', '0'))
+MATCHMAKING_MAX_QUEUE_DEPTH = int(os.environ.get('MATCHMAKING_MAX_QUEUE_DEPTH', '0'))
+CHAT_RETRY_AFTER = float(os.environ.get('CHAT_RETRY_AFTER', '5'))
+
+# A matched socket that drops without a close frame (1006) keeps its session this many seconds;
+# reconnecting with ?resume=<resume_token from the matched frame> rebinds it (0 = off, partner_left at once)
+CHAT_RESUME_GRACE = float(os.environ.get('CHAT_RESUME_GRACE', '0'))
+
+# /api/metrics/ (Prometheus text format, summed over live workers) is for this bearer token and staff
+# users only, unless METRICS_PUBLIC is set (e.g. when only an internal network can reach it)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', 'False').lower() == 'true'
+
+# Phase tracing of WebSocket connect/receive/disconnect (off at 0): log this fraction of traces as JSON
+# on the 'chat.trace' logger (at INFO), and keep the slowest SLOWLOG_SIZE of each kind per worker for
+# /api/debug/slowlog/ (staff only)
+CHAT_TRACE_SAMPLE_RATE = float(os.environ.get('CHAT_TRACE_SAMPLE_RATE', '0'))
+CHAT_TRACE_SLOWLOG_SIZE = int(os.environ.get('CHAT_TRACE_SLOWLOG_SIZE', '0'))
+
+# In-process cache of WebSocket identities (user, ban state, display name)
+IDENTITY_CACHE_TTL = float(os.environ.get('IDENTITY_CACHE_TTL', '30'))
+IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE', '10000'))
+
+# Per-worker asyncio connection pool for the matchmaking queue, per shard (connects wait up to the timeout when full)
+REDIS_POOL_MAX_CONNECTIONS = int(os.environ.get('REDIS_POOL_MAX_CONNECTIONS', '50'))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', '5'))
+# Connect/read timeout of the synchronous client (model signals, management commands), so an
+# unreachable Redis fails a profile save's ban mirroring fast instead of hanging the request
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '2'))
+# Worker liveness: each Daphne process heartbeats every interval; queue entries and sessions of a
+# worker silent for longer than the timeout are skipped/evicted. Session keys expire after the TTL
+# unless a live worker refreshes them.
+MATCHMAKING_HEARTBEAT_INTERVAL = float(os.environ.get('MATCHMAKING_HEARTBEAT_INTERVAL', '5'))
+MATCHMAKING_WORKER_TIMEOUT = int(os.environ.get('MATCHMAKING_WORKER_TIMEOUT', '20'))
+MATCHMAKING_SESSION_TTL = int(os.environ.get('MATCHMAKING_SESSION_TTL', '120'))
+# Matching on ?lang=&region=&interests= relaxes over time: after the first delay (seconds) a waiter
+# accepts language- or region-only matches, after the second anyone
+MATCHMAKING_RELAX_DELAYS = tuple(
+    int(v) for v in os.environ.get('MATCHMAKING_RELAX_DELAYS', '5,15').split(',')
+)
+# Users matched within the TTL (seconds) are not paired again; up to MAX partners are remembered
+MATCHMAKING_RECENT_PARTNER_TTL = int(os.environ.get('MATCHMAKING_RECENT_PARTNER_TTL', '300'))
+MATCHMAKING_RECENT_PARTNER_MAX = int(os.environ.get('MATCHMAKING_RECENT_PARTNER_MAX', '20'))
+# With at least DEPTH users waiting, prefer a partner on the joiner's own worker process among the
+# next SCAN eligible waiters (their messages then stay in memory with the hybrid layer; 0 = off)
+MATCHMAKING_PREFER_LOCAL_DEPTH = int(os.environ.get('MATCHMAKING_PREFER_LOCAL_DEPTH', '0'))
+MATCHMAKING_PREFER_LOCAL_SCAN = int(os.environ.get('MATCHMAKING_PREFER_LOCAL_SCAN', '20'))
+# With several REDIS_SHARD_URLS, waiters unmatched for this many seconds are moved to the deepest
+# shard by the worker loop, so sparse shards can't strand users
+MATCHMAKING_REBALANCE_AFTER = float(os.environ.get('MATCHMAKING_REBALANCE_AFTER', '2'))
+# A user queued from a second tab either replaces the first entry ('replace') or is turned away ('reject')
+MATCHMAKING_DUPLICATE_POLICY = os.environ.get('MATCHMAKING_DUPLICATE_POLICY', 'replace')
 
 # MongoDB for match logs (optional); MONGODB_URI or MONGO_URI
 MONGO_URI = os.environ.get('MONGODB_URI') or os.environ.get('MONGO_URI', 'mongodb://127.0.0.1:27017')
 MONGO_DB_NAME = os.environ.get('MONGO_DB_NAME', 'blinkchat')
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', '2000'))
+# Match logs are batched by a background writer; when its buffer is full or Mongo is down,
+# events go to MATCH_LOG_SPILL_PATH.<pid> (JSON lines, replayed later) or are dropped if unset
+MATCH_LOG_QUEUE_SIZE = int(os.environ.get('MATCH_LOG_QUEUE_SIZE', '10000'))
+MATCH_LOG_BATCH_SIZE = int(os.environ.get('MATCH_LOG_BATCH_SIZE', '200'))
+MATCH_LOG_FLUSH_INTERVAL = float(os.environ.get('MATCH_LOG_FLUSH_INTERVAL', '1.0'))
+MATCH_LOG_SPILL_PATH = os.environ.get('MATCH_LOG_SPILL_PATH', '')
 
 # Port for ASGI (Daphne); use PORT from host (e.g. Vercel/Railway) or default 8000
 PORT = int(os.environ.get('PORT', '8000'))